@@ -38,4 +38,5 @@ echo "=========================================="
 echo ""
 
 # 最簡單的啟動方式 - 不使用任何會導致問題的選項
+python -m app.migrations || exit 1
 exec python -m uvicorn app.main:app --host 0.0.0.0 --port 8000
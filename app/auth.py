@@ -3,6 +3,7 @@ from fastapi.responses import RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
 import os
+import hmac
 import logging
 import sys
 
@@ -82,3 +83,19 @@ def require_login(request: Request):
     if not user:
         return RedirectResponse(url='/login', status_code=status.HTTP_302_FOUND)
     return None
+
+def require_internal_access(request: Request):
+    """
+    內部監控端點的權限檢查：已登入的使用者，
+    或帶有與 INTERNAL_API_TOKEN 相符的 X-Internal-Token header（給監控程式用）
+    """
+    if request.session.get('user'):
+        return
+    expected = os.getenv('INTERNAL_API_TOKEN')
+    provided = request.headers.get('x-internal-token', '')
+    if expected and hmac.compare_digest(provided, expected):
+        return
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Not authenticated"
+    )
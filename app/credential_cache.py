@@ -0,0 +1,302 @@
+"""
+Gmail 憑證記憶體快取與提前更新（refresh-ahead）
+- session 中的 gmail_token 與 gmail_token.pickle 的憑證都只建立 / 讀取一次，保留在記憶體
+- 背景 thread 在 access token 到期前 GMAIL_REFRESH_AHEAD_SECONDS 秒先行更新，
+  發信時不必等待 OAuth token 更新；pickle 憑證更新後由背景寫回檔案
+- 不知道到期時間的憑證（舊 session 沒有 expires_at）登記後立即在背景更新一次以取得到期時間
+- 超過 GMAIL_CREDENTIAL_IDLE_SECONDS 未使用（get / token_for / load_file）的憑證不再提前更新，
+  並由背景 thread 移出快取；使用者登出或不再發信後，不會在程序存活期間一直替其更新 token
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Optional
+import hashlib
+import os
+import pickle
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 到期前多少秒開始更新
+GMAIL_REFRESH_AHEAD_SECONDS = int(os.getenv("GMAIL_REFRESH_AHEAD_SECONDS", "300"))
+# 背景檢查間隔（秒）
+GMAIL_REFRESH_CHECK_SECONDS = int(os.getenv("GMAIL_REFRESH_CHECK_SECONDS", "30"))
+# 最多快取幾組憑證（LRU）
+GMAIL_CREDENTIAL_CACHE_SIZE = int(os.getenv("GMAIL_CREDENTIAL_CACHE_SIZE", "64"))
+# 閒置多久（秒）後停止提前更新並移出快取；應不小於 EMAIL_RETRY_MAX_DELAY_SECONDS，重試佇列才能取回原發送者的憑證
+GMAIL_CREDENTIAL_IDLE_SECONDS = int(os.getenv("GMAIL_CREDENTIAL_IDLE_SECONDS", str(6 * 3600)))
+# 更新失敗後隔多久再試（秒）
+_RETRY_AFTER_FAILURE = timedelta(minutes=5)
+
+
+def credential_key(token_dict: dict) -> str:
+    """憑證識別碼（不保存原始 token）"""
+    secret = token_dict.get("refresh_token") or token_dict.get("access_token") or ""
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def file_credential_key(path) -> str:
+    """gmail_token.pickle 憑證的識別碼（路徑雜湊，長度固定，可存入 credential_key 欄位）"""
+    digest = hashlib.sha256(str(Path(path).resolve()).encode()).hexdigest()
+    return f"file:{digest[:40]}"
+
+
+def _utcnow() -> datetime:
+    # google-auth 的 expiry 使用 naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def build_credentials(token_dict: dict):
+    """由 session 的 gmail_token 建立 Credentials（expires_at 為 epoch 秒）"""
+    from google.oauth2.credentials import Credentials
+    from app.email_service import SCOPES
+
+    expiry = None
+    if token_dict.get("expires_at"):
+        expiry = datetime.fromtimestamp(int(token_dict["expires_at"]), timezone.utc).replace(tzinfo=None)
+    return Credentials(
+        token=token_dict.get("access_token"),
+        refresh_token=token_dict.get("refresh_token"),
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=os.getenv("GOOGLE_CLIENT_ID"),
+        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+        scopes=SCOPES,
+        expiry=expiry,
+    )
+
+
+class _Entry:
+    def __init__(self, credentials, on_refresh: Optional[Callable] = None):
+        self.credentials = credentials
+        self.on_refresh = on_refresh
+        self.lock = threading.Lock()  # 同一組憑證同時只做一次更新
+        self.last_error: Optional[str] = None
+        self.failed_at: Optional[datetime] = None
+        self.refreshed_at: Optional[datetime] = None
+        self.last_used = _utcnow()
+
+
+class CredentialCache:
+    def __init__(self, max_entries: int = GMAIL_CREDENTIAL_CACHE_SIZE,
+                 ahead_seconds: int = GMAIL_REFRESH_AHEAD_SECONDS,
+                 check_seconds: int = GMAIL_REFRESH_CHECK_SECONDS,
+                 idle_seconds: int = GMAIL_CREDENTIAL_IDLE_SECONDS):
+        self.max_entries = max_entries
+        self.ahead = timedelta(seconds=ahead_seconds)
+        self.idle = timedelta(seconds=idle_seconds)
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._files: dict = {}  # 檔案路徑 → 最後讀取 / 寫入時的 mtime
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- 取得憑證 ----
+
+    def get(self, token_dict: dict):
+        """session gmail_token 對應的 Credentials（同一組 refresh token 共用同一個物件）"""
+        key = credential_key(token_dict)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(build_credentials(token_dict))
+                self._put(key, entry)
+            else:
+                self._entries.move_to_end(key)
+                entry.last_used = _utcnow()
+                # 使用者重新授權帶來新的 access token，而快取中的已失效時改用新的
+                creds = entry.credentials
+                access_token = token_dict.get("access_token")
+                if access_token and access_token != creds.token and not creds.valid:
+                    fresh = build_credentials(token_dict)
+                    creds.token, creds.expiry = fresh.token, fresh.expiry
+        self._schedule(entry)
+        return entry.credentials
+
+    def token_for(self, key: str) -> Optional[dict]:
+        """依識別碼取回記憶體中的憑證（gmail_token 格式），程序重啟後即不存在"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or key.startswith("file:"):
+            return None
+        entry.last_used = _utcnow()
+        creds = entry.credentials
+        expires_at = None
+        if creds.expiry is not None:
+            expires_at = int(creds.expiry.replace(tzinfo=timezone.utc).timestamp())
+        return {
+            "access_token": creds.token,
+            "refresh_token": creds.refresh_token,
+            "expires_at": expires_at,
+        }
+
+    def load_file(self, path: Path):
+        """gmail_token.pickle 的憑證；檔案未變動時直接回傳記憶體中的物件"""
+        path = Path(path)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        key = file_credential_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._files.get(key) == mtime:
+                self._entries.move_to_end(key)
+                entry.last_used = _utcnow()
+                return entry.credentials
+        with open(path, 'rb') as token:
+            credentials = pickle.load(token)
+        if not credentials:
+            return None
+        entry = _Entry(credentials, on_refresh=lambda creds: self._write_file(key, path, creds))
+        with self._lock:
+            self._put(key, entry)
+            self._files[key] = mtime
+        self._schedule(entry)
+        return credentials
+
+    def forget_file(self, path: Path):
+        """檔案內容由外部改寫（例如重新授權）後丟棄快取"""
+        key = file_credential_key(path)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._files.pop(key, None)
+
+    def usable(self, credentials) -> bool:
+        """
+        憑證目前可用：token 有效，或可由 refresh token 更新且背景更新沒有失敗過
+        （不會在呼叫端同步更新）
+        """
+        if credentials.valid:
+            return True
+        entry = self._entry_for(credentials)
+        return bool(credentials.refresh_token) and (entry is None or entry.last_error is None)
+
+    def refresh_now(self, credentials) -> bool:
+        """同步更新（只在背景更新來不及時使用），回傳是否成功"""
+        entry = self._entry_for(credentials) or _Entry(credentials)
+        return self._refresh(entry)
+
+    # ---- 背景更新 ----
+
+    def _is_idle(self, entry: _Entry, now: datetime) -> bool:
+        return now - entry.last_used > self.idle
+
+    def _needs_refresh(self, entry: _Entry) -> bool:
+        creds = entry.credentials
+        if not creds.refresh_token:
+            return False
+        now = _utcnow()
+        if self._is_idle(entry, now):
+            # 閒置的憑證不提前更新（下次使用時若已過期，由呼叫端同步更新）
+            return False
+        if entry.failed_at and now - entry.failed_at < _RETRY_AFTER_FAILURE:
+            return False
+        if creds.expiry is None:
+            # 不知道到期時間：更新一次以取得
+            return entry.refreshed_at is None
+        return creds.expiry - now <= self.ahead
+
+    def _refresh(self, entry: _Entry) -> bool:
+        from google.auth.transport.requests import Request
+
+        with entry.lock:
+            if entry.refreshed_at and not self._needs_refresh(entry) and entry.credentials.valid:
+                return True  # 其他 thread 剛更新完
+            try:
+                entry.credentials.refresh(Request())
+            except Exception as e:
+                entry.last_error = str(e)
+                entry.failed_at = _utcnow()
+                logger.warning(f"Gmail 憑證更新失敗: {e}")
+                return False
+            entry.last_error = None
+            entry.failed_at = None
+            entry.refreshed_at = _utcnow()
+        if entry.on_refresh:
+            try:
+                entry.on_refresh(entry.credentials)
+            except Exception as e:
+                logger.warning(f"寫回 Gmail 憑證失敗: {e}")
+        logger.info(f"✓ Gmail 憑證已提前更新，新 token 到期時間 {entry.credentials.expiry} (UTC)")
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.evict_idle()
+            with self._lock:
+                due = [e for e in self._entries.values() if self._needs_refresh(e)]
+            for entry in due:
+                if self._stop.is_set():
+                    break
+                self._refresh(entry)
+            self._wake.wait(self.check_seconds)
+            self._wake.clear()
+
+    def _schedule(self, entry: _Entry):
+        """確保背景 thread 已啟動；需要更新的憑證立即喚醒處理"""
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stop.clear()
+                    self._thread = threading.Thread(target=self._run, name="gmail-credential-refresh", daemon=True)
+                    self._thread.start()
+        if self._needs_refresh(entry):
+            self._wake.set()
+
+    def evict_idle(self) -> int:
+        """移出閒置超過 idle 的憑證，回傳移出的數量"""
+        now = _utcnow()
+        with self._lock:
+            idle = [key for key, entry in self._entries.items() if self._is_idle(entry, now)]
+            for key in idle:
+                del self._entries[key]
+                self._files.pop(key, None)
+        if idle:
+            logger.info(f"已移出 {len(idle)} 組閒置的 Gmail 憑證")
+        return len(idle)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # ---- 內部 ----
+
+    def _put(self, key: str, entry: _Entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._files.pop(old_key, None)
+
+    def _entry_for(self, credentials) -> Optional[_Entry]:
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.credentials is credentials:
+                    return entry
+        return None
+
+    def _write_file(self, key: str, path: Path, credentials):
+        with open(path, 'wb') as token:
+            pickle.dump(credentials, token)
+        with self._lock:
+            self._files[key] = path.stat().st_mtime
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = _utcnow()
+            return {
+                "credentials": len(self._entries),
+                "refresh_thread_alive": bool(self._thread and self._thread.is_alive()),
+                "failed": sum(1 for e in self._entries.values() if e.last_error),
+                "expiring_within_ahead": sum(
+                    1 for e in self._entries.values()
+                    if e.credentials.expiry is not None and e.credentials.expiry - now <= self.ahead
+                ),
+            }
+
+
+credential_cache = CredentialCache()
@@ -1,27 +1,153 @@
 from sqlalchemy.orm import Session
-from app import models, schemas
-from typing import List, Optional
+from sqlalchemy import and_, or_, literal, func, update, select
+from sqlalchemy.exc import IntegrityError
+from app import models, schemas, search as client_search
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+import base64
+import json
+import os
 
 def get_client(db: Session, client_id: int):
     return db.query(models.Client).filter(models.Client.id == client_id).first()
 
-def get_clients(db: Session, skip: int = 0, limit: int = 100, search: Optional[str] = None):
+def encode_cursor(client: models.Client) -> str:
+    """將列表最後一筆的排序鍵編碼為不透明的分頁游標"""
+    payload = [
+        client.updated_at.isoformat() if client.updated_at else None,
+        client.created_at.isoformat() if client.created_at else None,
+        client.id,
+    ]
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], Optional[datetime], int]:
+    """解析分頁游標，格式錯誤時拋出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, created_at, client_id = json.loads(raw)
+        return (
+            datetime.fromisoformat(updated_at) if updated_at else None,
+            datetime.fromisoformat(created_at) if created_at else None,
+            int(client_id),
+        )
+    except (ValueError, TypeError) as e:
+        raise ValueError("無效的分頁游標") from e
+
+def _timestamp_param(db: Session, value: datetime):
+    """
+    產生與欄位比較用的時間參數。
+    SQLite 以字串儲存時間，server_default/onupdate 寫入的格式沒有微秒，
+    而 SQLAlchemy 綁定參數會補上 .000000，直接比較會讓同秒資料判斷錯誤。
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        fmt = "%Y-%m-%d %H:%M:%S.%f" if value.microsecond else "%Y-%m-%d %H:%M:%S"
+        return literal(value.strftime(fmt))
+    return value
+
+def _after_cursor(db: Session, cursor: str):
+    """keyset 條件：排在游標那筆資料之後的所有列（對應 get_clients 的排序）"""
+    updated_at, created_at, client_id = decode_cursor(cursor)
+    Client = models.Client
+
+    if created_at is None:
+        tail = and_(Client.created_at.is_(None), Client.id < client_id)
+    else:
+        created = _timestamp_param(db, created_at)
+        tail = or_(
+            Client.created_at < created,
+            and_(Client.created_at == created, Client.id < client_id),
+            Client.created_at.is_(None),
+        )
+
+    if updated_at is None:
+        # 游標已進入 updated_at 為 NULL 的尾段（NULLS LAST）
+        return and_(Client.updated_at.is_(None), tail)
+
+    updated = _timestamp_param(db, updated_at)
+    return or_(
+        Client.updated_at < updated,
+        and_(Client.updated_at == updated, tail),
+        Client.updated_at.is_(None),
+    )
+
+def _clients_query(db: Session, search: Optional[str] = None, ranked: bool = False):
     query = db.query(models.Client)
+    order_by = []
     if search:
-        query = query.filter(
-            (models.Client.client_name.ilike(f"%{search}%")) |
-            (models.Client.project_name.ilike(f"%{search}%"))
-        )
+        query = query.filter(client_search.search_filter(db, search))
+        if ranked:
+            # 搜尋時相關度高的排前面
+            order_by.append(client_search.search_rank(db, search).desc())
     # 排序：最後修改時間新到舊（updated_at 優先，若為 None 則用 created_at）
-    query = query.order_by(
+    # 最後以 id 排序確保順序穩定，keyset 分頁才不會漏資料或重複
+    return query.order_by(
+        *order_by,
         models.Client.updated_at.desc().nullslast(),
-        models.Client.created_at.desc()
+        models.Client.created_at.desc(),
+        models.Client.id.desc()
+    )
+
+def get_clients(db: Session, skip: int = 0, limit: int = 100, search: Optional[str] = None):
+    return _clients_query(db, search, ranked=True).offset(skip).limit(limit).all()
+
+def get_clients_page(db: Session, limit: int = 100, search: Optional[str] = None,
+                     cursor: Optional[str] = None) -> Tuple[List[models.Client], Optional[str]]:
+    """
+    keyset (游標) 分頁：以上一頁最後一筆的排序鍵定位，
+    搭配 ix_clients_recent 索引，任何一頁的成本都與第一頁相同。
+    帶 search 時只做索引過濾、維持時間排序；需要相關度排序請用 get_clients。
+
+    Returns:
+        (clients, next_cursor)：沒有下一頁時 next_cursor 為 None
+    """
+    query = _clients_query(db, search)
+    if cursor:
+        query = query.filter(_after_cursor(db, cursor))
+    # 多取一筆判斷是否還有下一頁
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+def count_clients(db: Session, search: Optional[str] = None) -> int:
+    """符合搜尋條件的客戶數"""
+    query = db.query(func.count(models.Client.id))
+    if search:
+        query = query.filter(client_search.search_filter(db, search))
+    return query.scalar()
+
+def get_client_ids(db: Session, search: Optional[str] = None, exclude_ids=()) -> List[int]:
+    """符合搜尋條件的所有客戶 ID（扣除 exclude_ids），供「全選符合條件」於發送時解析"""
+    query = db.query(models.Client.id)
+    if search:
+        query = query.filter(client_search.search_filter(db, search))
+    excluded = set(exclude_ids)
+    return [client_id for (client_id,) in query.order_by(models.Client.id) if client_id not in excluded]
+
+# 啟用後 get_statistics 直接讀 client_stats 的 rollup 列（O(1)），
+# 由 create/update/delete_client 在同一個 transaction 內增量更新
+STATS_ROLLUP_ENABLED = os.getenv("CLIENT_STATS_ROLLUP", "false").lower() in ("1", "true", "yes")
+STATS_ROLLUP_ID = 1
+
+def adjust_stats_rollup(db: Session, clients_delta: int, amount_delta: int):
+    """增量更新統計 rollup；rollup 列尚未建立時略過，第一次讀取時會完整計算"""
+    if not STATS_ROLLUP_ENABLED or (clients_delta == 0 and amount_delta == 0):
+        return
+    db.execute(
+        update(models.ClientStats)
+        .where(models.ClientStats.id == STATS_ROLLUP_ID)
+        .values(
+            total_clients=models.ClientStats.total_clients + clients_delta,
+            total_amount=models.ClientStats.total_amount + amount_delta,
+        )
     )
-    return query.offset(skip).limit(limit).all()
 
 def create_client(db: Session, client: schemas.ClientCreate):
     db_client = models.Client(**client.model_dump())
     db.add(db_client)
+    adjust_stats_rollup(db, 1, db_client.project_cost)
     db.commit()
     db.refresh(db_client)
     return db_client
@@ -29,9 +155,11 @@ def create_client(db: Session, client: schemas.ClientCreate):
 def update_client(db: Session, client_id: int, client: schemas.ClientUpdate):
     db_client = get_client(db, client_id)
     if db_client:
+        old_cost = db_client.project_cost
         update_data = client.model_dump(exclude_unset=True)
         for key, value in update_data.items():
             setattr(db_client, key, value)
+        adjust_stats_rollup(db, 0, db_client.project_cost - old_cost)
         db.commit()
         db.refresh(db_client)
     return db_client
@@ -40,15 +168,47 @@ def delete_client(db: Session, client_id: int):
     db_client = get_client(db, client_id)
     if db_client:
         db.delete(db_client)
+        adjust_stats_rollup(db, -1, -db_client.project_cost)
         db.commit()
     return db_client
 
+def _aggregate_statistics(db: Session):
+    """單一 SQL 聚合查詢：客戶數與費用總和"""
+    total_clients, total_amount = db.query(
+        func.count(models.Client.id),
+        func.coalesce(func.sum(models.Client.project_cost), 0),
+    ).one()
+    return total_clients, int(total_amount)
+
+def rebuild_statistics_rollup(db: Session):
+    """以聚合查詢重新計算並寫入 rollup 列（初次建立或校正用）"""
+    total_clients, total_amount = _aggregate_statistics(db)
+    stats = db.get(models.ClientStats, STATS_ROLLUP_ID)
+    if stats:
+        stats.total_clients = total_clients
+        stats.total_amount = total_amount
+    else:
+        db.add(models.ClientStats(
+            id=STATS_ROLLUP_ID,
+            total_clients=total_clients,
+            total_amount=total_amount,
+        ))
+    try:
+        db.commit()
+    except IntegrityError:
+        # 其他 worker 同時建立了 rollup 列，直接使用對方的結果
+        db.rollback()
+    return total_clients, total_amount
+
 def get_statistics(db: Session):
-    total_clients = db.query(models.Client).count()
-    total_cost = db.query(models.Client).with_entities(
-        models.Client.project_cost
-    ).all()
-    total_amount = sum([c[0] for c in total_cost]) if total_cost else 0
+    if STATS_ROLLUP_ENABLED:
+        stats = db.get(models.ClientStats, STATS_ROLLUP_ID)
+        if stats:
+            total_clients, total_amount = stats.total_clients, stats.total_amount
+        else:
+            total_clients, total_amount = rebuild_statistics_rollup(db)
+    else:
+        total_clients, total_amount = _aggregate_statistics(db)
     avg_amount = total_amount / total_clients if total_clients > 0 else 0
     
     return {
@@ -56,3 +216,91 @@ def get_statistics(db: Session):
         "total_amount": total_amount,
         "average_amount": int(avg_amount)
     }
+
+# ---- 郵件發送記錄 ----
+
+def encode_log_cursor(log_id: int) -> str:
+    """郵件記錄分頁游標（上一頁最後一筆的 id）"""
+    raw = json.dumps([log_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_log_cursor(cursor: str) -> int:
+    """解析郵件記錄分頁游標，格式錯誤時拋出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        (log_id,) = json.loads(raw)
+        return int(log_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError("無效的分頁游標") from e
+
+def _log_time_param(db, value: datetime):
+    """日期區間參數：帶時區的時間先轉成 UTC（資料庫中 created_at 為 UTC）"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+        if db.get_bind().dialect.name == "sqlite":
+            value = value.replace(tzinfo=None)
+    return _timestamp_param(db, value)
+
+def email_log_filters(db, status: Optional[str] = None, template_id: Optional[int] = None,
+                      client_id: Optional[int] = None, created_from: Optional[datetime] = None,
+                      created_to: Optional[datetime] = None) -> list:
+    """
+    郵件記錄篩選條件（created_from 含、created_to 不含）。
+    db 只用來判斷方言，同步 Session 與 AsyncSession 皆可。
+    """
+    Log = models.EmailLog
+    conditions = []
+    if status:
+        conditions.append(Log.status == status)
+    if template_id is not None:
+        conditions.append(Log.template_id == template_id)
+    if client_id is not None:
+        conditions.append(Log.client_id == client_id)
+    if created_from is not None:
+        conditions.append(Log.created_at >= _log_time_param(db, created_from))
+    if created_to is not None:
+        conditions.append(Log.created_at < _log_time_param(db, created_to))
+    return conditions
+
+def email_logs_page_query(conditions: list, cursor: Optional[str] = None, limit: int = 50):
+    """
+    郵件記錄 keyset 分頁查詢（新到舊）。
+    以 id 排序（寫入順序），搭配 (client_id, id) / (template_id, id) / (status, id) 索引，
+    篩選後直接沿索引取 limit + 1 筆，不需排序全部符合的資料；多取的一筆用來判斷是否有下一頁。
+    """
+    query = select(models.EmailLog).where(*conditions)
+    if cursor:
+        query = query.where(models.EmailLog.id < decode_log_cursor(cursor))
+    return query.order_by(models.EmailLog.id.desc()).limit(limit + 1)
+
+def split_log_page(rows: list, limit: int) -> Tuple[list, Optional[str]]:
+    """切掉多取的一筆，回傳 (本頁資料, 下一頁游標)"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_log_cursor(rows[-1].id)
+    return rows, None
+
+def email_log_counts_query(conditions: list):
+    """單一 GROUP BY 查詢取得各狀態 × 模板的筆數（由 (status, template_id) 索引支援）"""
+    Log = models.EmailLog
+    return (
+        select(Log.status, Log.template_id, func.count())
+        .where(*conditions)
+        .group_by(Log.status, Log.template_id)
+    )
+
+def summarize_log_counts(rows) -> dict:
+    """將 (status, template_id, count) 列整理為總數、各狀態與各模板的統計"""
+    by_status, by_template = {}, {}
+    total = 0
+    for status, template_id, count in rows:
+        total += count
+        by_status[status] = by_status.get(status, 0) + count
+        per_template = by_template.setdefault(template_id, {"template_id": template_id, "total": 0})
+        per_template["total"] += count
+        per_template[status] = per_template.get(status, 0) + count
+    return {
+        "total": total,
+        "by_status": by_status,
+        "by_template": sorted(by_template.values(), key=lambda t: -t["total"]),
+    }
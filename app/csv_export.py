@@ -0,0 +1,61 @@
+"""
+客戶資料串流匯出模組（CSV / NDJSON）
+以 yield_per 走 server-side cursor 分批讀取 clients，邊讀邊輸出，
+記憶體用量與資料筆數無關。CSV 欄位與 csv_import 相同，可直接再匯入。
+"""
+from sqlalchemy import select
+from typing import Iterator
+from app import models
+from app.database import ReadSessionLocal
+from app.csv_import import COLUMN_MAP
+import csv
+import io
+import json
+
+EXPORT_BATCH_SIZE = 1000
+
+# clients 欄位 → 匯出欄位名稱（與匯入格式相同）
+EXPORT_COLUMNS = {field: header for header, field in COLUMN_MAP.items()}
+
+
+def _iter_client_batches(batch_size: int) -> Iterator[list]:
+    """
+    以獨立 session 逐批讀取客戶資料。
+    StreamingResponse 會在 request 的依賴關閉後才開始迭代，因此不能共用 get_db 的 session。
+    """
+    db = ReadSessionLocal()
+    try:
+        columns = [getattr(models.Client, field) for field in EXPORT_COLUMNS]
+        result = db.execute(
+            select(*columns)
+            .order_by(models.Client.id)
+            .execution_options(yield_per=batch_size)
+        )
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+
+def iter_clients_csv(batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """產生 CSV 內容（含 UTF-8 BOM，方便 Excel 開啟）"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS.values())
+    yield "\ufeff" + buf.getvalue()
+
+    for rows in _iter_client_batches(batch_size):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(rows)
+        yield buf.getvalue()
+
+
+def iter_clients_ndjson(batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """產生 NDJSON 內容（每行一筆客戶）"""
+    headers = list(EXPORT_COLUMNS.values())
+    for rows in _iter_client_batches(batch_size):
+        yield "".join(
+            json.dumps(dict(zip(headers, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
@@ -0,0 +1,132 @@
+"""
+客戶 CSV 批次匯入模組
+以 chunk 串流解析上傳檔案，向量化驗證欄位後整批寫入：
+- PostgreSQL (psycopg2)：COPY ... FROM STDIN
+- 其他資料庫：多列 INSERT（executemany）
+整份檔案一個 transaction：不會整份檔案讀進記憶體，也不會逐筆 commit；
+任何一個 chunk 失敗時整份檔案都不寫入，重新上傳不會產生重複資料。
+"""
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from typing import BinaryIO, TYPE_CHECKING
+from app import crud, models
+import csv
+import io
+import time
+import logging
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# CSV 欄位 → clients 資料表欄位
+COLUMN_MAP = {
+    "客戶名稱": "client_name",
+    "專案名稱": "project_name",
+    "email": "email",
+    "專案費用": "project_cost",
+}
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class CSVImportError(ValueError):
+    """CSV 檔案格式錯誤（缺欄位、編碼錯誤等）"""
+
+
+def _validate_chunk(chunk: "pd.DataFrame") -> "pd.DataFrame":
+    """向量化驗證並轉換一個 chunk，回傳可寫入的資料（格式錯誤的列會被剔除）"""
+    import pandas as pd
+
+    missing = [col for col in COLUMN_MAP if col not in chunk.columns]
+    if missing:
+        raise CSVImportError(f"CSV 缺少欄位：{', '.join(missing)}")
+
+    df = chunk[list(COLUMN_MAP)].rename(columns=COLUMN_MAP)
+    for col in ("client_name", "project_name", "email"):
+        df[col] = df[col].astype("string").str.strip()
+
+    cost = pd.to_numeric(df["project_cost"].astype("string").str.replace(",", ""), errors="coerce")
+    valid = (
+        df["client_name"].fillna("").ne("")
+        & df["project_name"].fillna("").ne("")
+        & df["email"].fillna("").ne("")
+        & cost.notna()
+    )
+    df = df[valid].copy()
+    df["project_cost"] = cost[valid].astype("int64")
+    return df
+
+
+def _copy_rows(db: Session, df: "pd.DataFrame"):
+    """PostgreSQL：以 COPY 寫入"""
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, quoting=csv.QUOTE_MINIMAL)
+    buf.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY clients ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)",
+            buf,
+        )
+    finally:
+        cursor.close()
+
+
+def _insert_rows(db: Session, df: "pd.DataFrame"):
+    """其他資料庫：多列 INSERT"""
+    db.execute(insert(models.Client), df.to_dict("records"))
+
+
+def import_clients_csv(db: Session, fileobj: BinaryIO, chunksize: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """
+    串流匯入客戶 CSV。
+
+    Returns:
+        dict: {"imported": int, "skipped": int, "seconds": float, "rows_per_sec": float}
+
+    Raises:
+        CSVImportError: 檔案缺少必要欄位或不是 UTF-8（已寫入的 chunk 一併 rollback）
+    """
+    # pandas 載入很慢，只在實際匯入時才 import，避免拖慢應用程式啟動
+    import pandas as pd
+
+    bind = db.get_bind()
+    use_copy = bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2"
+    write_rows = _copy_rows if use_copy else _insert_rows
+
+    imported = skipped = total_cost = 0
+    started = time.perf_counter()
+    try:
+        reader = pd.read_csv(fileobj, encoding="utf-8-sig", dtype=str, chunksize=chunksize)
+        for chunk in reader:
+            df = _validate_chunk(chunk)
+            skipped += len(chunk) - len(df)
+            if df.empty:
+                continue
+            write_rows(db, df)
+            imported += len(df)
+            total_cost += int(df["project_cost"].sum())
+        if imported:
+            crud.adjust_stats_rollup(db, imported, total_cost)
+        db.commit()
+    except UnicodeDecodeError as e:
+        db.rollback()
+        raise CSVImportError("CSV 檔案必須是 UTF-8 編碼（整份檔案未匯入）") from e
+    except pd.errors.EmptyDataError as e:
+        db.rollback()
+        raise CSVImportError("CSV 檔案沒有資料") from e
+    except Exception:
+        db.rollback()
+        raise
+
+    seconds = time.perf_counter() - started
+    rows_per_sec = imported / seconds if seconds > 0 else 0.0
+    logger.info(f"CSV 匯入完成：{imported} 筆，略過 {skipped} 筆，{seconds:.2f}s（{rows_per_sec:,.0f} rows/sec）")
+    return {
+        "imported": imported,
+        "skipped": skipped,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows_per_sec, 1),
+    }
@@ -0,0 +1,402 @@
+"""
+背景批次發信
+/api/emails/send 只建立 EmailJob 並立即回傳 job id，實際發送由程序內的 worker pool 執行：
+- 以 Gmail batch 請求一次送出多封（GMAIL_BATCH_SIZE），多個 batch 由 ConcurrentSender 並行送出
+  並受速率 / 每日配額限制（見 app.email_sender）
+- 每封的結果由 EmailLogWriter 批次寫入 EmailLog（帶 job_id）並累加 EmailJob 的 sent_count / failed_count；
+  可重試的失敗同時排入 email_retries，由排程稍後重送（見 app.email_retry）
+- 進度可由 GET /api/emails/jobs/{id} 或 SSE /api/emails/jobs/{id}/events 取得
+- 帶冪等鍵（idempotency key）重送同一請求時回傳原本的工作；原工作中斷（failed，或租約已過期）則續送，
+  已有 EmailLog 的客戶（以 (job_id, client_id) 唯一限制保證只有一筆）直接略過。
+  冪等鍵依建立者區分，續送只接受原建立者、原發送者的憑證（email_jobs.credential_key）
+- 租約（lease）：排隊中 / 執行中的工作記錄負責的程序（worker_id）與 lease_expires_at，
+  由該程序的背景 thread 每 EMAIL_JOB_LEASE_SECONDS / 3 秒延長。程序被強制結束（SIGKILL、OOM、
+  未等待的部署）後租約過期，recover_orphaned_jobs（啟動時與排程定期執行）將其標記為 failed，
+  之後以相同冪等鍵重送即可續送
+
+Gmail token 只在記憶體中交給 worker，不寫入資料庫。
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+import logging
+
+from app import models
+from app.template_render import TemplatePlan, client_variables, get_template_plan
+
+logger = logging.getLogger(__name__)
+
+# 同時執行的發信工作數
+EMAIL_JOB_WORKERS = int(os.getenv("EMAIL_JOB_WORKERS", "2"))
+# 每次從資料庫載入的收件客戶數
+CLIENT_FETCH_BATCH = 200
+# 租約長度（秒）：負責的程序超過這段時間沒有延長，即視為已中斷
+EMAIL_JOB_LEASE_SECONDS = int(os.getenv("EMAIL_JOB_LEASE_SECONDS", "120"))
+# 已結束的工作狀態
+FINISHED_STATUSES = ("completed", "failed")
+# 需要租約的工作狀態
+ACTIVE_STATUSES = ("queued", "running")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+# job id → Future（僅本程序提交的工作）
+_futures: Dict[int, Future] = {}
+_heartbeat: Optional[threading.Thread] = None
+_worker: Optional[Tuple[int, str]] = None
+
+
+def worker_id() -> str:
+    """本程序的識別碼；容器重啟後 pid 可能相同，因此加上隨機碼"""
+    global _worker
+    pid = os.getpid()
+    if _worker is None or _worker[0] != pid:
+        _worker = (pid, f"{socket.gethostname()}:{pid}:{secrets.token_hex(4)}")
+    return _worker[1]
+
+
+def _lease_deadline() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=EMAIL_JOB_LEASE_SECONDS)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """第一次發信時才建立 worker pool"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EMAIL_JOB_WORKERS, thread_name_prefix="email-job")
+        return _executor
+
+
+def create_job(db: Session, template_id: int, client_ids: List[int],
+               created_by: Optional[str] = None,
+               idempotency_key: Optional[str] = None,
+               credential_key: Optional[str] = None) -> Tuple[models.EmailJob, bool]:
+    """
+    建立排隊中的發信工作（重複的客戶 ID 只發一次）。
+    同一位建立者的 idempotency_key 已被使用時不建立新工作，回傳 (既有工作, False)。
+    credential_key 為發送者憑證識別碼（見 email_retry.sender_credential_key），續送時需相同。
+    """
+    unique_ids = list(dict.fromkeys(client_ids))
+    job = models.EmailJob(
+        template_id=template_id,
+        client_ids=json.dumps(unique_ids),
+        status="queued",
+        total=len(unique_ids),
+        sent_count=0,
+        failed_count=0,
+        created_by=created_by,
+        idempotency_key=idempotency_key,
+        credential_key=credential_key,
+        worker_id=worker_id(),
+        lease_expires_at=_lease_deadline(),
+    )
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # 同一個冪等鍵的請求同時送達，由先寫入的那個建立工作
+        db.rollback()
+        existing = get_job_by_key(db, created_by, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        return existing, False
+    db.refresh(job)
+    return job, True
+
+
+def get_job_by_key(db: Session, created_by: Optional[str], idempotency_key: str) -> Optional[models.EmailJob]:
+    """冪等鍵只在同一位建立者內有效"""
+    return db.query(models.EmailJob).filter(
+        models.EmailJob.created_by == created_by, models.EmailJob.idempotency_key == idempotency_key
+    ).first()
+
+
+def _resumable_condition(now: datetime):
+    """可續送：已中斷（failed），或排隊中 / 執行中但租約已過期（負責的程序已不存在）"""
+    return or_(
+        models.EmailJob.status == "failed",
+        (models.EmailJob.status.in_(ACTIVE_STATUSES)
+         & or_(models.EmailJob.lease_expires_at.is_(None), models.EmailJob.lease_expires_at < now)),
+    )
+
+
+def is_resumable(job: models.EmailJob) -> bool:
+    if job.status == "failed":
+        return True
+    if job.status not in ACTIVE_STATUSES:
+        return False
+    lease = job.lease_expires_at
+    if lease is not None and lease.tzinfo is None:
+        # SQLite 讀回的時間沒有時區（寫入時為 UTC）
+        lease = lease.replace(tzinfo=timezone.utc)
+    return lease is None or lease < datetime.now(timezone.utc)
+
+
+def resume_job(db: Session, job_id: int) -> bool:
+    """
+    將中斷的工作（見 is_resumable）重新排入佇列，回傳是否成功；
+    以條件式 UPDATE 確保同時重送時只有一個請求會續送。
+    """
+    result = db.execute(
+        update(models.EmailJob)
+        .where(models.EmailJob.id == job_id, _resumable_condition(datetime.now(timezone.utc)))
+        .values(status="queued", error_message=None, finished_at=None,
+                worker_id=worker_id(), lease_expires_at=_lease_deadline())
+        # 不在 Python 端比對 session 內的物件（SQLite 讀回的時間沒有時區，無法與 now 比較）
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def recover_orphaned_jobs(db: Session) -> int:
+    """
+    將租約已過期的排隊中 / 執行中工作標記為 failed（負責的程序已不存在），回傳筆數。
+    沒有租約的工作（租約功能加入前建立）一併視為中斷。
+    """
+    now = datetime.now(timezone.utc)
+    result = db.execute(
+        update(models.EmailJob)
+        .where(models.EmailJob.status.in_(ACTIVE_STATUSES), _resumable_condition(now))
+        .values(
+            status="failed",
+            error_message="執行此工作的程序已中斷，以相同請求重新送出即可續送",
+            finished_at=now,
+            lease_expires_at=None,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    if result.rowcount:
+        logger.warning(f"已將 {result.rowcount} 個中斷的發信工作標記為失敗")
+    return result.rowcount
+
+
+def renew_leases():
+    """延長本程序排隊中 / 執行中工作的租約"""
+    from app.database import SessionLocal
+
+    job_ids = list(_futures)
+    if not job_ids:
+        return
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(models.EmailJob)
+            .where(
+                models.EmailJob.id.in_(job_ids),
+                models.EmailJob.worker_id == worker_id(),
+                models.EmailJob.status.in_(ACTIVE_STATUSES),
+            )
+            .values(lease_expires_at=_lease_deadline())
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"延長發信工作租約失敗: {e}")
+    finally:
+        db.close()
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(max(1, EMAIL_JOB_LEASE_SECONDS // 3))
+        renew_leases()
+
+
+def _ensure_heartbeat():
+    global _heartbeat
+    with _executor_lock:
+        if _heartbeat is None or not _heartbeat.is_alive():
+            # daemon：程序結束時不等待；關閉期間仍在送的工作也持續延長租約
+            _heartbeat = threading.Thread(target=_heartbeat_loop, name="email-job-lease", daemon=True)
+            _heartbeat.start()
+
+
+def submit_job(job_id: int, gmail_token: Optional[dict]) -> Future:
+    """交給 worker pool 執行"""
+    _ensure_heartbeat()
+    future = _get_executor().submit(run_job, job_id, gmail_token)
+    _futures[job_id] = future
+    future.add_done_callback(lambda _: _futures.pop(job_id, None))
+    return future
+
+
+def run_job(job_id: int, gmail_token: Optional[dict]):
+    """執行發信工作（在 worker thread 中，使用自己的 Session 與 GmailService）"""
+    from app.database import SessionLocal
+    from app.email_log_writer import EmailLogWriter
+    from app.email_retry import sender_credential_key
+    from app.email_sender import ConcurrentSender
+
+    db = SessionLocal()
+    try:
+        # 以條件式 UPDATE 取得工作，避免同一工作被兩個 worker 同時執行
+        claimed = db.execute(
+            update(models.EmailJob)
+            .where(models.EmailJob.id == job_id, models.EmailJob.status == "queued")
+            .values(status="running", started_at=datetime.now(timezone.utc),
+                    worker_id=worker_id(), lease_expires_at=_lease_deadline())
+        ).rowcount
+        db.commit()
+        if not claimed:
+            return
+        job = db.get(models.EmailJob, job_id)
+        # 續送：已有發送記錄的客戶不再發送，進度以既有記錄重新計算
+        done = _processed_clients(db, job)
+        db.commit()
+
+        try:
+            template = db.get(models.EmailTemplate, job.template_id)
+            if template is None:
+                raise ValueError("找不到郵件模板")
+            plan = get_template_plan(template)
+
+            # 每個工作各自建立 sender（及其 GmailService），避免多個工作同時改動共用的憑證
+            sender_key = job.credential_key or sender_credential_key(gmail_token)
+            sender = ConcurrentSender(gmail_token, credential_key=sender_key)
+            writer = EmailLogWriter()
+            try:
+                client_ids = json.loads(job.client_ids)
+                for start in range(0, len(client_ids), CLIENT_FETCH_BATCH):
+                    batch_ids = [i for i in client_ids[start:start + CLIENT_FETCH_BATCH] if i not in done]
+                    if not batch_ids:
+                        continue
+                    clients = db.query(models.Client).filter(models.Client.id.in_(batch_ids)).all()
+                    _send_clients(sender, writer, job_id, template.id, plan, clients, sender_key)
+                    # 已被刪除的客戶視為失敗，讓 sent + failed 最後等於 total
+                    missing = len(batch_ids) - len(clients)
+                    if missing:
+                        writer.add_failed(job_id, missing)
+            finally:
+                sender.close()
+                writer.close()
+
+            job.status = "completed"
+        except Exception as e:
+            logger.error(f"發信工作 {job_id} 失敗: {e}")
+            db.rollback()
+            job.status = "failed"
+            job.error_message = str(e)
+        job.finished_at = datetime.now(timezone.utc)
+        job.lease_expires_at = None
+        db.commit()
+        logger.info(
+            f"發信工作 {job_id} 結束：{job.status}，成功 {job.sent_count} / 失敗 {job.failed_count} / 共 {job.total}"
+        )
+    finally:
+        db.close()
+
+
+def _processed_clients(db: Session, job: models.EmailJob) -> set:
+    """
+    此工作已有 EmailLog 的客戶 ID（成功，或失敗且已交給重試佇列 / 無法重試）。
+    一次查詢載入為 set，之後每位客戶 O(1) 判斷是否略過。
+    """
+    rows = db.query(models.EmailLog.client_id, models.EmailLog.status).filter(
+        models.EmailLog.job_id == job.id
+    ).all()
+    if not rows:
+        return set()
+    job.sent_count = sum(1 for _, status in rows if status == "sent")
+    job.failed_count = len(rows) - job.sent_count
+    logger.info(f"發信工作 {job.id} 續送：略過已處理的 {len(rows)} 位客戶")
+    return {client_id for client_id, _ in rows}
+
+
+def _send_clients(sender, writer, job_id: int, template_id: int, plan: TemplatePlan,
+                  clients: List[models.Client], sender_key: Optional[str]):
+    """並行發送一組客戶的郵件，每個 batch 完成即交給 writer 寫入 EmailLog"""
+    from app.email_retry import retry_entry
+
+    messages = []
+    for client in clients:
+        messages.append(plan.message(client.email, client_variables(client)))
+
+    def record(indexes: List[int], results: List[dict]):
+        for index in indexes:
+            client, message, result = clients[index], messages[index], results[index]
+            retry = None
+            if not result['success'] and result.get('retryable'):
+                retry = retry_entry(job_id, client.id, template_id, sender_key, result.get('error'),
+                                    result.get('retry_at'))
+            writer.add({
+                'job_id': job_id,
+                'client_id': client.id,
+                'client_email': client.email,
+                'template_id': template_id,
+                'subject': message['subject'],
+                'status': 'sent' if result['success'] else 'failed',
+                'error_message': result.get('error'),
+                'sent_at': datetime.now() if result['success'] else None,
+            }, retry)
+
+    sender.send(messages, on_chunk=record)
+
+
+def job_progress(job: models.EmailJob) -> dict:
+    """進度 API / SSE 回傳的內容"""
+    done = job.sent_count + job.failed_count
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "total": job.total,
+        "sent_count": job.sent_count,
+        "failed_count": job.failed_count,
+        "percent": round(done / job.total * 100, 1) if job.total else 100.0,
+        "error_message": job.error_message,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def startup_email_jobs():
+    """啟動時處理先前程序中斷而遺留的工作（租約過期者標記為失敗，可用相同冪等鍵續送）"""
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        recover_orphaned_jobs(db)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"檢查中斷的發信工作時發生錯誤: {e}")
+    finally:
+        db.close()
+
+
+def shutdown_email_jobs():
+    """
+    關閉 worker pool：取消尚未開始的工作並標記為失敗（token 不落地，重啟後無法續送）；
+    執行中的工作會在程序結束前送完。
+    """
+    if _executor is None:
+        return
+    pending = [job_id for job_id, future in list(_futures.items()) if future.cancel()]
+    _executor.shutdown(wait=False, cancel_futures=True)
+    if not pending:
+        return
+
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        db.query(models.EmailJob).filter(
+            models.EmailJob.id.in_(pending), models.EmailJob.status == "queued"
+        ).update({
+            "status": "failed",
+            "error_message": "服務重新啟動，工作已取消",
+            "finished_at": datetime.now(timezone.utc),
+            "lease_expires_at": None,
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    logger.info(f"已取消 {len(pending)} 個排隊中的發信工作")
@@ -0,0 +1,147 @@
+"""
+EmailLog write-behind 寫入
+發送結果先放在記憶體緩衝，每 EMAIL_LOG_FLUSH_ROWS 筆或每 EMAIL_LOG_FLUSH_MS 毫秒批次寫入一次：
+- EmailLog 以一次 executemany INSERT 寫入；(job_id, client_id) 已有記錄的列略過（續送 / 重複執行時不重複記錄）
+- 可重試的失敗同時寫入 email_retries 重試佇列（見 app.email_retry）
+- EmailJob 的 sent_count / failed_count 以 SQL 累加（不覆蓋其他寫入者的進度）
+程序中斷時最多只會遺失一個 flush 週期內的記錄。
+"""
+from collections import defaultdict
+from sqlalchemy import insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import List, Optional, Tuple
+import os
+import threading
+import logging
+
+from app import models
+
+logger = logging.getLogger(__name__)
+
+EMAIL_LOG_FLUSH_ROWS = int(os.getenv("EMAIL_LOG_FLUSH_ROWS", "100"))
+EMAIL_LOG_FLUSH_MS = int(os.getenv("EMAIL_LOG_FLUSH_MS", "500"))
+
+
+class EmailLogWriter:
+    """一個發信工作使用一個 writer；add() 可由多個 thread 同時呼叫"""
+
+    def __init__(self, flush_rows: int = EMAIL_LOG_FLUSH_ROWS, flush_ms: int = EMAIL_LOG_FLUSH_MS):
+        self.flush_rows = max(1, flush_rows)
+        self.flush_ms = max(1, flush_ms)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同時只有一個 flush，保持寫入順序
+        self._buffer: List[Tuple[dict, Optional[dict]]] = []
+        self._extra_failed = defaultdict(int)  # job id → 不產生 EmailLog 的失敗數（客戶已刪除）
+        self._stop = threading.Event()
+        self.rows_written = 0
+        self.flushes = 0
+        self._thread = threading.Thread(target=self._run, name="email-log-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, log: dict, retry: Optional[dict] = None):
+        """
+        加入一筆 EmailLog 欄位；retry 不為 None 時同時排入重試佇列
+        （欄位同 EmailRetry，email_log_id 於寫入時補上）
+        """
+        with self._lock:
+            self._buffer.append((log, retry))
+            full = len(self._buffer) >= self.flush_rows
+        if full:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"EmailLog 批次寫入失敗，稍後重試: {e}")
+
+    def add_failed(self, job_id: int, count: int):
+        with self._lock:
+            self._extra_failed[job_id] += count
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                items, self._buffer = self._buffer, []
+                extra_failed, self._extra_failed = self._extra_failed, defaultdict(int)
+            if not items and not extra_failed:
+                return
+            try:
+                self._write(items, extra_failed)
+            except Exception:
+                # 寫入失敗（資料庫暫時無法連線等）：放回緩衝，下次 flush 再試
+                with self._lock:
+                    self._buffer[:0] = items
+                    for job_id, count in extra_failed.items():
+                        self._extra_failed[job_id] += count
+                raise
+
+    def _write(self, items: List[Tuple[dict, Optional[dict]]], extra_failed: dict):
+        from app.database import SessionLocal
+
+        counts = defaultdict(lambda: [0, 0])
+        for job_id, count in extra_failed.items():
+            counts[job_id][1] += count
+
+        db = SessionLocal()
+        try:
+            if items:
+                inserted = _insert_logs(db, [log for log, _ in items])
+                log_ids = {}
+                for log_id, job_id, client_id, status in inserted:
+                    log_ids[(job_id, client_id)] = log_id
+                    if job_id is not None:
+                        counts[job_id][0 if status == "sent" else 1] += 1
+                skipped = len(items) - len(inserted)
+                if skipped:
+                    logger.warning(f"略過 {skipped} 筆已存在的發送記錄（同一工作同一客戶）")
+                retry_rows = [
+                    {**retry, "email_log_id": log_ids[(log.get("job_id"), log["client_id"])]}
+                    for log, retry in items
+                    if retry is not None and (log.get("job_id"), log["client_id"]) in log_ids
+                ]
+                if retry_rows:
+                    db.execute(insert(models.EmailRetry), retry_rows)
+            for job_id, (sent, failed) in counts.items():
+                db.execute(
+                    update(models.EmailJob)
+                    .where(models.EmailJob.id == job_id)
+                    .values(
+                        sent_count=models.EmailJob.sent_count + sent,
+                        failed_count=models.EmailJob.failed_count + failed,
+                    )
+                )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.rows_written += len(items)
+        self.flushes += 1
+
+    def _run(self):
+        while not self._stop.wait(self.flush_ms / 1000):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"EmailLog 批次寫入失敗，稍後重試: {e}")
+
+    def close(self):
+        """停止背景 flush 並寫入剩餘記錄（失敗時拋出例外）"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+def _insert_logs(db, rows: List[dict]) -> list:
+    """
+    批次寫入 EmailLog，違反 (job_id, client_id) 唯一限制的列略過；
+    回傳實際寫入列的 (id, job_id, client_id, status)
+    """
+    Log = models.EmailLog
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(Log).on_conflict_do_nothing(index_elements=["job_id", "client_id"])
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(Log).on_conflict_do_nothing(index_elements=["job_id", "client_id"])
+    else:
+        stmt = insert(Log)
+    return db.execute(stmt.returning(Log.id, Log.job_id, Log.client_id, Log.status), rows).all()
@@ -0,0 +1,217 @@
+"""
+發送失敗重試佇列
+可重試的失敗（429 / 5xx / 連線錯誤，且 ConcurrentSender 內的即時重試已用完）由 EmailLogWriter
+寫入 email_retries；排程每 EMAIL_RETRY_INTERVAL_SECONDS 秒取出到期的項目重新發送：
+- 成功：重試項目標記 sent，原 EmailLog 改為 sent，工作的成功 / 失敗數同步調整
+- 失敗：依指數退避（含 jitter）安排下次重試，超過 EMAIL_RETRY_MAX_ATTEMPTS 次或不可重試時標記 dead
+- 發送者今日配額已用完：不計次數，延到配額重置時間（發信工作中配額用完的收件人也以此方式排入）
+
+Gmail 憑證不寫入資料庫：重試時從記憶體中的 credential_cache 依 credential_key 取回，
+一律以原本的發送者重送，不會改用其他帳號。只有原本就以伺服器端 gmail_token.pickle 發送的項目
+（credential_key 為 file: 開頭）才使用 pickle 憑證。取不到原發送者的憑證（已登出、程序重啟、
+由其他程序發送）時計入重試次數，超過 EMAIL_RETRY_CREDENTIAL_ATTEMPTS 次即標記 dead。
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from typing import Optional
+import os
+import random
+import logging
+
+from app import models
+
+logger = logging.getLogger(__name__)
+
+EMAIL_RETRY_INTERVAL_SECONDS = int(os.getenv("EMAIL_RETRY_INTERVAL_SECONDS", "60"))
+EMAIL_RETRY_MAX_ATTEMPTS = int(os.getenv("EMAIL_RETRY_MAX_ATTEMPTS", "8"))
+# 第 n 次重試前等待 base * 2^n 秒（上限 EMAIL_RETRY_MAX_DELAY_SECONDS），再乘上 0.5 ~ 1 的隨機係數
+EMAIL_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", "60"))
+EMAIL_RETRY_MAX_DELAY_SECONDS = int(os.getenv("EMAIL_RETRY_MAX_DELAY_SECONDS", str(6 * 3600)))
+# 取不到發送者憑證時最多再試幾次（每次依指數退避延後）
+EMAIL_RETRY_CREDENTIAL_ATTEMPTS = int(os.getenv("EMAIL_RETRY_CREDENTIAL_ATTEMPTS", "3"))
+# 每輪最多處理的項目數
+EMAIL_RETRY_BATCH = int(os.getenv("EMAIL_RETRY_BATCH", "200"))
+
+CREDENTIAL_UNAVAILABLE = "無法取得原發送者的 Gmail 憑證（已登出或服務重新啟動）"
+
+
+def next_attempt_at(attempts: int, now: Optional[datetime] = None) -> datetime:
+    """已失敗 attempts 次後的下次重試時間"""
+    now = now or datetime.now(timezone.utc)
+    delay = min(EMAIL_RETRY_MAX_DELAY_SECONDS, EMAIL_RETRY_BASE_SECONDS * (2 ** attempts))
+    return now + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def retry_entry(job_id: Optional[int], client_id: int, template_id: int,
+                credential_key: Optional[str], error: Optional[str],
+                retry_at: Optional[datetime] = None) -> dict:
+    """EmailLogWriter.add 的 retry 欄位；retry_at 指定第一次重試的時間（例如每日配額重置時）"""
+    return {
+        "job_id": job_id,
+        "client_id": client_id,
+        "template_id": template_id,
+        "credential_key": credential_key,
+        "status": "pending",
+        "attempts": 0,
+        "last_error": error,
+        "next_attempt_at": retry_at or next_attempt_at(0),
+    }
+
+
+def sender_credential_key(gmail_token: Optional[dict]) -> str:
+    """
+    發送者的 credential_key：使用者的 gmail_token，或沒有 token 時的伺服器端 gmail_token.pickle；
+    SMTP / fake transport 不論登入的使用者都由同一個帳號發送，以 transport 名稱表示
+    """
+    from app.credential_cache import credential_key, file_credential_key
+    from app.email_service import GmailService
+    from app.mail_transport import MAIL_TRANSPORT, requires_gmail_auth
+
+    if not requires_gmail_auth():
+        return MAIL_TRANSPORT
+    if gmail_token:
+        return credential_key(gmail_token)
+    return file_credential_key(GmailService().token_path)
+
+
+def _sender_for(credential_key: Optional[str]):
+    """取得原發送者的 sender；原發送者的憑證無法取得時回傳 None（不改用其他帳號）"""
+    from app.credential_cache import credential_cache, file_credential_key
+    from app.email_sender import ConcurrentSender
+    from app.email_service import GmailService
+    from app.mail_transport import requires_gmail_auth
+
+    if not requires_gmail_auth():
+        # SMTP / fake transport 不需要使用者憑證
+        return ConcurrentSender(None, credential_key=credential_key)
+    if credential_key is None or credential_key.startswith("file:"):
+        # 以伺服器端 pickle 發送的項目（舊資料沒有記錄 credential_key，當時也只有 pickle 會留下 None）
+        service = GmailService()
+        if credential_key not in (None, file_credential_key(service.token_path)):
+            return None
+        return ConcurrentSender(None, credential_key=credential_key) if service.is_authenticated() else None
+    token = credential_cache.token_for(credential_key)
+    return ConcurrentSender(token, credential_key=credential_key) if token is not None else None
+
+
+def drain_retry_queue(db: Session) -> dict:
+    """處理一輪到期的重試，回傳各結果的數量"""
+    from app.template_render import get_template_plan, client_variables, UnknownPlaceholderError
+
+    now = datetime.now(timezone.utc)
+    due = (
+        db.query(models.EmailRetry)
+        .filter(models.EmailRetry.status == "pending", models.EmailRetry.next_attempt_at <= now)
+        .order_by(models.EmailRetry.next_attempt_at)
+        .limit(EMAIL_RETRY_BATCH)
+        .all()
+    )
+    summary = {"sent": 0, "rescheduled": 0, "dead": 0, "postponed": 0}
+    if not due:
+        return summary
+
+    clients = {
+        c.id: c for c in db.query(models.Client).filter(
+            models.Client.id.in_({r.client_id for r in due})
+        )
+    }
+    templates = {
+        t.id: t for t in db.query(models.EmailTemplate).filter(
+            models.EmailTemplate.id.in_({r.template_id for r in due})
+        )
+    }
+
+    by_credential = defaultdict(list)
+    for item in due:
+        by_credential[item.credential_key].append(item)
+
+    for credential_key, items in by_credential.items():
+        sender = _sender_for(credential_key)
+        if sender is None:
+            # 原發送者的憑證不在本程序（已登出、程序重啟或由其他程序發送）：計入次數，有限次後放棄
+            for item in items:
+                item.attempts += 1
+                item.last_error = CREDENTIAL_UNAVAILABLE
+                if item.attempts >= EMAIL_RETRY_CREDENTIAL_ATTEMPTS:
+                    _give_up(db, item, CREDENTIAL_UNAVAILABLE)
+                    summary["dead"] += 1
+                else:
+                    item.next_attempt_at = next_attempt_at(item.attempts, now)
+                    summary["postponed"] += 1
+            db.commit()
+            continue
+
+        sendable, messages = [], []
+        for item in items:
+            client, template = clients.get(item.client_id), templates.get(item.template_id)
+            try:
+                if client is None or template is None:
+                    raise ValueError("客戶或模板已刪除")
+                message = get_template_plan(template).message(client.email, client_variables(client))
+            except (ValueError, UnknownPlaceholderError) as e:
+                _give_up(db, item, str(e))
+                summary["dead"] += 1
+                continue
+            sendable.append(item)
+            messages.append(message)
+
+        try:
+            results = sender.send(messages) if messages else []
+        finally:
+            sender.close()
+
+        for item, result in zip(sendable, results):
+            if result["success"]:
+                _mark_sent(db, item)
+                summary["sent"] += 1
+                continue
+            if result.get("quota_exhausted"):
+                # 發送者今日配額已用完：不計次數，換日後再送
+                item.next_attempt_at = result["retry_at"]
+                summary["postponed"] += 1
+                continue
+            item.attempts += 1
+            item.last_error = result.get("error")
+            if not result.get("retryable") or item.attempts >= EMAIL_RETRY_MAX_ATTEMPTS:
+                _give_up(db, item, item.last_error)
+                summary["dead"] += 1
+            else:
+                item.next_attempt_at = next_attempt_at(item.attempts, now)
+                summary["rescheduled"] += 1
+        db.commit()
+
+    db.commit()
+    return summary
+
+
+def _mark_sent(db: Session, item: models.EmailRetry):
+    item.status = "sent"
+    item.last_error = None
+    db.execute(
+        update(models.EmailLog)
+        .where(models.EmailLog.id == item.email_log_id)
+        .values(status="sent", error_message=None, sent_at=datetime.now())
+    )
+    if item.job_id is not None:
+        db.execute(
+            update(models.EmailJob)
+            .where(models.EmailJob.id == item.job_id)
+            .values(
+                sent_count=models.EmailJob.sent_count + 1,
+                failed_count=models.EmailJob.failed_count - 1,
+            )
+        )
+
+
+def _give_up(db: Session, item: models.EmailRetry, error: Optional[str]):
+    item.status = "dead"
+    item.last_error = error
+    db.execute(
+        update(models.EmailLog)
+        .where(models.EmailLog.id == item.email_log_id)
+        .values(error_message=f"{error}（已重試 {item.attempts} 次，放棄）")
+    )
+    logger.warning(f"郵件重試放棄：email_log {item.email_log_id}，{error}")
+
@@ -0,0 +1,158 @@
+"""
+並行發信：多個 thread 同時送出 Gmail batch 請求，受速率限制約束
+- GMAIL_SEND_RATE：每秒郵件數（令牌桶），GMAIL_SEND_BURST：允許的突發量。
+  令牌桶在每個程序內，uvicorn --workers N 時以 WEB_CONCURRENCY（N）平分，所有程序合計不超過設定值
+- GMAIL_DAILY_QUOTA：每位發送者（Gmail 帳號）的每日發送上限，用量存在資料庫由所有程序共用，重啟後不歸零
+  （見 app.send_quota）；用完時不在發送 thread 中等待，剩下的郵件以 quota_exhausted 結果回傳，
+  由呼叫端排入重試佇列，於換日（retry_at）後再送
+- 429 / 5xx 等可重試錯誤以指數退避 + jitter 重試，最多 GMAIL_SEND_MAX_RETRIES 次；
+  收到速率限制錯誤時暫停令牌桶，讓所有發送者一起退避
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, List, Optional
+import os
+import threading
+import time
+import logging
+
+from app.email_service import GMAIL_BATCH_SIZE
+from app.rate_limit import TokenBucket, DailyQuota, backoff_delay
+from app.send_quota import SharedDailyQuota
+
+logger = logging.getLogger(__name__)
+
+# 預設值依 Gmail 每位使用者的發送限制（messages.send 每次 100 quota units，每秒 250 units）
+GMAIL_SEND_RATE = float(os.getenv("GMAIL_SEND_RATE", "2.5"))
+GMAIL_SEND_BURST = int(os.getenv("GMAIL_SEND_BURST", str(GMAIL_BATCH_SIZE)))
+GMAIL_DAILY_QUOTA = int(os.getenv("GMAIL_DAILY_QUOTA", "2000"))
+GMAIL_SEND_CONCURRENCY = int(os.getenv("GMAIL_SEND_CONCURRENCY", "4"))
+GMAIL_SEND_MAX_RETRIES = int(os.getenv("GMAIL_SEND_MAX_RETRIES", "5"))
+# 同時執行的應用程式程序數（uvicorn 也以此作為 --workers 的預設值）
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+# 同一個 Gmail 帳號的限制由所有發信工作共用；速率平分給每個程序，每日配額存放在資料庫
+send_rate_limiter = TokenBucket(GMAIL_SEND_RATE / WEB_CONCURRENCY, max(1, GMAIL_SEND_BURST // WEB_CONCURRENCY))
+daily_quota = SharedDailyQuota(GMAIL_DAILY_QUOTA)
+
+QUOTA_EXHAUSTED = "已達今日發送配額，將於換日後重送"
+
+
+def quota_exhausted_result(to: str, retry_at: datetime) -> dict:
+    """今日配額已用完而未送出的郵件：可重試，retry_at 為配額重置時間"""
+    return {
+        'success': False,
+        'error': QUOTA_EXHAUSTED,
+        'to': to,
+        'retryable': True,
+        'quota_exhausted': True,
+        'retry_at': retry_at,
+    }
+
+
+class ConcurrentSender:
+    """
+    一個發信工作使用一個 sender：
+    每個 thread 各自開啟一個 transport（見 app.mail_transport；Gmail service 與 SMTP 連線都不是 thread-safe），
+    close() 時歸還，下一個工作可直接重複使用已建立的 service / 連線。
+    """
+
+    def __init__(self, gmail_token: Optional[dict], concurrency: int = GMAIL_SEND_CONCURRENCY,
+                 batch_size: int = GMAIL_BATCH_SIZE,
+                 limiter: Optional[TokenBucket] = None, quota: Optional[DailyQuota] = None,
+                 max_retries: int = GMAIL_SEND_MAX_RETRIES, credential_key: Optional[str] = None):
+        from app.email_retry import sender_credential_key
+
+        self.gmail_token = gmail_token
+        # 每日配額依發送者計算
+        self.credential_key = credential_key or sender_credential_key(gmail_token)
+        self.batch_size = max(1, batch_size)
+        self.limiter = limiter or send_rate_limiter
+        self.quota = quota or daily_quota
+        self.max_retries = max_retries
+        self._local = threading.local()
+        self._services = []
+        self._services_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="email-send")
+
+    def _service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            from app.mail_transport import open_transport
+            # Gmail 沒有 token 時使用伺服器端的 gmail_token.pickle 憑證（send_batch 時才驗證）
+            service = open_transport(self.gmail_token)
+            self._local.service = service
+            with self._services_lock:
+                self._services.append(service)
+        return service
+
+    def send(self, messages: List[dict],
+             on_chunk: Optional[Callable[[List[int], List[dict]], None]] = None) -> List[dict]:
+        """
+        並行發送 messages（{'to', 'subject', 'message_html'}），
+        回傳與 GmailService.send_email 相同格式的結果，順序與 messages 一致。
+        on_chunk(indexes, results) 在每個 batch 有最終結果時呼叫（於發送 thread 中）。
+        """
+        results: List[Optional[dict]] = [None] * len(messages)
+        chunks = [
+            list(range(start, min(start + self.batch_size, len(messages))))
+            for start in range(0, len(messages), self.batch_size)
+        ]
+
+        def run(indexes: List[int]):
+            self._send_chunk(messages, indexes, results)
+            if on_chunk:
+                on_chunk(indexes, results)
+
+        futures = [self._executor.submit(run, indexes) for indexes in chunks]
+        for future in futures:
+            future.result()
+        return results
+
+    def _send_chunk(self, messages: List[dict], indexes: List[int], results: list):
+        pending = indexes
+        for attempt in range(self.max_retries + 1):
+            granted = self.quota.reserve(len(pending), self.credential_key)
+            if granted < len(pending):
+                # 今日配額已用完：不在此等待，剩下的交由重試佇列於換日後再送
+                retry_at = self.quota.reset_at()
+                for index in pending[granted:]:
+                    results[index] = quota_exhausted_result(messages[index]['to'], retry_at)
+                pending = pending[:granted]
+                if not pending:
+                    return
+            self.limiter.acquire(len(pending))
+            try:
+                batch_results = self._service().send_batch(
+                    [messages[i] for i in pending], batch_size=self.batch_size
+                )
+            except Exception as e:
+                # 建立 service 失敗等無法重試的錯誤
+                batch_results = [{'success': False, 'error': str(e), 'to': messages[i]['to']} for i in pending]
+
+            retry = []
+            rate_limited = False
+            for index, result in zip(pending, batch_results):
+                results[index] = result
+                if not result['success'] and result.get('retryable') and attempt < self.max_retries:
+                    retry.append(index)
+                    rate_limited = rate_limited or result.get('rate_limited', False)
+            if not retry:
+                return
+
+            # 未送出的郵件不計入每日配額
+            self.quota.release(len(retry), self.credential_key)
+            delay = backoff_delay(attempt)
+            if rate_limited:
+                self.limiter.pause(delay)
+            logger.warning(
+                f"{len(retry)} 封郵件發送失敗（可重試），{delay:.1f} 秒後進行第 {attempt + 1} 次重試"
+            )
+            time.sleep(delay)
+            pending = retry
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for service in self._services:
+            service.release()
+        self._services.clear()
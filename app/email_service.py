@@ -2,23 +2,82 @@ import os
 import base64
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 import pickle
 from pathlib import Path
 from typing import Optional
 import json
 
+# Google API 相關套件（google-auth、googleapiclient、oauthlib）載入很慢，
+# 統一在實際使用的方法內才 import，避免拖慢應用程式啟動
+
 # Gmail API 權限範圍
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
+# 單次 batch HTTP 請求包含的郵件數（Gmail 建議不超過 50，上限 100）；設為 1 則逐封發送
+GMAIL_BATCH_SIZE = min(int(os.getenv('GMAIL_BATCH_SIZE', '50')), 100)
+
+# 可重試的錯誤：速率限制與伺服器端暫時性錯誤
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+def _failure_result(to: str, error: Exception) -> dict:
+    """
+    失敗結果，附上 HTTP 狀態碼與是否可重試：
+    429 / 5xx / 403 速率限制，以及沒有 HTTP 回應的連線錯誤皆可重試
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        status = int(status)
+        retryable = status in RETRYABLE_STATUS or (
+            status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+        )
+    else:
+        retryable = isinstance(error, (OSError, TimeoutError))
+    return {
+        'success': False,
+        'error': str(error),
+        'to': to,
+        'status_code': status,
+        'retryable': retryable,
+        'rate_limited': status == 429 or (status == 403 and retryable),
+    }
+
+def build_mime(to: str, subject: str, message_html: str,
+               from_email: Optional[str] = None) -> MIMEMultipart:
+    """建立 HTML 郵件的 MIME 訊息（各 transport 共用）"""
+    message = MIMEMultipart('alternative')
+    message['to'] = to
+    message['subject'] = subject
+    if from_email:
+        message['from'] = from_email
+    
+    # 加入 HTML 內容
+    html_part = MIMEText(message_html, 'html', 'utf-8')
+    message.attach(html_part)
+    return message
+
+def message_bytes(to: str, subject: str, message_html: str, from_email: Optional[str] = None,
+                  template_plan=None, linesep: str = '\n', extra_headers=()) -> bytes:
+    """
+    郵件的 MIME bytes：有 template_plan 時使用其預先組好的 MIME 骨架（見 app.template_prepare），
+    否則以 build_mime 建立
+    """
+    if template_plan is not None:
+        return template_plan.mime.build(to, subject, message_html, from_email, linesep, extra_headers)
+    message = build_mime(to, subject, message_html, from_email)
+    for name, value in extra_headers:
+        message[name] = value
+    return message.as_bytes(policy=message.policy.clone(linesep=linesep))
+
 class GmailService:
+    """Gmail API 發信（實作 app.mail_transport 的 transport 介面：send_email / send_batch / release）"""
+
+    name = 'gmail'
+
     def __init__(self):
         self.creds = None
         self.service = None
+        self._pooled = False
         self.token_path = Path('gmail_token.pickle')
         
     def _get_client_config(self):
@@ -43,19 +102,19 @@ class GmailService:
         }
     
     def authenticate(self):
-        """驗證 Gmail API"""
-        # 載入已儲存的憑證
-        if self.token_path.exists():
-            with open(self.token_path, 'rb') as token:
-                self.creds = pickle.load(token)
+        """驗證 Gmail API（憑證由 credential_cache 保留在記憶體並在背景提前更新）"""
+        from google_auth_oauthlib.flow import Flow
+        from app.credential_cache import credential_cache
+        from app.gmail_pool import build_service
+
+        # 載入已儲存的憑證（檔案未變動時不會重新讀取）
+        self.creds = credential_cache.load_file(self.token_path)
         
         # 如果沒有有效憑證，進行登入
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except Exception as e:
-                    print(f"Token 更新失敗: {e}")
+                # 背景更新尚未完成（例如剛啟動），只好同步更新一次
+                if not credential_cache.refresh_now(self.creds):
                     self.creds = None
             
             if not self.creds:
@@ -78,16 +137,15 @@ class GmailService:
                     f"需要 Gmail API 授權。請訪問以下 URL 並授權：\n{auth_url}\n"
                     f"授權後，請使用授權碼呼叫 save_credentials(auth_code) 方法"
                 )
-            
-            # 儲存憑證供下次使用
-            with open(self.token_path, 'wb') as token:
-                pickle.dump(self.creds, token)
         
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        self.service = build_service(self.creds)
         return self.service
     
     def save_credentials(self, auth_code: str):
         """使用授權碼儲存憑證"""
+        from google_auth_oauthlib.flow import Flow
+        from app.credential_cache import credential_cache
+
         client_config = self._get_client_config()
         flow = Flow.from_client_config(
             client_config,
@@ -101,54 +159,46 @@ class GmailService:
         # 儲存憑證
         with open(self.token_path, 'wb') as token:
             pickle.dump(self.creds, token)
+        credential_cache.forget_file(self.token_path)
         
         return True
     
     def is_authenticated(self) -> bool:
-        """檢查是否已認證"""
-        if self.token_path.exists():
-            try:
-                with open(self.token_path, 'rb') as token:
-                    creds = pickle.load(token)
-                    if not creds:
-                        return False
-                    # 如果憑證有效，直接返回 True
-                    if creds.valid:
-                        return True
-                    # 如果憑證過期但有 refresh_token，嘗試刷新
-                    if creds.expired and creds.refresh_token:
-                        try:
-                            creds.refresh(Request())
-                            # 刷新成功後儲存新憑證
-                            with open(self.token_path, 'wb') as token_file:
-                                pickle.dump(creds, token_file)
-                            return True
-                        except Exception as e:
-                            print(f"Token 刷新失敗: {e}")
-                            return False
-                    return False
-            except:
-                return False
-        return False
+        """檢查是否已認證（只看記憶體中的憑證，過期的 token 交由背景更新，不在此同步更新）"""
+        from app.credential_cache import credential_cache
+
+        try:
+            creds = credential_cache.load_file(self.token_path)
+        except Exception:
+            return False
+        return bool(creds) and credential_cache.usable(creds)
     
     def set_credentials_from_token(self, token_dict: dict):
-        """從 token 字典設置憑證"""
+        """從 token 字典設置憑證（service 由連線池借出，用完請呼叫 release()）"""
+        from app.credential_cache import credential_cache
+        from app.gmail_pool import gmail_service_pool
+
+        self.release()
         try:
-            self.creds = Credentials(
-                token=token_dict.get('access_token'),
-                refresh_token=token_dict.get('refresh_token'),
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=os.getenv('GOOGLE_CLIENT_ID'),
-                client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-                scopes=SCOPES
-            )
-            self.service = build('gmail', 'v1', credentials=self.creds)
+            self.creds = credential_cache.get(token_dict)
+            self.service = gmail_service_pool.acquire(token_dict, self.creds)
+            self._pooled = True
         except Exception as e:
             print(f"設置憑證失敗: {e}")
             raise
     
+    def release(self):
+        """把借出的 service 歸還連線池"""
+        if getattr(self, '_pooled', False) and self.service is not None:
+            from app.gmail_pool import gmail_service_pool
+            gmail_service_pool.release(self.service)
+            self.service = None
+        self._pooled = False
+    
     def get_auth_url(self) -> str:
         """取得授權 URL"""
+        from google_auth_oauthlib.flow import Flow
+
         client_config = self._get_client_config()
         flow = Flow.from_client_config(
             client_config,
@@ -165,29 +215,23 @@ class GmailService:
         return auth_url
     
     def create_message(self, to: str, subject: str, message_html: str, 
-                      from_email: Optional[str] = None) -> dict:
+                      from_email: Optional[str] = None, template_plan=None) -> dict:
         """建立郵件訊息"""
-        message = MIMEMultipart('alternative')
-        message['to'] = to
-        message['subject'] = subject
-        if from_email:
-            message['from'] = from_email
-        
-        # 加入 HTML 內容
-        html_part = MIMEText(message_html, 'html', 'utf-8')
-        message.attach(html_part)
+        message = message_bytes(to, subject, message_html, from_email, template_plan)
         
         # 編碼為 base64
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        raw_message = base64.urlsafe_b64encode(message).decode('utf-8')
         return {'raw': raw_message}
     
-    def send_email(self, to: str, subject: str, message_html: str) -> dict:
+    def send_email(self, to: str, subject: str, message_html: str, template_plan=None) -> dict:
         """發送郵件"""
+        from googleapiclient.errors import HttpError
+
         try:
             if not self.service:
                 self.authenticate()
             
-            message = self.create_message(to, subject, message_html)
+            message = self.create_message(to, subject, message_html, template_plan=template_plan)
             sent_message = self.service.users().messages().send(
                 userId='me', body=message
             ).execute()
@@ -198,11 +242,7 @@ class GmailService:
                 'to': to
             }
         except HttpError as error:
-            return {
-                'success': False,
-                'error': str(error),
-                'to': to
-            }
+            return _failure_result(to, error)
         except RuntimeError as error:
             # 需要授權
             return {
@@ -212,19 +252,61 @@ class GmailService:
                 'needs_auth': True
             }
         except Exception as error:
-            return {
-                'success': False,
-                'error': str(error),
-                'to': to
-            }
+            return _failure_result(to, error)
     
+    def send_batch(self, messages: list, batch_size: int = GMAIL_BATCH_SIZE) -> list:
+        """
+        以 batch HTTP 請求發送多封郵件，每 batch_size 封只需一次 HTTP 往返。
+        messages 為 {'to', 'subject', 'message_html'} 列表；
+        回傳與 send_email 相同格式的結果列表，順序與 messages 一致。
+        """
+        if batch_size <= 1:
+            return [self.send_email(**m) for m in messages]
+
+        try:
+            if not self.service:
+                self.authenticate()
+        except Exception as error:
+            failure = {'success': False, 'error': str(error)}
+            if isinstance(error, RuntimeError):
+                failure['needs_auth'] = True
+            return [{**failure, 'to': m['to']} for m in messages]
+
+        results = [None] * len(messages)
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            to = messages[index]['to']
+            if exception is None:
+                results[index] = {'success': True, 'message_id': response['id'], 'to': to}
+            else:
+                results[index] = _failure_result(to, exception)
+
+        for start in range(0, len(messages), batch_size):
+            end = min(start + batch_size, len(messages))
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index in range(start, end):
+                m = messages[index]
+                message = self.create_message(
+                    m['to'], m['subject'], m['message_html'], template_plan=m.get('template_plan')
+                )
+                batch.add(
+                    self.service.users().messages().send(userId='me', body=message),
+                    request_id=str(index)
+                )
+            try:
+                batch.execute()
+            except Exception as error:
+                # 整個 batch 請求失敗（網路錯誤等），尚未取得結果的郵件皆記為失敗
+                for index in range(start, end):
+                    if results[index] is None:
+                        results[index] = _failure_result(messages[index]['to'], error)
+        return results
+
     def render_template(self, template_content: str, variables: dict) -> str:
-        """渲染郵件模板"""
-        content = template_content
-        for key, value in variables.items():
-            placeholder = f"{{{{{key}}}}}"
-            content = content.replace(placeholder, str(value))
-        return content
+        """渲染郵件模板（編譯結果依模板內容快取，每次只需填入變數）"""
+        from app.template_render import compile_source
+        return compile_source(template_content, tuple(sorted(variables))).render(variables)
 
 # 單例模式
 gmail_service = GmailService()
@@ -1,12 +1,19 @@
 """
 臺灣銀行日幣匯率爬蟲模組
 爬取 https://rate.bot.com.tw/xrt?Lang=zh-TW 的日幣現金匯率（本行賣出）
+
+HTTP 由 RateFetcher（httpx.AsyncClient）負責：
+- 連線 keep-alive 重複使用；手動爬取（/api/exchange-rate/fetch）直接在 event loop 上 await，不阻塞其他請求
+- 排程（背景 thread）交給應用程式的 event loop 執行，與手動爬取共用同一個 client
+- 連線錯誤、429 / 5xx 以指數退避重試，最多 EXCHANGE_RATE_MAX_RETRIES 次
+- 帶上次回應的 ETag / Last-Modified 發出條件式請求，304 時沿用上次解析的匯率，不重新下載、解析頁面
 """
-import requests
-from bs4 import BeautifulSoup
 from datetime import datetime, date, timezone, timedelta
 from sqlalchemy.orm import Session
 from sqlalchemy import desc
+from typing import Optional
+import asyncio
+import os
 import logging
 
 # 台北時區 UTC+8
@@ -20,75 +27,244 @@ HEADERS = {
                   "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 }
 
+# 每次請求的逾時秒數、失敗後最多重試次數、退避基準秒數（第 n 次重試前等待 0 ~ base * 2^n 秒）
+EXCHANGE_RATE_TIMEOUT = float(os.getenv("EXCHANGE_RATE_TIMEOUT", "15"))
+EXCHANGE_RATE_MAX_RETRIES = int(os.getenv("EXCHANGE_RATE_MAX_RETRIES", "3"))
+EXCHANGE_RATE_BACKOFF_SECONDS = float(os.getenv("EXCHANGE_RATE_BACKOFF_SECONDS", "1"))
+# 閒置連線保留秒數
+_KEEPALIVE_SECONDS = 60
+# Retry-After 最多等待的秒數
+_MAX_RETRY_AFTER = 60
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
 
-def fetch_jpy_rate() -> dict | None:
+def parse_jpy_rate(html: str) -> Optional[float]:
     """
-    爬取臺灣銀行牌告匯率頁面，取得日幣（JPY）現金匯率-本行賣出。
+    從牌告匯率頁面取出日幣（JPY）現金匯率-本行賣出。
 
     Returns:
-        dict: {"currency": "JPY", "cash_selling": float, "rate_date": date}
-        None: 爬取失敗時
+        float: 匯率
+        None: 頁面中沒有 JPY 列
+    Raises:
+        ValueError: 匯率欄位不是數字
     """
+    # BeautifulSoup / lxml 只在實際爬取時才載入，避免拖慢應用程式啟動
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+
+    # 找到匯率表格中的所有貨幣列
+    rows = soup.select("table.table tbody tr")
+
+    for row in rows:
+        # 每列的貨幣名稱在 td 裡面的 .visible-phone 或 title 屬性
+        currency_cell = row.select_one("td.currency div.visible-phone")
+        if not currency_cell:
+            continue
+
+        currency_text = currency_cell.get_text(strip=True)
+
+        if "JPY" not in currency_text:
+            continue
+
+        # 找到 JPY 列，取得「現金匯率-本行賣出」
+        # 表格欄位順序：幣別, 現金買入, 現金賣出, 即期買入, 即期賣出
+        tds = row.select("td")
+        # 現金賣出在 data-table="本行賣出" 的第一個 td（現金匯率區）
+        cash_selling_td = None
+        for td in tds:
+            data_table = td.get("data-table", "")
+            if "本行賣出" in data_table and "現金" in data_table:
+                cash_selling_td = td
+                break
+
+        if not cash_selling_td:
+            # 備用方案：按位置取第三個 td（index 2 = 現金賣出）
+            if len(tds) >= 3:
+                cash_selling_td = tds[2]
+
+        if cash_selling_td:
+            return float(cash_selling_td.get_text(strip=True))
+
+    return None
+
+
+def _retry_after(response) -> Optional[float]:
+    """Retry-After（秒數格式）；沒有或無法解析時回傳 None"""
+    value = response.headers.get("Retry-After")
     try:
-        resp = requests.get(TARGET_URL, headers=HEADERS, timeout=15)
-        resp.raise_for_status()
-        resp.encoding = "utf-8"
-
-        soup = BeautifulSoup(resp.text, "lxml")
-        
-        # 找到匯率表格中的所有貨幣列
-        rows = soup.select("table.table tbody tr")
-        
-        for row in rows:
-            # 每列的貨幣名稱在 td 裡面的 .visible-phone 或 title 屬性
-            currency_cell = row.select_one("td.currency div.visible-phone")
-            if not currency_cell:
-                continue
-            
-            currency_text = currency_cell.get_text(strip=True)
-            
-            if "JPY" not in currency_text:
-                continue
-            
-            # 找到 JPY 列，取得「現金匯率-本行賣出」
-            # 表格欄位順序：幣別, 現金買入, 現金賣出, 即期買入, 即期賣出
-            tds = row.select("td")
-            # 現金賣出在 data-table="本行賣出" 的第一個 td（現金匯率區）
-            cash_selling_td = None
-            for td in tds:
-                data_table = td.get("data-table", "")
-                if "本行賣出" in data_table and "現金" in data_table:
-                    cash_selling_td = td
-                    break
-            
-            if not cash_selling_td:
-                # 備用方案：按位置取第三個 td（index 2 = 現金賣出）
-                if len(tds) >= 3:
-                    cash_selling_td = tds[2]
-            
-            if cash_selling_td:
-                rate_text = cash_selling_td.get_text(strip=True)
-                rate_value = float(rate_text)
-                
-                logger.info(f"✓ 爬取成功: JPY 現金賣出匯率 = {rate_value}")
+        return min(float(value), _MAX_RETRY_AFTER) if value else None
+    except ValueError:
+        return None
+
+
+class RateFetcher:
+    """
+    匯率頁面的 HTTP client。httpx.AsyncClient 綁定建立它的 event loop，
+    換了 loop（例如沒有啟動應用程式時以 asyncio.run 執行）會重新建立。
+    """
+
+    def __init__(self, url: str = TARGET_URL):
+        self.url = url
+        self._client = None
+        self._lock: Optional[asyncio.Lock] = None  # 同時只發出一個請求，後到的直接拿到條件式請求的結果
+        self._client_loop = None
+        self._app_loop = None  # 應用程式的 event loop，排程 thread 透過它執行
+        # 上次成功回應的驗證資訊與解析結果
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._rate: Optional[float] = None
+        self.requests = 0
+        self.not_modified = 0
+        self.retries = 0
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """應用程式啟動時登記 event loop，排程的同步呼叫改在這個 loop 上共用 client"""
+        self._app_loop = loop
+
+    def _http(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                headers=HEADERS,
+                timeout=EXCHANGE_RATE_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=2, keepalive_expiry=_KEEPALIVE_SECONDS),
+            )
+            self._lock = asyncio.Lock()
+            self._client_loop = loop
+        return self._client
+
+    def _conditional_headers(self) -> dict:
+        if self._rate is None:
+            return {}
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+        return headers
+
+    async def _get(self):
+        """GET 匯率頁面；連線錯誤與 429 / 5xx 退避後重試，重試用完時拋出最後的錯誤"""
+        import httpx
+        from app.rate_limit import backoff_delay
+
+        client = self._http()
+        for attempt in range(EXCHANGE_RATE_MAX_RETRIES + 1):
+            delay = None
+            try:
+                self.requests += 1
+                response = await client.get(self.url, headers=self._conditional_headers())
+                if response.status_code not in _RETRY_STATUS:
+                    return response
+                if attempt == EXCHANGE_RATE_MAX_RETRIES:
+                    response.raise_for_status()
+                delay = _retry_after(response)
+                logger.warning(f"匯率頁面回應 {response.status_code}，稍後重試（第 {attempt + 1} 次）")
+            except httpx.TransportError as e:
+                if attempt == EXCHANGE_RATE_MAX_RETRIES:
+                    raise
+                logger.warning(f"連線匯率頁面失敗，稍後重試（第 {attempt + 1} 次）: {e}")
+            self.retries += 1
+            if delay is None:
+                delay = backoff_delay(attempt, EXCHANGE_RATE_BACKOFF_SECONDS)
+            await asyncio.sleep(delay)
+
+    async def fetch(self) -> Optional[dict]:
+        """
+        爬取臺灣銀行牌告匯率頁面，取得日幣（JPY）現金匯率-本行賣出。
+
+        Returns:
+            dict: {"currency": "JPY", "cash_selling": float, "rate_date": date}
+            None: 爬取失敗時
+        """
+        import httpx
+
+        self._http()
+        async with self._lock:
+            try:
+                response = await self._get()
+                if response.status_code == 304 and self._rate is not None:
+                    self.not_modified += 1
+                    rate_value = self._rate
+                    logger.info(f"✓ 匯率頁面未變更（304），沿用 JPY 現金賣出匯率 = {rate_value}")
+                else:
+                    response.raise_for_status()
+                    response.encoding = "utf-8"
+                    # 解析整頁表格需數十毫秒，移到 thread 避免佔住 event loop
+                    rate_value = await asyncio.to_thread(parse_jpy_rate, response.text)
+                    if rate_value is None:
+                        logger.error("未找到 JPY 匯率資料")
+                        return None
+                    self._etag = response.headers.get("ETag")
+                    self._last_modified = response.headers.get("Last-Modified")
+                    self._rate = rate_value
+                    logger.info(f"✓ 爬取成功: JPY 現金賣出匯率 = {rate_value}")
                 return {
                     "currency": "JPY",
                     "cash_selling": rate_value,
                     "rate_date": datetime.now(TAIPEI_TZ).date(),
                 }
-        
-        logger.error("未找到 JPY 匯率資料")
-        return None
 
-    except requests.RequestException as e:
-        logger.error(f"爬取匯率失敗（網路錯誤）: {e}")
-        return None
-    except (ValueError, IndexError) as e:
-        logger.error(f"解析匯率資料失敗: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"爬取匯率時發生未預期錯誤: {e}")
-        return None
+            except httpx.HTTPError as e:
+                logger.error(f"爬取匯率失敗（網路錯誤）: {e}")
+                return None
+            except (ValueError, IndexError) as e:
+                logger.error(f"解析匯率資料失敗: {e}")
+                return None
+            except Exception as e:
+                logger.error(f"爬取匯率時發生未預期錯誤: {e}")
+                return None
+
+    def fetch_sync(self) -> Optional[dict]:
+        """
+        同步版本（排程 thread 用）：應用程式的 event loop 執行中時交給它處理並等待結果，
+        否則以暫時的 event loop 執行，結束時關閉連線
+        """
+        loop = self._app_loop
+        if loop is not None and loop.is_running():
+            future = asyncio.run_coroutine_threadsafe(self.fetch(), loop)
+            # 每次請求都有逾時，這裡只是避免 loop 關閉時永遠等待
+            budget = (EXCHANGE_RATE_TIMEOUT + _MAX_RETRY_AFTER) * (EXCHANGE_RATE_MAX_RETRIES + 1)
+            return future.result(timeout=budget)
+
+        async def once():
+            try:
+                return await self.fetch()
+            finally:
+                await self.aclose()
+
+        return asyncio.run(once())
+
+    async def aclose(self):
+        client, self._client, self._client_loop = self._client, None, None
+        if client is not None:
+            await client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "retries": self.retries,
+            "etag": self._etag,
+            "last_modified": self._last_modified,
+        }
+
+
+rate_fetcher = RateFetcher()
+
+
+async def fetch_jpy_rate_async() -> Optional[dict]:
+    """爬取日幣匯率（在 event loop 中 await）"""
+    return await rate_fetcher.fetch()
+
+
+def fetch_jpy_rate() -> Optional[dict]:
+    """爬取日幣匯率（同步呼叫，排程用）"""
+    return rate_fetcher.fetch_sync()
 
 
 def _get_period() -> str:
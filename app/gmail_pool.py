@@ -0,0 +1,135 @@
+"""
+Gmail API service 連線池
+build('gmail', 'v1') 每次都要解析（甚至下載）discovery 文件並建立新的 HTTP 連線；
+這裡依憑證（refresh token）保留已建立的 service，借出 / 歸還重複使用：
+- discovery 文件使用 googleapiclient 隨套件附帶的靜態版本，只讀取一次
+- 每個 service 各自有 httplib2 連線（非 thread-safe），同一時間只借給一個使用者，
+  不同 thread / 不同使用者的發信彼此隔離；歸還後連線保持 keep-alive 供下次使用
+- 同一組憑證的 service 共用 credential_cache 中的 Credentials，由背景提前更新 token
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List
+import os
+import threading
+import logging
+
+from app.credential_cache import credential_cache, credential_key
+
+logger = logging.getLogger(__name__)
+
+# 每組憑證保留的閒置 service 數
+GMAIL_POOL_MAX_IDLE = int(os.getenv("GMAIL_POOL_MAX_IDLE", "8"))
+# 最多保留幾組憑證（LRU）
+GMAIL_POOL_MAX_CREDENTIALS = int(os.getenv("GMAIL_POOL_MAX_CREDENTIALS", "32"))
+# 單一 HTTP 請求逾時（秒）
+GMAIL_HTTP_TIMEOUT = int(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+
+
+@lru_cache(maxsize=1)
+def _discovery_document() -> str:
+    """googleapiclient 附帶的 Gmail v1 靜態 discovery 文件（不經網路）"""
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc("gmail", "v1")
+    if document is None:
+        raise RuntimeError("找不到 Gmail v1 靜態 discovery 文件，請更新 google-api-python-client")
+    return document
+
+
+def build_service(credentials):
+    """以靜態 discovery 文件建立 Gmail service（各自擁有 HTTP 連線）"""
+    from googleapiclient.discovery import build_from_document
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+
+    http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT))
+    return build_from_document(_discovery_document(), http=http)
+
+
+class _CredentialEntry:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.idle: List[object] = []
+        self.leased = 0
+
+
+class GmailServicePool:
+    def __init__(self, max_idle: int = GMAIL_POOL_MAX_IDLE,
+                 max_credentials: int = GMAIL_POOL_MAX_CREDENTIALS):
+        self.max_idle = max_idle
+        self.max_credentials = max_credentials
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _CredentialEntry]" = OrderedDict()
+        self._owners: Dict[int, _CredentialEntry] = {}  # id(service) → 借出時的 entry
+        self.builds = 0
+        self.reuses = 0
+
+    def acquire(self, token_dict: dict, credentials=None):
+        """
+        借出一個使用該憑證的 service（用完需 release）。
+        credentials 為呼叫端已由 credential_cache.get(token_dict) 取得的 Credentials，省略時在此取得。
+        """
+        key = credential_key(token_dict)
+        if credentials is None:
+            credentials = credential_cache.get(token_dict)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.credentials is not credentials:
+                # 新憑證，或快取中的 Credentials 已被替換（舊的 service 不再沿用）
+                entry = _CredentialEntry(credentials)
+                self._entries[key] = entry
+                self._evict()
+            else:
+                self._entries.move_to_end(key)
+            entry.leased += 1
+            service = entry.idle.pop() if entry.idle else None
+            if service is not None:
+                self.reuses += 1
+
+        if service is None:
+            service = build_service(credentials)
+            with self._lock:
+                self.builds += 1
+        with self._lock:
+            self._owners[id(service)] = entry
+        return service
+
+    def release(self, service):
+        """歸還 service；超過閒置上限或憑證已被淘汰時直接丟棄"""
+        with self._lock:
+            entry = self._owners.pop(id(service), None)
+            if entry is None:
+                return
+            entry.leased -= 1
+            if entry in self._entries.values() and len(entry.idle) < self.max_idle:
+                entry.idle.append(service)
+
+    @contextmanager
+    def lease(self, token_dict: dict):
+        service = self.acquire(token_dict)
+        try:
+            yield service
+        finally:
+            self.release(service)
+
+    def _evict(self):
+        # 淘汰最久未使用、且沒有借出中 service 的憑證
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_credentials:
+                break
+            if self._entries[key].leased == 0:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "credentials": len(self._entries),
+                "idle": sum(len(e.idle) for e in self._entries.values()),
+                "leased": sum(e.leased for e in self._entries.values()),
+                "builds": self.builds,
+                "reuses": self.reuses,
+            }
+
+
+gmail_service_pool = GmailServicePool()
@@ -0,0 +1,325 @@
+"""
+郵件傳送方式（transport）
+ConcurrentSender 以 open_transport() 取得 transport，介面為：
+- send_email(to, subject, message_html, template_plan=None) -> 結果 dict（success / error / to / retryable ...）
+- send_batch(messages, batch_size) -> 結果列表，順序與 messages 一致
+- release()：歸還借用的連線
+
+MAIL_TRANSPORT 選擇傳送方式：
+- gmail（預設）：Gmail API（GmailService，service 由 gmail_pool 借出）
+- smtp：一般 SMTP 伺服器，連線由 smtp_pool 保留重複使用（keep-alive），不必每封重新連線 / 登入
+- fake：程序內假 transport，不連網，只組出 MIME 並記錄（CI、壓測用）
+
+LocalSmtpSink（需安裝 aiosmtpd）在本機啟動 SMTP 接收端，可在不連外的情況下壓測 smtp transport。
+發送速率與每日配額限制（GMAIL_SEND_RATE、GMAIL_DAILY_QUOTA）對所有 transport 皆適用。
+"""
+from collections import deque
+from email.utils import make_msgid
+from typing import List, Optional
+import os
+import smtplib
+import threading
+import time
+import logging
+
+from app.email_service import GMAIL_BATCH_SIZE, message_bytes
+
+logger = logging.getLogger(__name__)
+
+MAIL_TRANSPORT = os.getenv("MAIL_TRANSPORT", "gmail").lower()
+
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+# starttls / ssl / none
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "starttls").lower()
+SMTP_FROM = os.getenv("SMTP_FROM") or SMTP_USERNAME
+SMTP_TIMEOUT = int(os.getenv("SMTP_TIMEOUT", "30"))
+# 保留的閒置連線數，以及閒置多久後關閉（多數伺服器會主動斷開閒置太久的連線）
+SMTP_POOL_MAX_IDLE = int(os.getenv("SMTP_POOL_MAX_IDLE", "8"))
+SMTP_POOL_IDLE_SECONDS = int(os.getenv("SMTP_POOL_IDLE_SECONDS", "60"))
+
+# fake transport：每次 send_batch 模擬的網路延遲（毫秒）與保留的最近郵件數
+FAKE_MAIL_LATENCY_MS = int(os.getenv("FAKE_MAIL_LATENCY_MS", "0"))
+FAKE_OUTBOX_SIZE = int(os.getenv("FAKE_OUTBOX_SIZE", "1000"))
+
+TRANSPORTS = ("gmail", "smtp", "fake")
+
+
+class MailTransport:
+    """transport 基底類別：子類別實作 send_email，需要時覆寫 send_batch 以減少往返"""
+
+    name = ""
+
+    def send_email(self, to: str, subject: str, message_html: str, template_plan=None) -> dict:
+        raise NotImplementedError
+
+    def send_batch(self, messages: List[dict], batch_size: int = GMAIL_BATCH_SIZE) -> List[dict]:
+        return [self.send_email(**m) for m in messages]
+
+    def release(self):
+        pass
+
+
+def requires_gmail_auth() -> bool:
+    """目前的 transport 是否需要使用者的 Gmail 授權"""
+    return MAIL_TRANSPORT == "gmail"
+
+
+def open_transport(gmail_token: Optional[dict] = None):
+    """
+    依 MAIL_TRANSPORT 建立 transport（用完需 release）。
+    gmail：gmail_token 為 None 時使用伺服器端的 gmail_token.pickle 憑證。
+    """
+    if MAIL_TRANSPORT == "smtp":
+        return SmtpTransport()
+    if MAIL_TRANSPORT == "fake":
+        return FakeTransport()
+    if MAIL_TRANSPORT != "gmail":
+        raise ValueError(f"不支援的 MAIL_TRANSPORT: {MAIL_TRANSPORT}（可用：{', '.join(TRANSPORTS)}）")
+
+    from app.email_service import GmailService
+    service = GmailService()
+    if gmail_token is not None:
+        service.set_credentials_from_token(gmail_token)
+    return service
+
+
+# ---- SMTP ----
+
+def _smtp_failure(to: str, error: Exception) -> dict:
+    """
+    SMTP 失敗結果：4xx 為暫時性錯誤可重試（421 / 450 / 451 多為伺服器限流），
+    連線中斷等沒有回應碼的網路錯誤也可重試
+    """
+    code = None
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        code = next(iter(error.recipients.values()), (None,))[0]
+    elif isinstance(error, smtplib.SMTPResponseException):
+        code = error.smtp_code
+    if code is not None:
+        retryable = 400 <= code < 500
+    else:
+        retryable = isinstance(error, (smtplib.SMTPServerDisconnected, OSError, TimeoutError))
+    return {
+        'success': False,
+        'error': str(error),
+        'to': to,
+        'status_code': code,
+        'retryable': retryable,
+        'rate_limited': code in (421, 450, 451),
+    }
+
+
+class SmtpConnectionPool:
+    """SMTP 連線池：連線 / TLS / 登入只在建立時做一次，歸還後保留給下一個發送者"""
+
+    def __init__(self, max_idle: int = SMTP_POOL_MAX_IDLE, idle_seconds: int = SMTP_POOL_IDLE_SECONDS):
+        self.max_idle = max_idle
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._idle = []  # (最後使用時間, 連線)
+        self.connects = 0
+        self.reuses = 0
+
+    def connect(self) -> smtplib.SMTP:
+        if SMTP_SECURITY == "ssl":
+            conn = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        else:
+            conn = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                conn.starttls()
+        if SMTP_USERNAME:
+            conn.login(SMTP_USERNAME, SMTP_PASSWORD or "")
+        with self._lock:
+            self.connects += 1
+        return conn
+
+    def acquire(self) -> smtplib.SMTP:
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                last_used, candidate = self._idle.pop()
+                if now - last_used < self.idle_seconds:
+                    conn = candidate
+                    self.reuses += 1
+                    break
+                stale.append(candidate)
+        for old in stale:
+            _quit(old)
+        return conn or self.connect()
+
+    def release(self, conn: smtplib.SMTP):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((time.monotonic(), conn))
+                return
+        _quit(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, conn in idle:
+            _quit(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"idle": len(self._idle), "connects": self.connects, "reuses": self.reuses}
+
+
+def _quit(conn: smtplib.SMTP):
+    try:
+        conn.quit()
+    except Exception:
+        conn.close()
+
+
+smtp_pool = SmtpConnectionPool()
+
+
+class SmtpTransport(MailTransport):
+    """一般 SMTP 伺服器；同一個 transport 的郵件沿用同一條連線依序送出"""
+
+    name = "smtp"
+
+    def __init__(self, pool: Optional[SmtpConnectionPool] = None, from_email: Optional[str] = SMTP_FROM):
+        self.pool = pool or smtp_pool
+        self.from_email = from_email
+        self._conn: Optional[smtplib.SMTP] = None
+
+    def send_email(self, to: str, subject: str, message_html: str, template_plan=None) -> dict:
+        message_id = make_msgid()
+        raw = message_bytes(to, subject, message_html, self.from_email, template_plan,
+                            linesep='\r\n', extra_headers=[('Message-ID', message_id)])
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = self.pool.acquire()
+                self._conn.sendmail(self.from_email or '', [to], raw)
+                return {'success': True, 'message_id': message_id, 'to': to}
+            except smtplib.SMTPServerDisconnected as error:
+                # 閒置連線已被伺服器關閉：丟棄並重新連線一次
+                self._conn = None
+                if attempt:
+                    return _smtp_failure(to, error)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as error:
+                return _smtp_failure(to, error)
+            except Exception as error:
+                # 連線狀態不明，不再沿用
+                self._discard()
+                return _smtp_failure(to, error)
+
+    def _discard(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def release(self):
+        if self._conn is not None:
+            self.pool.release(self._conn)
+            self._conn = None
+
+
+# ---- 程序內假 transport ----
+
+class FakeOutbox:
+    """fake transport 的收件匣：保留最近 FAKE_OUTBOX_SIZE 封的摘要與總數"""
+
+    def __init__(self, size: int = FAKE_OUTBOX_SIZE):
+        self._lock = threading.Lock()
+        self.messages = deque(maxlen=size)
+        self.total = 0
+        self.total_bytes = 0
+
+    def add(self, to: str, subject: str, size: int):
+        with self._lock:
+            self.messages.append({"to": to, "subject": subject, "size": size})
+            self.total += 1
+            self.total_bytes += size
+
+    def clear(self):
+        with self._lock:
+            self.messages.clear()
+            self.total = 0
+            self.total_bytes = 0
+
+
+fake_outbox = FakeOutbox()
+
+
+class FakeTransport(MailTransport):
+    """
+    不連網的 transport：組出完整 MIME 後記錄到 fake_outbox。
+    收件人網域為 fail.invalid 時回傳不可重試的失敗，retry.invalid 回傳可重試的 503，方便測試錯誤路徑。
+    """
+
+    name = "fake"
+
+    def __init__(self, outbox: Optional[FakeOutbox] = None, latency_ms: int = FAKE_MAIL_LATENCY_MS):
+        self.outbox = outbox or fake_outbox
+        self.latency_ms = latency_ms
+
+    def send_email(self, to: str, subject: str, message_html: str, template_plan=None) -> dict:
+        return self.send_batch([{'to': to, 'subject': subject, 'message_html': message_html,
+                                 'template_plan': template_plan}])[0]
+
+    def send_batch(self, messages: List[dict], batch_size: int = GMAIL_BATCH_SIZE) -> List[dict]:
+        if self.latency_ms:
+            # 每個 batch 模擬一次網路往返
+            batches = max(1, -(-len(messages) // max(1, batch_size)))
+            time.sleep(self.latency_ms * batches / 1000)
+        results = []
+        for m in messages:
+            domain = m['to'].rsplit('@', 1)[-1].lower()
+            if domain == 'fail.invalid':
+                results.append({'success': False, 'error': '550 mailbox unavailable', 'to': m['to'],
+                                'status_code': 550, 'retryable': False, 'rate_limited': False})
+                continue
+            if domain == 'retry.invalid':
+                results.append({'success': False, 'error': '503 service unavailable', 'to': m['to'],
+                                'status_code': 503, 'retryable': True, 'rate_limited': False})
+                continue
+            raw = message_bytes(m['to'], m['subject'], m['message_html'], template_plan=m.get('template_plan'))
+            self.outbox.add(m['to'], m['subject'], len(raw))
+            results.append({'success': True, 'message_id': f"fake-{self.outbox.total}", 'to': m['to']})
+        return results
+
+
+class LocalSmtpSink:
+    """
+    本機 SMTP 接收端（aiosmtpd），只計數不轉寄；搭配 MAIL_TRANSPORT=smtp、SMTP_SECURITY=none 壓測 SMTP 路徑。
+    aiosmtpd 不在 requirements 內，僅開發 / 壓測時安裝。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8025):
+        self.host = host
+        self.port = port
+        self.received = 0
+        self.received_bytes = 0
+        self._controller = None
+
+    def start(self):
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError as e:
+            raise RuntimeError("LocalSmtpSink 需要 aiosmtpd：pip install aiosmtpd") from e
+
+        sink = self
+
+        class _Handler:
+            async def handle_DATA(self, server, session, envelope):
+                sink.received += len(envelope.rcpt_tos)
+                sink.received_bytes += len(envelope.content)
+                return "250 OK"
+
+        self._controller = Controller(_Handler(), hostname=self.host, port=self.port)
+        self._controller.start()
+        return self
+
+    def stop(self):
+        if self._controller is not None:
+            self._controller.stop()
+            self._controller = None
@@ -5,13 +5,23 @@ from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from sqlalchemy.orm import Session
-from app.database import get_db, engine, Base
-from app.routers import clients, emails, exchange_rate as exchange_rate_router
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, get_async_read_db
+from app.sql_metrics import QueryCountMiddleware
+from app.routers import clients, emails, exchange_rate as exchange_rate_router, internal
 from app import crud, auth
 from app.auth import oauth, require_login
+from app.scheduler import start_scheduler, shutdown_scheduler
+from app.email_jobs import startup_email_jobs, shutdown_email_jobs
+from app.credential_cache import credential_cache
+from app.mail_transport import smtp_pool
+from app.exchange_rate import rate_fetcher
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
 import sys
+import time
 
 # 配置日志 - 确保输出到 stdout 以便在 Zeabur 中显示
 logging.basicConfig(
@@ -25,9 +35,25 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-Base.metadata.create_all(bind=engine)
+# 資料表與索引由遷移建立（python -m app.migrations），不在啟動時檢查 schema
 
-app = FastAPI(title="CRM 專案管理系統")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """啟動 / 關閉時的副作用（排程器等）集中在這裡，import app.main 本身不做任何 I/O"""
+    started = time.perf_counter()
+    # 排程的匯率爬取交給這個 event loop 執行，與手動爬取共用 keep-alive 連線
+    rate_fetcher.bind_loop(asyncio.get_running_loop())
+    scheduler = start_scheduler()
+    startup_email_jobs()
+    logger.info(f"✓ 應用程式啟動完成（lifespan {(time.perf_counter() - started) * 1000:.0f} ms）")
+    yield
+    shutdown_scheduler(scheduler)
+    shutdown_email_jobs()
+    credential_cache.stop()
+    smtp_pool.close_all()
+    await rate_fetcher.aclose()
+
+app = FastAPI(title="CRM 專案管理系統", lifespan=lifespan)
 
 # 信任 proxy headers（Zeabur 在 proxy 後面）
 app.add_middleware(
@@ -46,6 +72,9 @@ app.add_middleware(
     path="/"           # 整個網站可用
 )
 
+# 每個 request 的 SQL 查詢數 / DB 耗時（Server-Timing header）與 N+1 警告
+app.add_middleware(QueryCountMiddleware)
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
@@ -67,6 +96,7 @@ templates.env.filters["to_taipei"] = _to_taipei
 app.include_router(clients.router)
 app.include_router(emails.router)
 app.include_router(exchange_rate_router.router)
+app.include_router(internal.router)
 
 def get_redirect_uri(request: Request, callback_name: str, env_var: str = None) -> str:
     """
@@ -189,8 +219,11 @@ async def gmail_auth_callback(request: Request):
             'access_token': token.get('access_token'),
             'refresh_token': token.get('refresh_token'),
             'token_type': token.get('token_type'),
-            'expires_in': token.get('expires_in')
+            'expires_in': token.get('expires_in'),
+            'expires_at': token.get('expires_at')
         }
+        # 放進記憶體快取，之後由背景在到期前更新
+        credential_cache.get(request.session['gmail_token'])
         
         logger.info("✓ Gmail API 授權成功")
         
@@ -211,19 +244,36 @@ async def root(request: Request):
         return redirect
     return RedirectResponse(url="/dashboard")
 
+def _load_dashboard(db: Session, search: str = None, cursor: str = None):
+    """Dashboard 所需的資料（同步 Session 介面，透過 run_sync 在 async 路由中執行）"""
+    from app.exchange_rate import get_latest_jpy_rate
+
+    if search:
+        # 搜尋結果依相關度排序，只顯示最相關的前 100 筆
+        clients_list = crud.get_clients(db, search=search)
+        next_cursor = cursor = None
+    else:
+        try:
+            clients_list, next_cursor = crud.get_clients_page(db, cursor=cursor)
+        except ValueError:
+            # 游標無效（例如被手動修改），回到第一頁
+            cursor = None
+            clients_list, next_cursor = crud.get_clients_page(db)
+    stats = crud.get_statistics(db)
+    # 取得最新日幣匯率
+    jpy_rate = get_latest_jpy_rate(db)
+    return clients_list, cursor, next_cursor, stats, jpy_rate
+
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, search: str = None, db: Session = Depends(get_db)):
+async def dashboard(request: Request, search: str = None, cursor: str = None, db: AsyncSession = Depends(get_async_read_db)):
     redirect = require_login(request)
     if redirect:
         return redirect
-    clients_list = crud.get_clients(db, search=search)
-    stats = crud.get_statistics(db)
+    clients_list, cursor, next_cursor, stats, jpy_rate = await db.run_sync(
+        _load_dashboard, search, cursor
+    )
     user = request.session.get('user', {})
 
-    # 取得最新日幣匯率
-    from app.exchange_rate import get_latest_jpy_rate
-    jpy_rate = get_latest_jpy_rate(db)
-
     return templates.TemplateResponse(
         "dashboard.html",
         {
@@ -231,6 +281,8 @@ async def dashboard(request: Request, search: str = None, db: Session = Depends(
             "clients": clients_list,
             "stats": stats,
             "search": search or "",
+            "cursor": cursor,
+            "next_cursor": next_cursor,
             "user": user,
             "jpy_rate": jpy_rate,
         }
@@ -247,11 +299,11 @@ async def new_client_form(request: Request):
     )
 
 @app.get("/client/{client_id}/edit", response_class=HTMLResponse)
-async def edit_client_form(request: Request, client_id: int, db: Session = Depends(get_db)):
+async def edit_client_form(request: Request, client_id: int, db: AsyncSession = Depends(get_async_db)):
     redirect = require_login(request)
     if redirect:
         return redirect
-    client = crud.get_client(db, client_id)
+    client = await db.run_sync(crud.get_client, client_id)
     if not client:
         return RedirectResponse(url="/dashboard")
     return templates.TemplateResponse(
@@ -266,50 +318,6 @@ async def import_page(request: Request):
         return redirect
     return templates.TemplateResponse("import_csv.html", {"request": request})
 
-# === APScheduler: 每天早上 8:00 + 晚上 20:00 自動爬取日幣匯率 ===
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-
-def scheduled_fetch_rate():
-    """排程任務：爬取日幣匯率並存入資料庫"""
-    from app.exchange_rate import fetch_and_save
-    from app.database import SessionLocal
-    db = SessionLocal()
-    try:
-        success = fetch_and_save(db)
-        if success:
-            logger.info("✓ 排程爬取日幣匯率成功")
-        else:
-            logger.error("✗ 排程爬取日幣匯率失敗")
-    except Exception as e:
-        logger.error(f"排程爬取匯率時發生錯誤: {e}")
-    finally:
-        db.close()
-
-scheduler = BackgroundScheduler(daemon=True)
-scheduler.add_job(
-    scheduled_fetch_rate,
-    CronTrigger(hour=8, minute=0, timezone="Asia/Taipei"),
-    id="fetch_jpy_rate_morning",
-    name="每日早上8點爬取日幣匯率",
-    replace_existing=True,
-)
-scheduler.add_job(
-    scheduled_fetch_rate,
-    CronTrigger(hour=20, minute=0, timezone="Asia/Taipei"),
-    id="fetch_jpy_rate_evening",
-    name="每日晚上8點爬取日幣匯率",
-    replace_existing=True,
-)
-scheduler.start()
-logger.info("✓ APScheduler 已啟動：每日 08:00 / 20:00 (Asia/Taipei) 爬取日幣匯率")
-
-@app.on_event("shutdown")
-def shutdown_scheduler():
-    scheduler.shutdown(wait=False)
-    logger.info("✓ APScheduler 已關閉")
-
-
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
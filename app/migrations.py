@@ -0,0 +1,229 @@
+"""
+資料庫 schema 遷移
+依序執行 MIGRATIONS，已套用的版本記錄在 schema_migrations 表，可重複執行。
+PostgreSQL 上的索引以 CREATE INDEX CONCURRENTLY 建立，不會鎖住寫入。
+
+部署時在啟動應用程式之前執行：
+    python -m app.migrations
+"""
+from sqlalchemy import text, inspect
+from sqlalchemy.engine import Engine, Connection
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL advisory lock key，避免多個部署實例同時執行遷移
+_MIGRATION_LOCK_KEY = 7242001
+
+
+def _create_index(engine: Engine, name: str, table: str, columns: str, unique: bool = False):
+    """
+    建立索引（已存在則略過）。
+    PostgreSQL 使用 CONCURRENTLY（必須在 transaction 外執行）；
+    先前中斷而留下的 INVALID 索引會先刪除再重建。
+    """
+    create = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(f"{create} IF NOT EXISTS {name} ON {table} ({columns})"))
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            logger.warning(f"索引 {name} 為 INVALID（先前建立中斷），重新建立")
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        conn.execute(text(f"{create} CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def _drop_index(engine: Engine, name: str):
+    """刪除索引（不存在則略過）；PostgreSQL 使用 CONCURRENTLY"""
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def _add_column(engine: Engine, table: str, column: str, ddl_type: str):
+    """新增欄位（已存在則略過）"""
+    if column in {c["name"] for c in inspect(engine).get_columns(table)}:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def _baseline(engine: Engine):
+    """建立尚不存在的資料表（既有資料庫不會變動已存在的表）"""
+    from app.database import Base
+    from app import models  # noqa: F401 註冊所有 model
+    Base.metadata.create_all(bind=engine)
+
+
+def _search_index(engine: Engine):
+    """客戶搜尋索引（pg_trgm / SQLite FTS5）"""
+    from app.search import ensure_search_index
+    ensure_search_index(engine, strict=True)
+
+
+def _performance_indexes(engine: Engine):
+    """既有資料表補上排序 / 篩選用索引"""
+    if engine.dialect.name == "postgresql":
+        clients_recent = "updated_at DESC NULLS LAST, created_at DESC, id DESC"
+    else:
+        clients_recent = "updated_at DESC, created_at DESC, id DESC"
+    _create_index(engine, "ix_clients_recent", "clients", clients_recent)
+    _create_index(engine, "ix_email_logs_created_at", "email_logs", "created_at")
+    _create_index(engine, "ix_email_logs_client_id", "email_logs", "client_id")
+    _create_index(engine, "ix_exchange_rates_currency_fetched_at", "exchange_rates", "currency, fetched_at")
+
+
+def _email_jobs(engine: Engine):
+    """背景發信工作：email_jobs 表與 email_logs.job_id"""
+    from app import models
+    models.EmailJob.__table__.create(bind=engine, checkfirst=True)
+    _add_column(engine, "email_logs", "job_id", "INTEGER")
+    _create_index(engine, "ix_email_logs_job_id", "email_logs", "job_id")
+
+
+def _email_retries(engine: Engine):
+    """發送失敗的重試佇列"""
+    from app import models
+    models.EmailRetry.__table__.create(bind=engine, checkfirst=True)
+
+
+def _email_log_browse_indexes(engine: Engine):
+    """發送記錄篩選 / 分頁 / 分組統計用索引"""
+    _create_index(engine, "ix_email_logs_client_id_id", "email_logs", "client_id, id")
+    _create_index(engine, "ix_email_logs_template_id_id", "email_logs", "template_id, id")
+    _create_index(engine, "ix_email_logs_status_id", "email_logs", "status, id")
+    _create_index(engine, "ix_email_logs_status_template_id", "email_logs", "status, template_id")
+
+
+def _idempotent_sends(engine: Engine):
+    """發信冪等鍵與 (job_id, client_id) 唯一限制"""
+    _add_column(engine, "email_jobs", "idempotency_key", "VARCHAR(128)")
+    _create_index(engine, "uq_email_jobs_idempotency_key", "email_jobs", "idempotency_key", unique=True)
+    _create_index(engine, "uq_email_logs_job_id_client_id", "email_logs", "job_id, client_id", unique=True)
+
+
+def _email_job_leases(engine: Engine):
+    """發信工作租約：找出執行中程序已中斷的工作"""
+    timestamp = "TIMESTAMP WITH TIME ZONE" if engine.dialect.name == "postgresql" else "DATETIME"
+    _add_column(engine, "email_jobs", "worker_id", "VARCHAR(128)")
+    _add_column(engine, "email_jobs", "lease_expires_at", timestamp)
+    _create_index(engine, "ix_email_jobs_status_lease", "email_jobs", "status, lease_expires_at")
+
+
+def _send_quota(engine: Engine):
+    """跨程序共用的每日發送配額"""
+    from app import models
+    models.SendQuota.__table__.create(bind=engine, checkfirst=True)
+
+
+def _idempotency_key_per_user(engine: Engine):
+    """冪等鍵改為依建立者區分，並記錄發送者憑證識別碼（續送時只能用原發送者的憑證）"""
+    _add_column(engine, "email_jobs", "credential_key", "VARCHAR(64)")
+    _create_index(engine, "uq_email_jobs_created_by_idempotency_key", "email_jobs",
+                  "created_by, idempotency_key", unique=True)
+    _drop_index(engine, "uq_email_jobs_idempotency_key")
+
+
+def _send_quota_per_sender(engine: Engine):
+    """
+    每日發送配額改為依發送者計算：主鍵加入 credential_key。
+    表中只有當天的計數，直接重建；第一次使用時由 EmailLog 重新計算各發送者當天的用量。
+    """
+    from app import models
+    if "credential_key" not in {c["name"] for c in inspect(engine).get_columns("send_quota")}:
+        models.SendQuota.__table__.drop(bind=engine)
+    models.SendQuota.__table__.create(bind=engine, checkfirst=True)
+
+
+# (版本, 說明, 執行函式)；新增遷移請加在最後，已發布的版本不要修改
+MIGRATIONS: List[Tuple[str, str, Callable[[Engine], None]]] = [
+    ("0001", "建立資料表", _baseline),
+    ("0002", "客戶搜尋索引", _search_index),
+    ("0003", "效能索引：clients / email_logs / exchange_rates", _performance_indexes),
+    ("0004", "背景發信工作", _email_jobs),
+    ("0005", "發送失敗重試佇列", _email_retries),
+    ("0006", "發送記錄篩選索引", _email_log_browse_indexes),
+    ("0007", "發信冪等鍵", _idempotent_sends),
+    ("0008", "發信工作租約", _email_job_leases),
+    ("0009", "共用每日發送配額", _send_quota),
+    ("0010", "冪等鍵依使用者區分", _idempotency_key_per_user),
+    ("0011", "每日發送配額依發送者計算", _send_quota_per_sender),
+]
+
+
+def _ensure_version_table(conn: Connection):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version VARCHAR(32) PRIMARY KEY, "
+        "description VARCHAR(255), "
+        "applied_at TIMESTAMP)"
+    ))
+
+
+def applied_versions(engine: Engine) -> set:
+    if not inspect(engine).has_table("schema_migrations"):
+        return set()
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def run_migrations(engine: Engine = None) -> List[str]:
+    """執行尚未套用的遷移，回傳本次套用的版本"""
+    if engine is None:
+        from app.database import engine
+
+    is_postgres = engine.dialect.name == "postgresql"
+    lock_conn = None
+    if is_postgres:
+        lock_conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+
+    try:
+        with engine.begin() as conn:
+            _ensure_version_table(conn)
+        done = applied_versions(engine)
+
+        applied = []
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            logger.info(f"套用遷移 {version}：{description}")
+            migrate(engine)
+            with engine.begin() as conn:
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, description, applied_at) "
+                         "VALUES (:version, :description, :applied_at)"),
+                    {"version": version, "description": description,
+                     "applied_at": datetime.now(timezone.utc)},
+                )
+            applied.append(version)
+        return applied
+    finally:
+        if lock_conn is not None:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+            lock_conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        versions = run_migrations()
+    except Exception as e:
+        logger.error(f"遷移失敗：{e}")
+        sys.exit(1)
+    if versions:
+        logger.info(f"✓ 已套用遷移：{', '.join(versions)}")
+    else:
+        logger.info("✓ 資料庫已是最新版本")
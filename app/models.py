@@ -1,7 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, Float, Date
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Text, Boolean, Float, Date, Index
 from sqlalchemy.sql import func
 from app.database import Base
 
+def _not_postgresql(ddl, target, bind, dialect=None, **kw):
+    """ddl_if 條件：非 PostgreSQL 方言時才建立"""
+    return dialect is not None and dialect.name != "postgresql"
+
 class Client(Base):
     __tablename__ = "clients"
 
@@ -13,6 +17,29 @@ class Client(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    # 列表排序 / keyset 分頁用的複合索引，需與 crud.get_clients 的 ORDER BY 一致。
+    # PostgreSQL 的 DESC 預設 NULLS FIRST，必須明確指定 NULLS LAST；
+    # SQLite 不支援在索引上寫 NULLS LAST，但其 DESC 本來就是 NULL 排最後。
+    __table_args__ = (
+        Index(
+            "ix_clients_recent",
+            updated_at.desc().nullslast(), created_at.desc(), id.desc(),
+        ).ddl_if(dialect="postgresql"),
+        Index(
+            "ix_clients_recent",
+            updated_at.desc(), created_at.desc(), id.desc(),
+        ).ddl_if(callable_=_not_postgresql),
+    )
+
+class ClientStats(Base):
+    """客戶統計 rollup（單列，id 固定為 1），由 crud 在新增/修改/刪除時增量維護"""
+    __tablename__ = "client_stats"
+
+    id = Column(Integer, primary_key=True)
+    total_clients = Column(Integer, nullable=False, default=0)  # 客戶總數
+    total_amount = Column(BigInteger, nullable=False, default=0)  # 專案費用總和
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class EmailTemplate(Base):
     __tablename__ = "email_templates"
 
@@ -25,18 +52,86 @@ class EmailTemplate(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+class EmailJob(Base):
+    """批次發信工作：/api/emails/send 建立後由背景 worker 執行"""
+    __tablename__ = "email_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    template_id = Column(Integer, nullable=False)  # 使用的模板 ID
+    client_ids = Column(Text, nullable=False)  # 收件客戶 ID 列表 (JSON)
+    status = Column(String, nullable=False, default='queued')  # 狀態: queued, running, completed, failed
+    total = Column(Integer, nullable=False, default=0)  # 收件人數
+    sent_count = Column(Integer, nullable=False, default=0)  # 成功數
+    failed_count = Column(Integer, nullable=False, default=0)  # 失敗數
+    error_message = Column(Text, nullable=True)  # 整個工作失敗時的錯誤訊息
+    created_by = Column(String, nullable=True)  # 建立者 email
+    idempotency_key = Column(String(128), nullable=True)  # 用戶端送出的冪等鍵，重送同一鍵不會重複建立工作
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    worker_id = Column(String(128), nullable=True)  # 負責執行的程序（主機:pid:隨機碼）
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)  # 負責程序定期延長；過期表示程序已中斷
+    credential_key = Column(String(64), nullable=True)  # 發送者憑證識別碼（不含 token 本身），續送時需相同
+
+    __table_args__ = (
+        # 冪等鍵只在同一位使用者內唯一：不同使用者送出相同的鍵不會取得彼此的工作
+        Index("uq_email_jobs_created_by_idempotency_key", created_by, idempotency_key, unique=True),
+        Index("ix_email_jobs_status_lease", status, lease_expires_at),
+    )
+
 class EmailLog(Base):
     __tablename__ = "email_logs"
 
     id = Column(Integer, primary_key=True, index=True)
-    client_id = Column(Integer, nullable=False)  # 收件客戶 ID
+    job_id = Column(Integer, nullable=True, index=True)  # 所屬發信工作 ID
+    client_id = Column(Integer, nullable=False, index=True)  # 收件客戶 ID
     client_email = Column(String, nullable=False)  # 收件 email
     template_id = Column(Integer, nullable=True)  # 使用的模板 ID
     subject = Column(String, nullable=False)  # 郵件主旨
     status = Column(String, default='pending')  # 狀態: pending, sent, failed
     error_message = Column(Text, nullable=True)  # 錯誤訊息
     sent_at = Column(DateTime(timezone=True), nullable=True)  # 發送時間
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)  # 發送記錄頁排序鍵
+
+    # 發送記錄頁的篩選 + keyset 分頁（ORDER BY id DESC），以及依狀態 / 模板的分組統計
+    __table_args__ = (
+        # 同一個發信工作（campaign）每位客戶只有一筆記錄：續送時不會重複寫入
+        Index("uq_email_logs_job_id_client_id", job_id, client_id, unique=True),
+        Index("ix_email_logs_client_id_id", client_id, id),
+        Index("ix_email_logs_template_id_id", template_id, id),
+        Index("ix_email_logs_status_id", status, id),
+        Index("ix_email_logs_status_template_id", status, template_id),
+    )
+
+class SendQuota(Base):
+    """每日發送配額用量（所有程序共用），每位發送者依台北時間日期一天一列，見 app.send_quota"""
+    __tablename__ = "send_quota"
+
+    credential_key = Column(String(64), primary_key=True)  # 發送者憑證識別碼（同 email_jobs.credential_key）
+    day = Column(Date, primary_key=True)  # 台北時間日期
+    used = Column(Integer, nullable=False, default=0)  # 已保留的封數
+
+class EmailRetry(Base):
+    """發送失敗（可重試）的郵件，由排程以指數退避重新發送"""
+    __tablename__ = "email_retries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    email_log_id = Column(Integer, nullable=False, index=True)  # 對應的發送記錄，重送成功後更新為 sent
+    job_id = Column(Integer, nullable=True)  # 所屬發信工作 ID
+    client_id = Column(Integer, nullable=False)  # 收件客戶 ID
+    template_id = Column(Integer, nullable=False)  # 使用的模板 ID
+    credential_key = Column(String(64), nullable=True)  # 發送者憑證識別碼（不含 token 本身）
+    status = Column(String, nullable=False, default='pending')  # 狀態: pending, sent, dead
+    attempts = Column(Integer, nullable=False, default=0)  # 已重試次數
+    last_error = Column(Text, nullable=True)  # 最後一次錯誤
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)  # 下次重試時間
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # 排程取出到期的重試：WHERE status = 'pending' AND next_attempt_at <= now
+    __table_args__ = (
+        Index("ix_email_retries_status_next_attempt_at", status, next_attempt_at),
+    )
 
 class ExchangeRate(Base):
     __tablename__ = "exchange_rates"
@@ -47,3 +142,8 @@ class ExchangeRate(Base):
     rate_date = Column(Date, nullable=False, index=True)  # 匯率日期
     period = Column(String, nullable=False, default="morning")  # 時段: morning / evening
     fetched_at = Column(DateTime(timezone=True), server_default=func.now())  # 爬取時間
+
+    # 最新匯率 / 歷史查詢：WHERE currency = ? ORDER BY fetched_at DESC
+    __table_args__ = (
+        Index("ix_exchange_rates_currency_fetched_at", currency, fetched_at),
+    )
@@ -0,0 +1,161 @@
+"""
+資料庫連線池設定與監控
+- 連線池大小、overflow、recycle、pre-ping 由環境變數設定
+- 記錄 checkout 次數、等待時間分布、逾時與失效連線，供 /internal/db-pool 查詢
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import os
+import threading
+import time
+
+# 等待時間直方圖的上界（毫秒），最後一格為 +Inf
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+class PoolMetrics:
+    """單一連線池的累計統計（thread-safe）"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def record_wait(self, elapsed_ms: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total_ms += elapsed_ms
+            self.wait_max_ms = max(self.wait_max_ms, elapsed_ms)
+            for i, bound in enumerate(WAIT_BUCKETS_MS):
+                if elapsed_ms <= bound:
+                    self.wait_buckets[i] += 1
+                    break
+            else:
+                self.wait_buckets[-1] += 1
+
+    def incr(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            # 累計直方圖（與 Prometheus histogram 相同的 le 語意）
+            histogram, running = {}, 0
+            for bound, count in zip(list(WAIT_BUCKETS_MS) + ["+Inf"], self.wait_buckets):
+                running += count
+                histogram[str(bound)] = running
+            total = self.checkouts + self.timeouts
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "wait_avg_ms": round(self.wait_total_ms / total, 3) if total else 0.0,
+                "wait_max_ms": round(self.wait_max_ms, 3),
+                "wait_histogram_ms": histogram,
+            }
+
+
+# engine 名稱 → 統計
+_metrics: dict = {}
+# engine 名稱 → engine（取得即時的連線池狀態）
+_engines: dict = {}
+
+
+def _instrumented(base: type, metrics: PoolMetrics) -> type:
+    """
+    產生會量測 checkout 等待時間的連線池類別。
+    統計放在類別屬性上，engine.dispose() 重建連線池時仍沿用同一份。
+    """
+    class InstrumentedPool(base):
+        _pool_metrics = metrics
+
+        def connect(self):
+            started = time.perf_counter()
+            try:
+                conn = super().connect()
+            except PoolTimeoutError:
+                self._pool_metrics.record_wait((time.perf_counter() - started) * 1000, timed_out=True)
+                raise
+            self._pool_metrics.record_wait((time.perf_counter() - started) * 1000)
+            return conn
+
+    InstrumentedPool.__name__ = f"Instrumented{base.__name__}"
+    return InstrumentedPool
+
+
+def engine_kwargs(url, name: str, is_async: bool = False) -> dict:
+    """
+    依環境變數組出 create_engine / create_async_engine 的連線池參數：
+        DB_POOL_SIZE (5)、DB_MAX_OVERFLOW (10)、DB_POOL_TIMEOUT 秒 (30)、
+        DB_POOL_RECYCLE 秒 (1800，-1 停用)、DB_POOL_PRE_PING (true)
+    SQLite 記憶體資料庫維持 SQLAlchemy 預設的連線池。
+    """
+    sa_url = make_url(url)
+    kwargs = {
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+    }
+    if sa_url.get_backend_name() == "sqlite" and sa_url.database in (None, "", ":memory:"):
+        return kwargs
+
+    metrics = _metrics.setdefault(name, PoolMetrics(name))
+    base = AsyncAdaptedQueuePool if is_async else QueuePool
+    kwargs.update(
+        poolclass=_instrumented(base, metrics),
+        pool_size=_env_int("DB_POOL_SIZE", 5),
+        max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+        pool_timeout=_env_int("DB_POOL_TIMEOUT", 30),
+    )
+    return kwargs
+
+
+def instrument_engine(engine: Engine, name: str):
+    """掛上連線建立 / 失效事件，統計新連線數與 pre-ping 等原因丟棄的連線數"""
+    metrics = _metrics.setdefault(name, PoolMetrics(name))
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "connect", lambda *args: metrics.incr("connects"))
+    event.listen(sync_engine, "invalidate", lambda *args: metrics.incr("invalidations"))
+    _engines[name] = sync_engine
+
+
+def pool_status() -> dict:
+    """所有 engine 的連線池即時狀態與累計統計"""
+    result = {}
+    for name, engine in _engines.items():
+        pool = engine.pool
+        live = {"pool_class": type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            live.update(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=pool.overflow(),
+                max_overflow=pool._max_overflow,
+                timeout=pool.timeout(),
+            )
+        result[name] = {**live, **_metrics.setdefault(name, PoolMetrics(name)).snapshot()}
+    return result
@@ -0,0 +1,124 @@
+"""
+發信速率限制（thread-safe，程序內共用）
+- TokenBucket：每秒可發送的郵件數，允許短暫突發；收到 429 時可暫停所有發送者
+- DailyQuota：每位發送者的每日發送配額（依台北時間換日），用完時不等待，由呼叫端延到換日
+- backoff_delay：指數退避 + full jitter，避免多個發送者同時重試
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_TAIPEI_TZ = timezone(timedelta(hours=8))
+
+
+class TokenBucket:
+    """令牌桶：rate 個 / 秒補充，最多累積 capacity 個"""
+
+    def __init__(self, rate: float, capacity: int,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate 與 capacity 必須大於 0")
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, n: int = 1) -> float:
+        """取得 n 個令牌（不足時等待），回傳等待的秒數"""
+        waited = 0.0
+        while n > 0:
+            # 超過桶容量的請求分段取得
+            want = min(n, self.capacity)
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= want:
+                    self._tokens -= want
+                    n -= want
+                    continue
+                else:
+                    delay = (want - self._tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
+        return waited
+
+    def pause(self, seconds: float):
+        """暫停發放令牌（收到速率限制錯誤時讓所有發送者一起退避）"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+class DailyQuota:
+    """
+    每日配額（台北時間 00:00 重置），依發送者（credential_key）分開計算；limit <= 0 表示不限制。
+    剩餘不足時不等待：reserve 只保留得到的封數，其餘由呼叫端排入重試佇列到 reset_at() 再送。
+    """
+
+    def __init__(self, limit: int,
+                 now: Callable[[], datetime] = lambda: datetime.now(_TAIPEI_TZ)):
+        self.limit = limit
+        self._now = now
+        self._lock = threading.Lock()
+        self._day = None
+        self._used: Dict[Optional[str], int] = {}
+
+    def _roll(self):
+        today = self._now().date()
+        if today != self._day:
+            self._day = today
+            self._used = {}
+
+    def seconds_until_reset(self) -> float:
+        now = self._now()
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), now.tzinfo)
+        return max((tomorrow - now).total_seconds(), 1.0)
+
+    def reset_at(self) -> datetime:
+        """下次重置的時間（UTC）"""
+        return datetime.now(timezone.utc) + timedelta(seconds=self.seconds_until_reset())
+
+    def reserve(self, n: int, key: Optional[str] = None) -> int:
+        """保留最多 n 封的配額，回傳實際保留的封數（今日已用完時為 0，不等待）"""
+        if self.limit <= 0 or n <= 0:
+            return max(n, 0)
+        with self._lock:
+            self._roll()
+            granted = max(0, min(n, self.limit - self._used.get(key, 0)))
+            if granted:
+                self._used[key] = self._used.get(key, 0) + granted
+        if granted < n:
+            logger.warning(f"已達每日發送配額 {self.limit} 封，{n - granted} 封延到換日後發送")
+        return granted
+
+    def release(self, n: int, key: Optional[str] = None):
+        """退回未實際送出的配額（例如被拒絕、稍後重試的郵件）"""
+        with self._lock:
+            self._roll()
+            self._used[key] = max(0, self._used.get(key, 0) - n)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._roll()
+            return {"limit": self.limit, "day": str(self._day), "senders": len(self._used),
+                    "max_used": max(self._used.values(), default=0)}
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """第 attempt 次重試（0 起算）的等待秒數：0 ~ min(cap, base * 2^attempt) 之間隨機"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
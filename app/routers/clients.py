@@ -1,23 +1,54 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from app import crud, schemas
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.auth import get_current_user
+from app.csv_import import import_clients_csv, CSVImportError
+from app.csv_export import iter_clients_csv, iter_clients_ndjson
 from typing import List
-import pandas as pd
-import io
 
 router = APIRouter(prefix="/api/clients", tags=["clients"])
 
 @router.get("/", response_model=List[schemas.Client])
-def read_clients(skip: int = 0, limit: int = 100, search: str = None, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
-    clients = crud.get_clients(db, skip=skip, limit=limit, search=search)
+def read_clients(response: Response, skip: int = 0, limit: int = 100, search: str = None, cursor: str = None, paginate: str = "offset", db: Session = Depends(get_read_db), user: dict = Depends(get_current_user)):
+    """
+    客戶列表。
+    預設為 skip/limit 分頁；帶 cursor 或 paginate=cursor 時改用 keyset 分頁，
+    下一頁游標放在 X-Next-Cursor header（最後一頁則不回傳）。
+    """
+    if not cursor and paginate != "cursor":
+        return crud.get_clients(db, skip=skip, limit=limit, search=search)
+
+    try:
+        clients, next_cursor = crud.get_clients_page(db, limit=limit, search=search, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return clients
 
 @router.get("/statistics")
-def read_statistics(db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+def read_statistics(db: Session = Depends(get_read_db), user: dict = Depends(get_current_user)):
     return crud.get_statistics(db)
 
+@router.get("/export")
+def export_clients(format: str = "csv", user: dict = Depends(get_current_user)):
+    """串流匯出所有客戶（csv 可直接再匯入；ndjson 每行一筆）"""
+    if format == "csv":
+        return StreamingResponse(
+            iter_clients_csv(),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": 'attachment; filename="clients.csv"'},
+        )
+    if format == "ndjson":
+        return StreamingResponse(
+            iter_clients_ndjson(),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": 'attachment; filename="clients.ndjson"'},
+        )
+    raise HTTPException(status_code=400, detail="不支援的匯出格式，請使用 csv 或 ndjson")
+
 @router.get("/{client_id}", response_model=schemas.Client)
 def read_client(client_id: int, db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     db_client = crud.get_client(db, client_id=client_id)
@@ -44,22 +75,17 @@ def delete_client(client_id: int, db: Session = Depends(get_db), user: dict = De
     return {"message": "刪除成功"}
 
 @router.post("/import-csv")
-async def import_csv(file: UploadFile = File(...), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
+def import_csv(file: UploadFile = File(...), db: Session = Depends(get_db), user: dict = Depends(get_current_user)):
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="請上傳 CSV 檔案")
     
-    contents = await file.read()
-    df = pd.read_csv(io.StringIO(contents.decode('utf-8')))
-    
-    imported = 0
-    for _, row in df.iterrows():
-        client = schemas.ClientCreate(
-            client_name=row['客戶名稱'],
-            project_name=row['專案名稱'],
-            email=row['email'],
-            project_cost=int(row['專案費用'])
-        )
-        crud.create_client(db, client)
-        imported += 1
+    # 直接從上傳的暫存檔分段讀取，不把整份檔案載入記憶體
+    try:
+        result = import_clients_csv(db, file.file)
+    except CSVImportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    return {"message": f"成功匯入 {imported} 筆資料"}
+    message = f"成功匯入 {result['imported']} 筆資料"
+    if result["skipped"]:
+        message += f"（略過 {result['skipped']} 筆格式錯誤）"
+    return {"message": message, **result}
@@ -1,172 +1,358 @@
-from fastapi import APIRouter, Depends, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import APIRouter, Depends, Request, HTTPException, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from app.database import get_db
-from app import models, schemas
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, get_async_read_db, AsyncSessionLocal
+from app import models, schemas, email_jobs, crud
 from app.auth import require_login
-from app.email_service import gmail_service
+from app.template_render import get_template_plan, UnknownPlaceholderError
+from app.credential_cache import credential_cache
+from app.mail_transport import requires_gmail_auth
+from app.email_retry import sender_credential_key
 from datetime import datetime
+from typing import Optional
+import asyncio
+import json
+
+# SSE 進度推送的輪詢間隔（秒）
+JOB_EVENTS_POLL_SECONDS = 1.0
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
 
 @router.get("/send-email", response_class=HTMLResponse)
-async def send_email_page(request: Request, db: Session = Depends(get_db)):
+async def send_email_page(request: Request, db: AsyncSession = Depends(get_async_db)):
     """郵件發送頁面"""
     login_check = require_login(request)
     if login_check:
         return login_check
     
-    # 檢查 Gmail API 是否已授權 (檢查 session 中的 gmail_token)
-    is_gmail_auth = 'gmail_token' in request.session and request.session['gmail_token'] is not None
-    
-    # 取得所有客戶
-    clients = db.query(models.Client).all()
+    # 檢查 Gmail API 是否已授權 (檢查 session 中的 gmail_token)；SMTP / fake transport 不需要
+    is_gmail_auth = not requires_gmail_auth() or (
+        'gmail_token' in request.session and request.session['gmail_token'] is not None
+    )
     
-    # 取得所有啟用的模板
-    templates_list = db.query(models.EmailTemplate).filter(
-        models.EmailTemplate.is_active == True
-    ).all()
-    
-    # 轉換為可序列化的字典列表
-    templates_dict = [
-        {
-            "id": t.id,
-            "name": t.name,
-            "subject": t.subject,
-            "content": t.content,
-            "template_type": t.template_type
-        }
-        for t in templates_list
-    ]
+    # 取得所有啟用的模板（不含內容，預覽時再依 id 載入）
+    templates_list = (await db.execute(
+        select(
+            models.EmailTemplate.id,
+            models.EmailTemplate.name,
+            models.EmailTemplate.subject,
+            models.EmailTemplate.template_type,
+        ).where(models.EmailTemplate.is_active == True)
+    )).all()
     
+    # 收件客戶由 /api/emails/recipients 分頁載入，頁面大小不隨客戶數增加
     return templates.TemplateResponse("send_email.html", {
         "request": request,
-        "clients": clients,
-        "templates": templates_dict,
+        "templates": [dict(t._mapping) for t in templates_list],
         "is_gmail_auth": is_gmail_auth
     })
 
-@router.post("/api/emails/send")
+@router.get("/api/emails/recipients")
+async def list_recipients(
+    request: Request,
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    收件客戶選單（keyset 分頁、可搜尋）。
+    第一頁附上符合條件的總數 total，供「全選符合條件」顯示。
+    """
+    login_check = require_login(request)
+    if login_check:
+        raise HTTPException(status_code=401, detail="未登入")
+    
+    search = search.strip() if search else None
+    try:
+        clients, next_cursor = await db.run_sync(
+            lambda session: crud.get_clients_page(session, limit=limit, search=search, cursor=cursor)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    result = {
+        "items": [
+            {"id": c.id, "client_name": c.client_name, "email": c.email, "project_name": c.project_name}
+            for c in clients
+        ],
+        "next_cursor": next_cursor,
+    }
+    if not cursor:
+        result["total"] = await db.run_sync(lambda session: crud.count_clients(session, search))
+    return result
+
+@router.post("/api/emails/send", status_code=202)
 async def send_emails(
     request: Request,
     email_request: schemas.EmailSendRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """發送郵件 API"""
+    """
+    發送郵件 API：建立背景發信工作並立即回傳 job id。
+    帶冪等鍵（body 的 idempotency_key 或 Idempotency-Key header）重送時回傳原本的工作，不重複發信；
+    原工作已中斷則續送尚未處理的客戶。
+    """
     login_check = require_login(request)
     if login_check:
         raise HTTPException(status_code=401, detail="未登入")
     
     # 檢查 Gmail token
     gmail_token = request.session.get('gmail_token')
-    if not gmail_token:
+    if not gmail_token and requires_gmail_auth():
         raise HTTPException(
             status_code=401, 
             detail="Gmail API 未授權，請先完成授權"
         )
     
+    user = request.session.get('user') or {}
+    created_by = user.get('email')
+    idempotency_key = email_request.idempotency_key or request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        if len(idempotency_key) > 128:
+            raise HTTPException(status_code=400, detail="Idempotency-Key 長度不可超過 128")
+        # 冪等鍵依使用者區分，不會取得其他使用者的工作
+        existing = await db.scalar(
+            select(models.EmailJob).where(
+                models.EmailJob.created_by == created_by,
+                models.EmailJob.idempotency_key == idempotency_key,
+            )
+        )
+        if existing:
+            return await _replay_job(db, existing, email_request.template_id, created_by, gmail_token)
+    
     # 取得模板
-    template = db.query(models.EmailTemplate).filter(
-        models.EmailTemplate.id == email_request.template_id
-    ).first()
+    template = await db.get(models.EmailTemplate, email_request.template_id)
     
     if not template:
         raise HTTPException(status_code=404, detail="找不到郵件模板")
     
-    # 取得客戶
-    clients = db.query(models.Client).filter(
-        models.Client.id.in_(email_request.client_ids)
-    ).all()
-    
-    if not clients:
-        raise HTTPException(status_code=404, detail="找不到選擇的客戶")
+    # 模板含未知變數時不發送（否則 {{...}} 會原樣出現在郵件中）
+    try:
+        get_template_plan(template)
+    except UnknownPlaceholderError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # 使用 token 設置 Gmail service
-    gmail_service.set_credentials_from_token(gmail_token)
-    
-    # 發送郵件
-    results = []
-    for client in clients:
-        # 渲染模板
-        variables = {
-            'client_name': client.client_name,
-            'project_name': client.project_name,
-            'project_cost': f"NT$ {client.project_cost:,}",
-        }
-        
-        content = gmail_service.render_template(template.content, variables)
-        subject = gmail_service.render_template(template.subject, variables)
-        
-        # 發送
-        result = gmail_service.send_email(
-            to=client.email,
-            subject=subject,
-            message_html=content
+    client_ids = email_request.client_ids
+    recipient_filter = email_request.recipient_filter
+    if recipient_filter is not None:
+        # 「全選符合條件」：於送出時依搜尋條件解析收件人（含尚未載入到頁面上的客戶）
+        search = recipient_filter.search.strip() if recipient_filter.search else None
+        client_ids = await db.run_sync(
+            lambda session: crud.get_client_ids(session, search, recipient_filter.exclude_ids)
         )
-        
-        # 記錄發送狀態
-        log = models.EmailLog(
-            client_id=client.id,
-            client_email=client.email,
-            template_id=template.id,
-            subject=subject,
-            status='sent' if result['success'] else 'failed',
-            error_message=result.get('error'),
-            sent_at=datetime.now() if result['success'] else None
+        found = len(client_ids)
+    else:
+        # 確認至少有一位客戶存在
+        found = await db.scalar(
+            select(func.count(models.Client.id)).where(models.Client.id.in_(client_ids))
         )
-        db.add(log)
-        results.append({
-            'client_name': client.client_name,
-            'email': client.email,
-            'success': result['success'],
-            'error': result.get('error')
-        })
     
-    db.commit()
+    if not found:
+        raise HTTPException(status_code=404, detail="找不到選擇的客戶")
+    
+    job, created = await db.run_sync(
+        email_jobs.create_job, template.id, client_ids, created_by, idempotency_key,
+        sender_credential_key(gmail_token),
+    )
+    if not created:
+        return await _replay_job(db, job, email_request.template_id, created_by, gmail_token)
+    # 登記到憑證快取：token 快到期時由背景更新，發信時不必等待
+    if gmail_token:
+        credential_cache.get(gmail_token)
+    email_jobs.submit_job(job.id, gmail_token)
     
     return {
-        'message': '郵件發送完成',
-        'results': results,
-        'total': len(results),
-        'success_count': sum(1 for r in results if r['success']),
-        'failed_count': sum(1 for r in results if not r['success'])
+        'message': '郵件已排入發送佇列',
+        'job_id': job.id,
+        'status': job.status,
+        'total': job.total,
     }
 
+async def _replay_job(db: AsyncSession, job: models.EmailJob, template_id: int,
+                      created_by: Optional[str], gmail_token: Optional[dict]):
+    """
+    同一冪等鍵的重送：回傳既有工作；工作已中斷（failed 或租約過期）時續送未處理的客戶。
+    只有原建立者能取得工作，續送時也必須使用原發送者的憑證（不會改由其他信箱寄出）。
+    """
+    if job.created_by != created_by or job.template_id != template_id:
+        raise HTTPException(status_code=409, detail="此冪等鍵已用於其他發信請求")
+    
+    message = '此請求已受理，不會重複發送'
+    resumable = email_jobs.is_resumable(job)
+    if resumable and requires_gmail_auth() and job.credential_key \
+            and job.credential_key != sender_credential_key(gmail_token):
+        raise HTTPException(status_code=409, detail="此工作由其他 Gmail 帳號發送，請以原帳號授權後再續送")
+    if resumable and await db.run_sync(email_jobs.resume_job, job.id):
+        if gmail_token:
+            credential_cache.get(gmail_token)
+        email_jobs.submit_job(job.id, gmail_token)
+        message = '工作已重新排入佇列，已發送的客戶不會重複發送'
+    await db.refresh(job)
+    
+    return {
+        'message': message,
+        'job_id': job.id,
+        'status': job.status,
+        'total': job.total,
+        'duplicate': True,
+    }
+
+@router.get("/api/emails/jobs/{job_id}")
+async def email_job_status(request: Request, job_id: int, db: AsyncSession = Depends(get_async_db)):
+    """發信工作進度"""
+    login_check = require_login(request)
+    if login_check:
+        raise HTTPException(status_code=401, detail="未登入")
+    
+    job = await db.get(models.EmailJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="找不到發信工作")
+    
+    progress = email_jobs.job_progress(job)
+    if job.status in email_jobs.FINISHED_STATUSES:
+        # 工作結束後附上失敗明細
+        failures = (await db.execute(
+            select(models.EmailLog.client_email, models.EmailLog.error_message)
+            .where(models.EmailLog.job_id == job_id, models.EmailLog.status == 'failed')
+            .limit(200)
+        )).all()
+        progress['failures'] = [{'email': f.client_email, 'error': f.error_message} for f in failures]
+    return progress
+
+@router.get("/api/emails/jobs/{job_id}/events")
+async def email_job_events(request: Request, job_id: int):
+    """發信工作進度（Server-Sent Events），進度變動時推送，工作結束後關閉"""
+    login_check = require_login(request)
+    if login_check:
+        raise HTTPException(status_code=401, detail="未登入")
+    
+    async with AsyncSessionLocal() as db:
+        if not await db.get(models.EmailJob, job_id):
+            raise HTTPException(status_code=404, detail="找不到發信工作")
+    
+    async def event_stream():
+        last = None
+        while not await request.is_disconnected():
+            # 每次輪詢使用新的 session，才能讀到 worker 最新 commit 的進度
+            async with AsyncSessionLocal() as db:
+                job = await db.get(models.EmailJob, job_id)
+                progress = email_jobs.job_progress(job) if job is not None else None
+            if job is None:
+                # 串流期間工作已被刪除
+                yield f"event: error\ndata: {json.dumps({'job_id': job_id, 'error': '找不到發信工作'})}\n\n"
+                return
+            if progress != last:
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+                last = progress
+            if job.status in email_jobs.FINISHED_STATUSES:
+                yield f"event: done\ndata: {json.dumps(progress)}\n\n"
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @router.get("/email-logs", response_class=HTMLResponse)
-async def email_logs_page(request: Request, db: Session = Depends(get_db)):
-    """郵件發送記錄頁面"""
+async def email_logs_page(request: Request, db: AsyncSession = Depends(get_async_read_db)):
+    """郵件發送記錄頁面（記錄與統計由 /api/emails/logs 分頁載入）"""
     login_check = require_login(request)
     if login_check:
         return login_check
     
-    logs = db.query(models.EmailLog).order_by(
-        models.EmailLog.created_at.desc()
-    ).limit(100).all()
+    # 篩選用的模板清單（只取 id / 名稱）
+    template_options = (await db.execute(
+        select(models.EmailTemplate.id, models.EmailTemplate.name).order_by(models.EmailTemplate.id)
+    )).all()
     
     return templates.TemplateResponse("email_logs.html", {
         "request": request,
-        "logs": logs
+        "template_options": [{"id": t.id, "name": t.name} for t in template_options]
     })
 
+@router.get("/api/emails/logs")
+async def list_email_logs(
+    request: Request,
+    status: Optional[str] = None,
+    template_id: Optional[int] = None,
+    client_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    counts: Optional[bool] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    郵件發送記錄（新到舊，keyset 分頁）。
+    可依 status / template_id / client_id / 建立時間區間（date_from 含、date_to 不含）篩選；
+    下一頁帶回傳的 next_cursor。counts 預設只在第一頁計算（各狀態 / 模板筆數，單一分組查詢）。
+    """
+    login_check = require_login(request)
+    if login_check:
+        raise HTTPException(status_code=401, detail="未登入")
+    
+    conditions = crud.email_log_filters(
+        db, status=status, template_id=template_id, client_id=client_id,
+        created_from=date_from, created_to=date_to,
+    )
+    try:
+        query = crud.email_logs_page_query(conditions, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    rows = (await db.execute(query)).scalars().all()
+    logs, next_cursor = crud.split_log_page(rows, limit)
+    result = {
+        "items": [schemas.EmailLog.model_validate(log) for log in logs],
+        "next_cursor": next_cursor,
+    }
+    if counts if counts is not None else not cursor:
+        count_rows = (await db.execute(crud.email_log_counts_query(conditions))).all()
+        result["counts"] = crud.summarize_log_counts(count_rows)
+    return result
+
 @router.get("/api/templates")
-async def get_templates(request: Request, db: Session = Depends(get_db)):
+async def get_templates(request: Request, db: AsyncSession = Depends(get_async_db)):
     """取得郵件模板 API"""
-    templates = db.query(models.EmailTemplate).filter(
-        models.EmailTemplate.is_active == True
-    ).all()
+    templates = (await db.execute(
+        select(models.EmailTemplate).where(models.EmailTemplate.is_active == True)
+    )).scalars().all()
     return templates
 
+@router.get("/api/templates/{template_id}")
+async def get_template(request: Request, template_id: int, db: AsyncSession = Depends(get_async_db)):
+    """取得單一郵件模板（含內容，預覽用）"""
+    login_check = require_login(request)
+    if login_check:
+        raise HTTPException(status_code=401, detail="未登入")
+    
+    template = await db.get(models.EmailTemplate, template_id)
+    if not template:
+        raise HTTPException(status_code=404, detail="找不到郵件模板")
+    return {
+        "id": template.id,
+        "name": template.name,
+        "subject": template.subject,
+        "content": template.content,
+        "template_type": template.template_type,
+    }
+
 @router.post("/api/templates/init")
-async def init_templates(request: Request, db: Session = Depends(get_db)):
+async def init_templates(request: Request, db: AsyncSession = Depends(get_async_db)):
     """初始化預設郵件模板"""
     login_check = require_login(request)
     if login_check:
         raise HTTPException(status_code=401, detail="未登入")
     
     # 檢查是否已有模板
-    existing = db.query(models.EmailTemplate).count()
+    existing = await db.scalar(select(func.count(models.EmailTemplate.id)))
     if existing > 0:
         return {"message": "模板已存在", "count": existing}
     
@@ -319,7 +505,7 @@ async def init_templates(request: Request, db: Session = Depends(get_db)):
         template = models.EmailTemplate(**tmpl_data)
         db.add(template)
     
-    db.commit()
+    await db.commit()
     
     return {
         "message": "預設模板已建立",
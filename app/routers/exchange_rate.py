@@ -4,10 +4,10 @@
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, get_async_read_db
 from app.auth import require_login
-from app.exchange_rate import fetch_jpy_rate, save_rate_to_db, get_jpy_rate_history, get_latest_jpy_rate
+from app.exchange_rate import fetch_jpy_rate_async, save_rate_to_db, get_jpy_rate_history, get_latest_jpy_rate
 import logging
 
 logger = logging.getLogger(__name__)
@@ -30,14 +30,14 @@ templates.env.filters["to_taipei"] = _to_taipei
 
 
 @router.get("/exchange-rate", response_class=HTMLResponse)
-async def exchange_rate_page(request: Request, db: Session = Depends(get_db)):
+async def exchange_rate_page(request: Request, db: AsyncSession = Depends(get_async_read_db)):
     """歷史匯率查詢頁面"""
     redirect = require_login(request)
     if redirect:
         return redirect
 
-    history = get_jpy_rate_history(db, limit=180)
-    latest = get_latest_jpy_rate(db)
+    history = await db.run_sync(get_jpy_rate_history, 180)
+    latest = await db.run_sync(get_latest_jpy_rate)
     user = request.session.get("user", {})
 
     # 準備圖表資料（按時間正序）
@@ -58,15 +58,15 @@ async def exchange_rate_page(request: Request, db: Session = Depends(get_db)):
 
 
 @router.post("/api/exchange-rate/fetch")
-async def fetch_rate_api(request: Request, db: Session = Depends(get_db)):
+async def fetch_rate_api(request: Request, db: AsyncSession = Depends(get_async_db)):
     """手動觸發爬取匯率"""
     redirect = require_login(request)
     if redirect:
         return JSONResponse({"error": "未登入"}, status_code=401)
 
-    rate_data = fetch_jpy_rate()
+    rate_data = await fetch_jpy_rate_async()
     if rate_data:
-        save_rate_to_db(db, rate_data)
+        await db.run_sync(save_rate_to_db, rate_data)
         return JSONResponse({
             "success": True,
             "rate": rate_data["cash_selling"],
@@ -0,0 +1,47 @@
+"""
+內部監控路由（連線池狀態等），供維運調整 worker 數與連線池大小
+"""
+from fastapi import APIRouter, Depends
+from app.auth import require_internal_access
+from app.pool_stats import pool_status
+from app.scheduler import leader_status
+
+router = APIRouter(prefix="/internal", tags=["internal"], dependencies=[Depends(require_internal_access)])
+
+
+@router.get("/db-pool")
+def db_pool_stats():
+    """各 engine 的連線池即時狀態（checked out、overflow）與 checkout 等待時間分布"""
+    return pool_status()
+
+
+@router.get("/scheduler")
+def scheduler_status():
+    """本程序是否為排程 leader（多 worker 時只有一個會是 true）"""
+    return leader_status()
+
+
+@router.get("/exchange-rate")
+def exchange_rate_fetcher_status():
+    """匯率爬取的請求數、304（未變更）次數、重試次數與目前的 ETag / Last-Modified"""
+    from app.exchange_rate import rate_fetcher
+    return rate_fetcher.stats()
+
+
+@router.get("/email-sender")
+def email_sender_status():
+    """本程序的發信速率、今日已使用的發送配額、transport、Gmail service / SMTP 連線池與憑證快取"""
+    from app.email_sender import send_rate_limiter, daily_quota, GMAIL_SEND_CONCURRENCY
+    from app.gmail_pool import gmail_service_pool
+    from app.credential_cache import credential_cache
+    from app.mail_transport import MAIL_TRANSPORT, smtp_pool
+    return {
+        "transport": MAIL_TRANSPORT,
+        "rate_per_sec": send_rate_limiter.rate,
+        "burst": send_rate_limiter.capacity,
+        "concurrency": GMAIL_SEND_CONCURRENCY,
+        "daily_quota": daily_quota.snapshot(),
+        "service_pool": gmail_service_pool.stats(),
+        "smtp_pool": smtp_pool.stats(),
+        "credentials": credential_cache.stats(),
+    }
@@ -0,0 +1,263 @@
+"""
+APScheduler 排程：每天早上 8:00 + 晚上 20:00 自動爬取日幣匯率，並定期重送失敗的郵件
+由 app.main 的 lifespan 啟動與關閉（不在 import 時啟動）
+
+多個 worker（uvicorn --workers N / gunicorn）時以 leader election 確保只有一個程序執行排程：
+- PostgreSQL：session 層級的 advisory lock，持有鎖的連線中斷（程序結束）時自動釋放
+- 其他（SQLite 本機開發）：檔案鎖 (flock)，程序結束時由作業系統釋放
+每次排程觸發時各 worker 都會嘗試取得鎖，取得者才執行；原 leader 死掉後下一次排程即自動接手。
+"""
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from typing import Optional
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL advisory lock key（與遷移用的 key 不同）
+SCHEDULER_LOCK_KEY = 7242002
+# 非 PostgreSQL 時使用的鎖檔
+SCHEDULER_LOCK_FILE = os.getenv("SCHEDULER_LOCK_FILE", ".scheduler.lock")
+# leader 心跳 / follower 嘗試接手的間隔（秒）
+LEADER_HEARTBEAT_SECONDS = int(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", "60"))
+
+
+class LeaderElection:
+    """以資料庫 advisory lock 或檔案鎖選出唯一執行排程的程序"""
+
+    def __init__(self, engine: Engine, lock_key: int = SCHEDULER_LOCK_KEY,
+                 lock_file: str = SCHEDULER_LOCK_FILE):
+        self.engine = engine
+        self.lock_key = lock_key
+        self.lock_file = lock_file
+        self._mutex = threading.Lock()
+        self._conn = None  # PostgreSQL：持有 advisory lock 的連線
+        self._fd = None    # 檔案鎖
+        self._use_advisory_lock = engine.dialect.name == "postgresql"
+
+    @property
+    def is_leader(self) -> bool:
+        return self._conn is not None or self._fd is not None
+
+    def ensure_leader(self) -> bool:
+        """確認仍持有鎖；未持有時嘗試取得（不等待）。回傳目前是否為 leader"""
+        with self._mutex:
+            was_leader = self.is_leader
+            if was_leader and self._still_holding():
+                return True
+            acquired = self._try_acquire()
+            if acquired and not was_leader:
+                logger.info(f"✓ 取得排程 leader（pid={os.getpid()}）")
+            elif was_leader and not acquired:
+                logger.warning(f"失去排程 leader（pid={os.getpid()}）")
+            return acquired
+
+    def release(self):
+        with self._mutex:
+            if self._conn is not None:
+                try:
+                    self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.lock_key})
+                except Exception:
+                    pass
+                self._close_conn()
+            if self._fd is not None:
+                self._fd.close()  # 關閉檔案即釋放 flock
+                self._fd = None
+
+    def _still_holding(self) -> bool:
+        if self._conn is None:
+            return self._fd is not None
+        try:
+            # 連線還活著就代表 advisory lock 仍在（鎖跟著 DB session）
+            self._conn.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            logger.warning(f"排程 leader 連線中斷，鎖已失效: {e}")
+            self._close_conn()
+            return False
+
+    def _try_acquire(self) -> bool:
+        if self._use_advisory_lock:
+            conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                acquired = conn.execute(
+                    text("SELECT pg_try_advisory_lock(:key)"), {"key": self.lock_key}
+                ).scalar()
+            except Exception as e:
+                logger.error(f"取得排程 advisory lock 失敗: {e}")
+                acquired = False
+            if acquired:
+                self._conn = conn
+            else:
+                conn.close()
+            return bool(acquired)
+
+        try:
+            import fcntl
+        except ImportError:
+            # 無 fcntl（Windows 本機開發），只會有單一程序，直接視為 leader
+            self._fd = open(self.lock_file, "a")
+            return True
+        fd = open(self.lock_file, "a")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            return False
+        fd.truncate(0)
+        fd.write(str(os.getpid()))
+        fd.flush()
+        self._fd = fd
+        return True
+
+    def _close_conn(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+
+_election: Optional[LeaderElection] = None
+
+
+def leader_status() -> dict:
+    return {
+        "pid": os.getpid(),
+        "is_leader": bool(_election and _election.is_leader),
+        "backend": (
+            None if _election is None
+            else "advisory_lock" if _election._use_advisory_lock else "file_lock"
+        ),
+    }
+
+
+def scheduled_fetch_rate():
+    """排程任務：爬取日幣匯率並存入資料庫（只有 leader 會執行）"""
+    if _election is not None and not _election.ensure_leader():
+        logger.info("非排程 leader，略過本次匯率爬取")
+        return
+
+    from app.exchange_rate import fetch_and_save
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        success = fetch_and_save(db)
+        if success:
+            logger.info("✓ 排程爬取日幣匯率成功")
+        else:
+            logger.error("✗ 排程爬取日幣匯率失敗")
+    except Exception as e:
+        logger.error(f"排程爬取匯率時發生錯誤: {e}")
+    finally:
+        db.close()
+
+
+def scheduled_drain_email_retries():
+    """排程任務：重送到期的失敗郵件（只有 leader 會執行）"""
+    if _election is not None and not _election.ensure_leader():
+        return
+
+    from app.email_retry import drain_retry_queue
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        summary = drain_retry_queue(db)
+        if any(summary.values()):
+            logger.info(f"郵件重試佇列：{summary}")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"處理郵件重試佇列時發生錯誤: {e}")
+    finally:
+        db.close()
+
+
+def scheduled_recover_email_jobs():
+    """排程任務：租約過期（程序已中斷）的發信工作標記為失敗（只有 leader 會執行）"""
+    if _election is not None and not _election.ensure_leader():
+        return
+
+    from app.email_jobs import recover_orphaned_jobs
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        recover_orphaned_jobs(db)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"檢查中斷的發信工作時發生錯誤: {e}")
+    finally:
+        db.close()
+
+
+def _leader_heartbeat():
+    """leader 確認鎖仍有效；follower 嘗試接手已死掉的 leader"""
+    if _election is not None:
+        _election.ensure_leader()
+
+
+def start_scheduler():
+    """建立並啟動排程器，回傳 scheduler 供關閉時使用"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+    from app.database import engine
+    from app.email_retry import EMAIL_RETRY_INTERVAL_SECONDS
+    from app.email_jobs import EMAIL_JOB_LEASE_SECONDS
+
+    global _election
+    _election = LeaderElection(engine)
+    if not _election.ensure_leader():
+        logger.info(f"排程 leader 由其他程序擔任（pid={os.getpid()} 待命）")
+
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        scheduled_fetch_rate,
+        CronTrigger(hour=8, minute=0, timezone="Asia/Taipei"),
+        id="fetch_jpy_rate_morning",
+        name="每日早上8點爬取日幣匯率",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        scheduled_fetch_rate,
+        CronTrigger(hour=20, minute=0, timezone="Asia/Taipei"),
+        id="fetch_jpy_rate_evening",
+        name="每日晚上8點爬取日幣匯率",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        scheduled_drain_email_retries,
+        IntervalTrigger(seconds=EMAIL_RETRY_INTERVAL_SECONDS),
+        id="drain_email_retries",
+        name="重送失敗郵件",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        scheduled_recover_email_jobs,
+        IntervalTrigger(seconds=EMAIL_JOB_LEASE_SECONDS),
+        id="recover_email_jobs",
+        name="標記中斷的發信工作",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        _leader_heartbeat,
+        IntervalTrigger(seconds=LEADER_HEARTBEAT_SECONDS),
+        id="scheduler_leader_heartbeat",
+        name="排程 leader 心跳",
+        replace_existing=True,
+    )
+    scheduler.start()
+    logger.info("✓ APScheduler 已啟動：每日 08:00 / 20:00 (Asia/Taipei) 爬取日幣匯率")
+    return scheduler
+
+
+def shutdown_scheduler(scheduler):
+    scheduler.shutdown(wait=False)
+    if _election is not None:
+        _election.release()
+    logger.info("✓ APScheduler 已關閉")
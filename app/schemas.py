@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
 from typing import Optional
 
@@ -43,9 +43,17 @@ class EmailTemplate(EmailTemplateBase):
     class Config:
         from_attributes = True
 
+class RecipientFilter(BaseModel):
+    """「全選符合條件」：收件人於送出時依搜尋條件在伺服器端解析"""
+    search: Optional[str] = None
+    exclude_ids: list[int] = []
+
 class EmailSendRequest(BaseModel):
-    client_ids: list[int]
+    client_ids: list[int] = []
     template_id: int
+    recipient_filter: Optional[RecipientFilter] = None
+    # 冪等鍵（例如每次送出時產生的 UUID）；同一鍵重送時不會重複發信
+    idempotency_key: Optional[str] = Field(None, max_length=128)
 
 class EmailLogBase(BaseModel):
     client_id: int
@@ -57,6 +65,7 @@ class EmailLogBase(BaseModel):
 
 class EmailLog(EmailLogBase):
     id: int
+    job_id: Optional[int] = None
     sent_at: Optional[datetime] = None
     created_at: datetime
 
@@ -0,0 +1,117 @@
+"""
+客戶搜尋索引模組
+client_name / project_name 的子字串搜尋：
+- PostgreSQL：pg_trgm GIN 索引，ILIKE '%關鍵字%' 可直接走索引，以 similarity() 排序
+- SQLite（本機開發）：FTS5 trigram 虛擬表，由 trigger 與 clients 表保持同步
+"""
+from sqlalchemy import text, inspect, or_, case, func, literal
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from app import models
+import logging
+
+logger = logging.getLogger(__name__)
+
+# trigram 索引至少需要 3 個字元才能切出 trigram，更短的關鍵字只能掃描
+MIN_TRIGRAM_LENGTH = 3
+
+_POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_clients_client_name_trgm "
+    "ON clients USING gin (client_name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_clients_project_name_trgm "
+    "ON clients USING gin (project_name gin_trgm_ops)",
+]
+
+_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5("
+    "client_name, project_name, content='clients', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS clients_fts_ai AFTER INSERT ON clients BEGIN "
+    "INSERT INTO clients_fts(rowid, client_name, project_name) "
+    "VALUES (new.id, new.client_name, new.project_name); END",
+    "CREATE TRIGGER IF NOT EXISTS clients_fts_ad AFTER DELETE ON clients BEGIN "
+    "INSERT INTO clients_fts(clients_fts, rowid, client_name, project_name) "
+    "VALUES ('delete', old.id, old.client_name, old.project_name); END",
+    "CREATE TRIGGER IF NOT EXISTS clients_fts_au AFTER UPDATE OF client_name, project_name ON clients BEGIN "
+    "INSERT INTO clients_fts(clients_fts, rowid, client_name, project_name) "
+    "VALUES ('delete', old.id, old.client_name, old.project_name); "
+    "INSERT INTO clients_fts(rowid, client_name, project_name) "
+    "VALUES (new.id, new.client_name, new.project_name); END",
+]
+
+# 各 engine 是否已有 SQLite FTS 表（避免每次搜尋都查 schema）
+_fts_ready: dict = {}
+
+
+def ensure_search_index(engine: Engine, strict: bool = False):
+    """建立搜尋索引（可重複執行）；strict=True 時失敗會拋出例外（遷移用）"""
+    dialect = engine.dialect.name
+    try:
+        if dialect == "postgresql":
+            with engine.begin() as conn:
+                for ddl in _POSTGRES_DDL:
+                    conn.execute(text(ddl))
+            logger.info("✓ 客戶搜尋 pg_trgm 索引已就緒")
+        elif dialect == "sqlite":
+            existed = inspect(engine).has_table("clients_fts")
+            with engine.begin() as conn:
+                for ddl in _SQLITE_DDL:
+                    conn.execute(text(ddl))
+                if not existed:
+                    # 新建立的 FTS 表需要從既有資料重建一次
+                    conn.execute(text("INSERT INTO clients_fts(clients_fts) VALUES ('rebuild')"))
+            _fts_ready[engine.url] = True
+            logger.info("✓ 客戶搜尋 FTS5 索引已就緒")
+    except Exception as e:
+        if strict:
+            raise
+        # 索引只影響效能，建立失敗時搜尋仍會退回全表掃描
+        logger.error(f"建立客戶搜尋索引失敗: {e}")
+
+
+def _sqlite_fts_ready(db: Session) -> bool:
+    engine = db.get_bind()
+    if engine.url not in _fts_ready:
+        _fts_ready[engine.url] = inspect(engine).has_table("clients_fts")
+    return _fts_ready[engine.url]
+
+
+def _fts_phrase(term: str) -> str:
+    """轉成 FTS5 字串片語，避免關鍵字中的運算子被解析"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def search_filter(db: Session, term: str):
+    """客戶名稱或專案名稱包含關鍵字（不分大小寫）的條件"""
+    Client = models.Client
+    like = or_(
+        Client.client_name.ilike(f"%{term}%"),
+        Client.project_name.ilike(f"%{term}%"),
+    )
+    if (db.get_bind().dialect.name == "sqlite"
+            and len(term) >= MIN_TRIGRAM_LENGTH and _sqlite_fts_ready(db)):
+        matched = text("SELECT rowid FROM clients_fts WHERE clients_fts MATCH :fts_term").bindparams(
+            fts_term=_fts_phrase(term)
+        )
+        return Client.id.in_(matched)
+    # PostgreSQL 的 ILIKE 由 pg_trgm GIN 索引支援
+    return like
+
+
+def search_rank(db: Session, term: str):
+    """搜尋結果排序分數（越大越相關）"""
+    Client = models.Client
+    if db.get_bind().dialect.name == "postgresql":
+        return func.greatest(
+            func.similarity(Client.client_name, term),
+            func.similarity(Client.project_name, term),
+        )
+    # 其他資料庫：完全相符 > 開頭相符 > 包含
+    lowered = literal(term.lower())
+    return case(
+        (or_(func.lower(Client.client_name) == lowered,
+             func.lower(Client.project_name) == lowered), 3),
+        (or_(Client.client_name.ilike(f"{term}%"),
+             Client.project_name.ilike(f"{term}%")), 2),
+        else_=1,
+    )
@@ -0,0 +1,198 @@
+"""
+發信吞吐量壓測：從 EmailSendRequest 到 EmailLog 寫入的完整路徑（封 / 秒）
+
+    python -m app.send_benchmark                          # fake transport，2000 位客戶
+    python -m app.send_benchmark --clients 10000 --latency-ms 80
+    python -m app.send_benchmark --transport smtp --smtp-sink   # 本機 aiosmtpd 接收端（需安裝 aiosmtpd）
+
+流程與 /api/emails/send 相同：驗證 EmailSendRequest → create_job → run_job
+（模板編譯、ConcurrentSender 並行發送、EmailLogWriter 批次寫入），最後確認 EmailLog 筆數。
+預設使用暫存的 SQLite 資料庫；--database-url 請指向專用的測試資料庫。
+壓測寫入的模板、客戶、工作與 EmailLog 結束時（包含失敗時）都會刪除，客戶統計 rollup 一併退回。
+速率 / 每日配額限制預設關閉，以量測程式本身的上限。
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import List, Optional
+
+BENCH_TEMPLATE = """
+<html><body>
+<p>親愛的 <strong>{{client_name}}</strong> 您好，</p>
+<p>關於 <strong>{{project_name}}</strong> 專案，請款金額為 {{project_cost}}。</p>
+</body></html>
+"""
+
+
+def configure(args):
+    """在 import app 模組之前設定環境變數（各模組於 import 時讀取設定）"""
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        path = os.path.join(tempfile.mkdtemp(prefix="send-bench-"), "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["MAIL_TRANSPORT"] = args.transport
+    os.environ["FAKE_MAIL_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["GMAIL_BATCH_SIZE"] = str(args.batch_size)
+    os.environ["GMAIL_SEND_CONCURRENCY"] = str(args.concurrency)
+    if not args.rate_limit:
+        os.environ["GMAIL_SEND_RATE"] = "1000000"
+        os.environ["GMAIL_SEND_BURST"] = "1000000"
+        os.environ["GMAIL_DAILY_QUOTA"] = "0"  # 0 表示不限制，也不讀寫共用配額
+    if args.smtp_sink:
+        os.environ["SMTP_HOST"] = "127.0.0.1"
+        os.environ["SMTP_PORT"] = str(args.sink_port)
+        os.environ["SMTP_SECURITY"] = "none"
+        os.environ.pop("SMTP_USERNAME", None)
+        os.environ.setdefault("SMTP_FROM", "bench@localhost")
+
+
+CLEANUP_CHUNK = 1000
+
+
+def seed(db, count: int):
+    """建立壓測用模板與客戶，回傳 (template_id, client_ids)；id 由資料庫配發（PostgreSQL 的 sequence 保持一致）"""
+    from sqlalchemy import insert
+    from app import crud, models
+
+    template = models.EmailTemplate(
+        name="壓測模板", template_type="invoice",
+        subject="【請款通知】{{project_name}} 專案款項", content=BENCH_TEMPLATE,
+    )
+    db.add(template)
+    db.flush()
+    rows = [
+        {
+            "client_name": f"壓測客戶 {i}",
+            "project_name": f"專案 {i}",
+            "email": f"bench{i}@example.com",
+            "project_cost": 1000 + i,
+        }
+        for i in range(count)
+    ]
+    client_ids = list(db.scalars(
+        insert(models.Client).returning(models.Client.id, sort_by_parameter_order=True), rows
+    ))
+    crud.adjust_stats_rollup(db, count, sum(row["project_cost"] for row in rows))
+    db.commit()
+    return template.id, client_ids
+
+
+def cleanup(db, template_id: Optional[int], client_ids: List[int], job_id: Optional[int]):
+    """刪除 seed 與本次壓測寫入的資料（模板、客戶、工作、EmailLog、重試），並退回統計 rollup"""
+    from sqlalchemy import delete, func, select
+    from app import crud, models
+
+    db.rollback()
+    if job_id is not None:
+        db.execute(delete(models.EmailRetry).where(models.EmailRetry.job_id == job_id))
+        db.execute(delete(models.EmailLog).where(models.EmailLog.job_id == job_id))
+        db.execute(delete(models.EmailJob).where(models.EmailJob.id == job_id))
+    removed = amount = 0
+    for i in range(0, len(client_ids), CLEANUP_CHUNK):
+        chunk = client_ids[i:i + CLEANUP_CHUNK]
+        cond = models.Client.id.in_(chunk)
+        amount += db.scalar(select(func.coalesce(func.sum(models.Client.project_cost), 0)).where(cond))
+        removed += db.execute(delete(models.Client).where(cond)).rowcount
+    crud.adjust_stats_rollup(db, -removed, -amount)
+    if template_id is not None:
+        db.execute(delete(models.EmailTemplate).where(models.EmailTemplate.id == template_id))
+    db.commit()
+
+
+def run(args) -> dict:
+    from app.migrations import run_migrations
+    from app.database import SessionLocal
+    from app import models, schemas, email_jobs
+    from app.email_sender import GMAIL_SEND_CONCURRENCY
+    from app.email_service import GMAIL_BATCH_SIZE
+    from app.mail_transport import fake_outbox, smtp_pool, LocalSmtpSink
+
+    run_migrations()
+    sink = LocalSmtpSink(port=args.sink_port).start() if args.smtp_sink else None
+    db = SessionLocal()
+    template_id, client_ids, job_id = None, [], None
+    try:
+        template_id, client_ids = seed(db, args.clients)
+
+        started = time.perf_counter()
+        request = schemas.EmailSendRequest.model_validate({
+            "template_id": template_id,
+            "client_ids": client_ids,
+            "idempotency_key": f"bench-{time.time_ns()}",
+        })
+        job, _ = email_jobs.create_job(
+            db, request.template_id, request.client_ids, "benchmark", request.idempotency_key
+        )
+        job_id = job.id
+        created = time.perf_counter()
+        email_jobs.run_job(job.id, None)
+        finished = time.perf_counter()
+
+        db.expire_all()
+        job = db.get(models.EmailJob, job.id)
+        status, sent, failed = job.status, job.sent_count, job.failed_count
+        logged = db.query(models.EmailLog).filter(models.EmailLog.job_id == job.id).count()
+    finally:
+        try:
+            cleanup(db, template_id, client_ids, job_id)
+        finally:
+            db.close()
+            smtp_pool.close_all()
+            if sink:
+                sink.stop()
+    elapsed = finished - started
+    result = {
+        "transport": args.transport,
+        "clients": args.clients,
+        "batch_size": GMAIL_BATCH_SIZE,
+        "concurrency": GMAIL_SEND_CONCURRENCY,
+        "status": status,
+        "sent": sent,
+        "failed": failed,
+        "email_logs": logged,
+        "create_job_ms": (created - started) * 1000,
+        "send_and_persist_ms": (finished - created) * 1000,
+        "messages_per_sec": args.clients / elapsed if elapsed else 0.0,
+    }
+    if args.transport == "fake" and fake_outbox.total:
+        result["avg_message_bytes"] = fake_outbox.total_bytes / fake_outbox.total
+    if sink:
+        result["sink_received"] = sink.received
+    return result
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"transport：{result['transport']}（batch {result['batch_size']}，並行 {result['concurrency']}）",
+        f"工作狀態：{result['status']}，成功 {result['sent']} / 失敗 {result['failed']} / 共 {result['clients']}",
+        f"EmailLog 寫入：{result['email_logs']} 筆",
+        f"建立工作：{result['create_job_ms']:.0f} ms",
+        f"發送 + 寫入記錄：{result['send_and_persist_ms']:.0f} ms",
+        f"吞吐量：{result['messages_per_sec']:.0f} 封 / 秒",
+    ]
+    if "avg_message_bytes" in result:
+        lines.append(f"平均郵件大小：{result['avg_message_bytes']:.0f} bytes")
+    if "sink_received" in result:
+        lines.append(f"SMTP 接收端收到：{result['sink_received']} 封")
+    if result["email_logs"] != result["clients"]:
+        lines.append("⚠️  EmailLog 筆數與收件人數不符")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="量測發信吞吐量（EmailSendRequest → EmailLog）")
+    parser.add_argument("--clients", type=int, default=2000, help="收件人數")
+    parser.add_argument("--transport", choices=("fake", "smtp", "gmail"), default="fake")
+    parser.add_argument("--latency-ms", type=int, default=0, help="fake transport 每個 batch 模擬的網路延遲")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate-limit", action="store_true", help="套用 GMAIL_SEND_RATE 等實際的速率限制")
+    parser.add_argument("--smtp-sink", action="store_true", help="啟動本機 aiosmtpd 接收端（搭配 --transport smtp）")
+    parser.add_argument("--sink-port", type=int, default=8025)
+    parser.add_argument("--database-url", help="專用的測試資料庫（預設為暫存 SQLite）")
+    args = parser.parse_args()
+
+    configure(args)
+    print(format_report(run(args)))
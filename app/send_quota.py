@@ -0,0 +1,130 @@
+"""
+每日發送配額（資料庫共用）
+rate_limit.DailyQuota 只在程序內計數：uvicorn --workers N 時每個程序各有一份上限，重啟後也會歸零。
+SharedDailyQuota 把用量記在 send_quota 表（發送者 credential_key + 台北時間日期一列），以條件式 UPDATE
+（used + n <= limit）原子地保留配額，所有程序共用同一個上限，重啟後也不會歸零。
+Gmail 的限制以發送帳號計算，因此每位發送者各自一份配額，不會因其他人的大量發信而用完。
+當天的列第一次建立時，以該發送者當天已成功發送的 EmailLog 筆數（經由 email_jobs.credential_key）作為起始用量。
+資料庫暫時無法使用時退回程序內計數，不中斷發送。
+"""
+from datetime import date, datetime, time as dt_time
+from sqlalchemy import case, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from typing import Callable, Optional
+import logging
+
+from app import models
+from app.rate_limit import DailyQuota, _TAIPEI_TZ
+
+logger = logging.getLogger(__name__)
+
+# 沒有 credential_key 時使用的發送者識別碼（主鍵欄位不可為 NULL）
+_DEFAULT_SENDER = ""
+
+
+class SharedDailyQuota(DailyQuota):
+    """介面與 DailyQuota 相同（reserve / release / snapshot），用量存放在資料庫"""
+
+    def __init__(self, limit: int, session_factory: Optional[Callable[[], Session]] = None, **kwargs):
+        super().__init__(limit, **kwargs)
+        self._session_factory = session_factory
+
+    def _session(self) -> Session:
+        if self._session_factory is None:
+            from app.database import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    def _sent_today(self, db: Session, day: date, sender: str) -> int:
+        """該發送者當天已成功發送的 EmailLog 筆數（sent_at 以伺服器本地時間寫入）"""
+        start = datetime.combine(day, dt_time.min, _TAIPEI_TZ).astimezone().replace(tzinfo=None)
+        return db.query(func.count(models.EmailLog.id)).join(
+            models.EmailJob, models.EmailJob.id == models.EmailLog.job_id
+        ).filter(
+            models.EmailJob.credential_key == sender,
+            models.EmailLog.status == "sent",
+            models.EmailLog.sent_at >= start,
+        ).scalar() or 0
+
+    def _create_row(self, db: Session, day: date, sender: str):
+        db.add(models.SendQuota(credential_key=sender, day=day, used=self._sent_today(db, day, sender)))
+        try:
+            db.commit()
+        except IntegrityError:
+            # 其他程序同時建立了當天的列
+            db.rollback()
+
+    def _reserve(self, day: date, n: int, sender: str) -> int:
+        row_filter = (models.SendQuota.credential_key == sender, models.SendQuota.day == day)
+        db = self._session()
+        try:
+            for _ in range(3):
+                used = db.scalar(select(models.SendQuota.used).where(*row_filter))
+                if used is None:
+                    self._create_row(db, day, sender)
+                    continue
+                granted = min(n, self.limit - used)
+                if granted <= 0:
+                    return 0
+                reserved = db.execute(
+                    update(models.SendQuota)
+                    .where(*row_filter, models.SendQuota.used + granted <= self.limit)
+                    .values(used=models.SendQuota.used + granted)
+                ).rowcount
+                db.commit()
+                if reserved:
+                    return granted
+                # 其他程序剛保留了配額：重新讀取用量再試
+            return 0
+        finally:
+            db.close()
+
+    def reserve(self, n: int, key: Optional[str] = None) -> int:
+        """保留該發送者最多 n 封的配額，回傳實際保留的封數（今日已用完時為 0，不等待）"""
+        if self.limit <= 0 or n <= 0:
+            return max(n, 0)
+        try:
+            granted = self._reserve(self._now().date(), n, key or _DEFAULT_SENDER)
+        except Exception as e:
+            logger.warning(f"無法讀寫共用發送配額，改用程序內計數: {e}")
+            return super().reserve(n, key)
+        if granted < n:
+            logger.warning(f"已達每日發送配額 {self.limit} 封，{n - granted} 封延到換日後發送")
+        return granted
+
+    def release(self, n: int, key: Optional[str] = None):
+        """退回未實際送出的配額（例如被拒絕、稍後重試的郵件）"""
+        if self.limit <= 0 or n <= 0:
+            return
+        db = self._session()
+        try:
+            used = models.SendQuota.used
+            db.execute(
+                update(models.SendQuota)
+                .where(models.SendQuota.credential_key == (key or _DEFAULT_SENDER),
+                       models.SendQuota.day == self._now().date())
+                .values(used=case((used > n, used - n), else_=0))
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"無法退回共用發送配額: {e}")
+            super().release(n, key)
+        finally:
+            db.close()
+
+    def snapshot(self) -> dict:
+        day = self._now().date()
+        db = self._session()
+        try:
+            senders, max_used = db.execute(
+                select(func.count(), func.coalesce(func.max(models.SendQuota.used), 0))
+                .where(models.SendQuota.day == day)
+            ).one()
+        except Exception as e:
+            logger.warning(f"無法讀取共用發送配額: {e}")
+            return super().snapshot()
+        finally:
+            db.close()
+        return {"limit": self.limit, "day": str(day), "senders": senders, "max_used": max_used, "shared": True}
@@ -0,0 +1,117 @@
+"""
+每個 request 的 SQL 查詢統計
+- 透過 SQLAlchemy before/after_cursor_execute 事件記錄查詢次數與 DB 耗時
+- 以 Server-Timing header 回傳（瀏覽器 DevTools 可直接看到）
+- 同一個 request 重複執行相同形狀的 SQL 達門檻時發出 N+1 警告
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Optional
+import os
+import re
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 同一個 request 內相同 SQL 執行次數達此門檻即視為疑似 N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "10"))
+
+# IN (?, ?, ?) 等展開後長度不同的參數列表視為同一種形狀
+_PARAM_LIST_RE = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|\$\d+|:\w+)\s*,?)+\)")
+
+
+class QueryStats:
+    """單一 request（或 query_counter 區塊）的查詢統計"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement: str, elapsed_ms: float):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.shapes[_PARAM_LIST_RE.sub("(?)", statement)] += 1
+
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD):
+        """重複次數達門檻的 SQL 形狀"""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+_current_stats: ContextVar[Optional[QueryStats]] = ContextVar("sql_query_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats.get() is not None:
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    if stats is None:
+        return
+    starts = conn.info.get("query_start_time")
+    if starts:
+        stats.record(statement, (time.perf_counter() - starts.pop()) * 1000)
+
+
+@contextmanager
+def query_counter():
+    """
+    統計區塊內（同一個 context）執行的 SQL，可用於測試或腳本中檢查查詢數是否退化：
+
+        with query_counter() as stats:
+            crud.get_statistics(db)
+        assert stats.count == 1
+
+    透過 HTTP 呼叫時請改看回應的 Server-Timing header（desc 內含查詢數）。
+    """
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+class QueryCountMiddleware:
+    """ASGI middleware：統計每個 request 的 SQL 查詢數與耗時，加上 Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current_stats.set(stats)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                total_ms = (time.perf_counter() - started) * 1000
+                timing = (
+                    f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries", '
+                    f"app;dur={total_ms:.1f}"
+                )
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_stats.reset(token)
+            for shape, n in stats.repeated():
+                logger.warning(
+                    f"疑似 N+1 查詢：{scope['method']} {scope['path']} 重複執行 {n} 次：{shape[:200]}"
+                )
@@ -0,0 +1,83 @@
+"""
+啟動時間分析報告（python -X importtime 的彙整版）
+
+    python -m app.startup_report            # 前 20 名
+    python -m app.startup_report --top 40
+
+在獨立的子程序中以 -X importtime 匯入 app.main，列出：
+- 各頂層套件的 import 耗時（self time 加總）
+- cumulative 耗時最高的模組
+用來確認 pandas、Google API client、BeautifulSoup 等重量級套件沒有在啟動時被載入。
+"""
+from collections import defaultdict
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+# 應該延遲到第一次使用才載入的套件
+LAZY_PACKAGES = ("pandas", "googleapiclient", "google_auth_oauthlib", "bs4", "lxml", "apscheduler")
+
+
+def collect_import_times(target: str = "app.main"):
+    """在子程序中 import target，回傳 (wall_ms, [(module, self_us, cumulative_us, depth)])"""
+    env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        capture_output=True, text=True, env=env,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {target} 失敗：\n{proc.stderr[-2000:]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+    return wall_ms, rows
+
+
+def build_report(wall_ms: float, rows: list, top: int = 20) -> str:
+    by_package = defaultdict(int)
+    for module, self_us, _, _ in rows:
+        by_package[module.split(".")[0]] += self_us
+    total_us = sum(by_package.values())
+
+    lines = [
+        f"子程序總耗時（含直譯器啟動）：{wall_ms:.0f} ms",
+        f"import 耗時合計：{total_us / 1000:.0f} ms，共 {len(rows)} 個模組",
+        "",
+        f"== 頂層套件 import 耗時（前 {top} 名）==",
+    ]
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        share = self_us / total_us * 100 if total_us else 0
+        lines.append(f"{self_us / 1000:9.1f} ms  {share:5.1f}%  {package}")
+
+    lines += ["", f"== cumulative 耗時最高的模組（前 {top} 名）=="]
+    for module, _, cumulative_us, _ in sorted(rows, key=lambda r: -r[2])[:top]:
+        lines.append(f"{cumulative_us / 1000:9.1f} ms  {module}")
+
+    loaded_lazy = sorted({m.split(".")[0] for m, _, _, _ in rows} & set(LAZY_PACKAGES))
+    lines.append("")
+    if loaded_lazy:
+        lines.append(f"⚠️  啟動時載入了應延遲載入的套件：{', '.join(loaded_lazy)}")
+    else:
+        lines.append("✓ 重量級套件皆未在啟動時載入")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分析 import app.main 的啟動時間")
+    parser.add_argument("--top", type=int, default=20, help="顯示前幾名")
+    parser.add_argument("--target", default="app.main", help="要分析的模組")
+    args = parser.parse_args()
+
+    wall_ms, rows = collect_import_times(args.target)
+    print(build_report(wall_ms, rows, args.top))
@@ -0,0 +1,244 @@
+"""
+郵件模板前處理（每個模板版本只做一次，結果隨 TemplatePlan 快取）
+- CSS inline：<style> 中的簡單選擇器（tag / .class / #id 及其組合）寫入各元素的 style 屬性，
+  多數郵件客戶端（Gmail 網頁版、Outlook）會忽略或刪除 <style>；@media 與複雜選擇器保留在 <style>
+- 壓縮：移除註解（保留 Outlook 條件註解）、合併連續空白、去掉區塊標籤前後的縮排
+- MIME 骨架：boundary 與各段標頭預先組好，每封郵件只需填入收件人、主旨與內文的 base64；
+  內文沒有變數時 base64 也只編碼一次
+"""
+from base64 import encodebytes
+from email.header import Header
+from typing import Dict, List, Optional, Sequence, Tuple
+import os
+import re
+import secrets
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TEMPLATE_INLINE_CSS = os.getenv("EMAIL_TEMPLATE_INLINE_CSS", "true").lower() in ("1", "true", "yes")
+EMAIL_TEMPLATE_MINIFY = os.getenv("EMAIL_TEMPLATE_MINIFY", "true").lower() in ("1", "true", "yes")
+
+# tag、.class、#id 的組合（不含空白 / 子代 / 虛擬類別等）
+_SIMPLE_SELECTOR_RE = re.compile(r"^([a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$")
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_RULE_RE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+_HTML_COMMENT_RE = re.compile(r"<!--(?!\[if)(?!<!\[endif).*?-->", re.S)
+_PRESERVE_RE = re.compile(r"(<(pre|textarea|script)\b.*?</\2\s*>)", re.S | re.I)
+_BLOCK_TAGS = (
+    "html|head|body|title|meta|link|style|div|p|table|thead|tbody|tfoot|tr|td|th|ul|ol|li|"
+    "h[1-6]|hr|br|center|header|footer|section|article|blockquote|!doctype"
+)
+_BLOCK_SPACE_RE = re.compile(rf"\s*(</?(?:{_BLOCK_TAGS})\b[^>]*>)\s*", re.I)
+_SPACE_RE = re.compile(r"\s+")
+
+
+# ---- CSS inline ----
+
+def _split_css(css: str) -> List[Tuple[Optional[str], str]]:
+    """
+    依原文順序拆成 (selectors, declarations) 的一般規則，與需保留原文的 @ 區塊（@media 等）；
+    @ 區塊以 (None, 原文) 表示，保持位置才不會改變保留在 <style> 中規則的 cascade 順序
+    """
+    css = _CSS_COMMENT_RE.sub("", css)
+    items = []
+    position = 0
+    while position < len(css):
+        at = css.find("@", position)
+        chunk_end = at if at != -1 else len(css)
+        for match in _CSS_RULE_RE.finditer(css, position, chunk_end):
+            items.append((match.group(1).strip(), match.group(2).strip()))
+        if at == -1:
+            break
+        # @ 區塊：以大括號配對找出結尾（@import 等沒有區塊的以分號結尾）
+        brace = css.find("{", at)
+        semicolon = css.find(";", at)
+        if brace == -1 or (semicolon != -1 and semicolon < brace):
+            end = semicolon + 1 if semicolon != -1 else len(css)
+        else:
+            depth, end = 0, brace
+            while end < len(css):
+                if css[end] == "{":
+                    depth += 1
+                elif css[end] == "}":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            end += 1
+        items.append((None, css[at:end].strip()))
+        position = end
+    return items
+
+
+def _parse_declarations(text: str) -> Dict[str, str]:
+    declarations = {}
+    for item in text.split(";"):
+        name, sep, value = item.partition(":")
+        if sep and name.strip() and value.strip():
+            declarations[name.strip().lower()] = _SPACE_RE.sub(" ", value.strip())
+    return declarations
+
+
+def _selector_matcher(selector: str):
+    """簡單選擇器 → (specificity, 比對函式)；不支援的選擇器回傳 None"""
+    match = _SIMPLE_SELECTOR_RE.match(selector)
+    if not match or not selector:
+        return None
+    tag = (match.group(1) or "").lower()
+    parts = re.findall(r"([.#])([\w-]+)", match.group(2))
+    classes = {name for kind, name in parts if kind == "."}
+    ids = [name for kind, name in parts if kind == "#"]
+    if len(ids) > 1:
+        return None
+
+    def matches(element) -> bool:
+        if tag and element.name != tag:
+            return False
+        if ids and element.get("id") != ids[0]:
+            return False
+        return classes.issubset(element.get("class") or ())
+
+    return (len(ids), len(classes), 1 if tag else 0), matches
+
+
+def inline_css(html: str) -> str:
+    """把 <style> 中的規則寫入元素的 style 屬性（元素原有的 style 優先）"""
+    if "<style" not in html.lower():
+        return html
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    styles = soup.find_all("style")
+    rules, kept = [], []
+    for style in styles:
+        if style.get("media") not in (None, "", "all", "screen"):
+            # 只針對特定媒體的 <style> 不 inline，原樣保留
+            continue
+        keep = []
+        for selectors, body in _split_css(style.get_text()):
+            if selectors is None:
+                keep.append(body)
+                continue
+            declarations = _parse_declarations(body)
+            for selector in selectors.split(","):
+                selector = selector.strip()
+                matcher = _selector_matcher(selector)
+                if matcher is None:
+                    keep.append(f"{selector}{{{body}}}")
+                else:
+                    rules.append((matcher[0], len(rules), matcher[1], declarations))
+        kept.append((style, keep))
+
+    # 依 specificity、出現順序套用，後者覆蓋前者
+    rules.sort(key=lambda rule: (rule[0], rule[1]))
+    for element in soup.find_all(True):
+        if element.name in ("style", "head", "title", "meta", "link", "script"):
+            continue
+        merged = {}
+        for _, _, matches, declarations in rules:
+            if matches(element):
+                merged.update(declarations)
+        if not merged:
+            continue
+        merged.update(_parse_declarations(element.get("style", "")))
+        element["style"] = ";".join(f"{name}:{value}" for name, value in merged.items())
+
+    # 無法 inline 的規則留在原本的 <style>（順序與 media 屬性不變），清空的 <style> 移除
+    for style, keep in kept:
+        if keep:
+            style.string = "\n".join(keep)
+        else:
+            style.decompose()
+    return str(soup)
+
+
+# ---- 壓縮 ----
+
+def minify_html(html: str) -> str:
+    """移除註解與多餘空白；<pre> / <textarea> / <script> 內容保留原樣"""
+    html = _HTML_COMMENT_RE.sub("", html)
+    parts = _PRESERVE_RE.split(html)
+    out = []
+    # split 結果依序為：一般文字、保留區塊、標籤名稱、一般文字...
+    for index in range(0, len(parts), 3):
+        text = _SPACE_RE.sub(" ", parts[index])
+        out.append(_BLOCK_SPACE_RE.sub(r"\1", text))
+        if index + 1 < len(parts):
+            out.append(parts[index + 1])
+    return "".join(out).strip()
+
+
+def prepare_html(html: str) -> str:
+    """模板內文前處理（CSS inline → 壓縮）；失敗時退回原文，不影響發送"""
+    try:
+        if EMAIL_TEMPLATE_INLINE_CSS:
+            html = inline_css(html)
+        if EMAIL_TEMPLATE_MINIFY:
+            html = minify_html(html)
+    except Exception as e:
+        logger.warning(f"郵件模板前處理失敗，使用原始內容: {e}")
+    return html
+
+
+# ---- MIME ----
+
+def _header_value(value: str, linesep: str = "\n") -> str:
+    """非 ASCII 標頭以 RFC 2047 編碼；換行一律換成空白，避免客戶資料插入額外標頭"""
+    value = _SPACE_RE.sub(" ", value) if ("\n" in value or "\r" in value) else value
+    if value.isascii():
+        return value
+    return Header(value, "utf-8").encode(linesep=linesep)
+
+
+def _base64_body(html: str, linesep: bytes) -> bytes:
+    encoded = encodebytes(html.encode("utf-8"))
+    return encoded.replace(b"\n", linesep) if linesep != b"\n" else encoded
+
+
+class MimeSkeleton:
+    """
+    與 email_service.build_mime 相同結構（multipart/alternative 內含一個 base64 的 text/html），
+    但標頭與 boundary 預先組好，每封只需串接 bytes。
+    """
+
+    def __init__(self, static_body: Optional[str] = None):
+        self.boundary = "===============" + secrets.token_hex(10) + "=="
+        self._static_body = static_body
+        self._cache: Dict[bytes, Tuple[bytes, bytes, Optional[bytes]]] = {}
+
+    def _parts(self, linesep: bytes):
+        parts = self._cache.get(linesep)
+        if parts is None:
+            head = (
+                f'Content-Type: multipart/alternative; boundary="{self.boundary}"\n'
+                "MIME-Version: 1.0\n"
+            ).encode().replace(b"\n", linesep)
+            part = (
+                "\n"
+                f"--{self.boundary}\n"
+                'Content-Type: text/html; charset="utf-8"\n'
+                "MIME-Version: 1.0\n"
+                "Content-Transfer-Encoding: base64\n"
+                "\n"
+            ).encode().replace(b"\n", linesep)
+            body = _base64_body(self._static_body, linesep) if self._static_body is not None else None
+            parts = (head, part, body)
+            self._cache[linesep] = parts
+        return parts
+
+    def build(self, to: str, subject: str, html: str, from_email: Optional[str] = None,
+              linesep: str = "\n", extra_headers: Sequence[Tuple[str, str]] = ()) -> bytes:
+        sep = linesep.encode()
+        head, part, body = self._parts(sep)
+        headers = [f"to: {_header_value(to, linesep)}", f"subject: {_header_value(subject, linesep)}"]
+        if from_email:
+            headers.append(f"from: {_header_value(from_email, linesep)}")
+        headers += [f"{name}: {_header_value(value, linesep)}" for name, value in extra_headers]
+        return b"".join((
+            head,
+            linesep.join(headers).encode(), sep,
+            part,
+            body if body is not None else _base64_body(html, sep),
+            sep, f"--{self.boundary}--".encode(), sep,
+        ))
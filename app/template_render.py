@@ -0,0 +1,148 @@
+"""
+郵件模板編譯與快取
+模板只在第一次使用時掃描一次，拆成「固定文字 / 變數」片段；之後每位收件人只需填入變數後 join。
+快取以 (模板 id, updated_at) 為 key（LRU），模板修改後 updated_at 改變即自動重新編譯。
+未知的 {{...}} 佔位符在編譯時就回報，不會原樣出現在寄出的郵件中。
+"""
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+import re
+import threading
+
+# 模板可使用的變數
+KNOWN_VARIABLES = ('client_name', 'project_name', 'project_cost')
+# 快取的模板數
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "128"))
+
+_PLACEHOLDER_RE = re.compile(r"\{\{(.*?)\}\}", re.S)
+
+
+class UnknownPlaceholderError(ValueError):
+    """模板含有無法填入的佔位符"""
+
+    def __init__(self, names: Iterable[str]):
+        self.names = sorted(set(names))
+        super().__init__(f"模板含有未知的變數：{', '.join('{{' + n + '}}' for n in self.names)}")
+
+
+class CompiledTemplate:
+    """編譯後的模板：segments 為固定文字，slots 記錄需填入變數的位置"""
+
+    __slots__ = ("segments", "slots", "unknown")
+
+    def __init__(self, source: str, known: Iterable[str] = KNOWN_VARIABLES):
+        known = set(known)
+        self.segments: List[str] = []
+        self.slots: List[Tuple[int, str]] = []
+        self.unknown: List[str] = []
+        position = 0
+        for match in _PLACEHOLDER_RE.finditer(source):
+            self.segments.append(source[position:match.start()])
+            name = match.group(1)
+            if name in known:
+                self.slots.append((len(self.segments), name))
+                self.segments.append("")
+            else:
+                # 未知變數保留原文（與舊版 str.replace 行為相同），並記錄下來
+                self.unknown.append(name)
+                self.segments.append(match.group(0))
+            position = match.end()
+        self.segments.append(source[position:])
+
+    def render(self, variables: Dict[str, object]) -> str:
+        parts = self.segments.copy()
+        for index, name in self.slots:
+            parts[index] = str(variables[name])
+        return "".join(parts)
+
+
+class TemplatePlan:
+    """
+    一個 EmailTemplate 的主旨與內文；prepare 時內文先經過 CSS inline 與壓縮，
+    並預先組好 MIME 骨架（見 app.template_prepare），隨 plan 一起快取
+    """
+
+    __slots__ = ("subject", "content", "mime")
+
+    def __init__(self, subject: str, content: str, prepare: bool = True):
+        from app.template_prepare import MimeSkeleton, prepare_html
+
+        if prepare:
+            content = prepare_html(content)
+        self.subject = CompiledTemplate(subject)
+        self.content = CompiledTemplate(content)
+        unknown = self.subject.unknown + self.content.unknown
+        if unknown:
+            raise UnknownPlaceholderError(unknown)
+        # 內文沒有變數時，base64 也只需編碼一次
+        self.mime = MimeSkeleton("".join(self.content.segments) if not self.content.slots else None)
+
+    def render(self, variables: Dict[str, object]) -> Tuple[str, str]:
+        """回傳 (主旨, 內文)"""
+        return self.subject.render(variables), self.content.render(variables)
+
+    def message(self, to: str, variables: Dict[str, object]) -> dict:
+        """發送用的 message（transport 以 template_plan 的 MIME 骨架組出郵件）"""
+        subject, html = self.render(variables)
+        return {'to': to, 'subject': subject, 'message_html': html, 'template_plan': self}
+
+
+class _LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[tuple, TemplatePlan]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[TemplatePlan]:
+        with self._lock:
+            plan = self._data.get(key)
+            if plan is not None:
+                self._data.move_to_end(key)
+            return plan
+
+    def put(self, key, plan: TemplatePlan):
+        with self._lock:
+            self._data[key] = plan
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_plan_cache = _LRUCache(TEMPLATE_CACHE_SIZE)
+
+
+def get_template_plan(template) -> TemplatePlan:
+    """
+    取得 EmailTemplate 編譯後的 plan（依 id + updated_at 快取）；
+    模板含未知變數時拋出 UnknownPlaceholderError
+    """
+    key = (template.id, template.updated_at)
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = TemplatePlan(template.subject, template.content)
+        _plan_cache.put(key, plan)
+    return plan
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_source(source: str, known: Tuple[str, ...] = KNOWN_VARIABLES) -> CompiledTemplate:
+    """依模板原文快取編譯結果（供只有模板字串的呼叫端，如 GmailService.render_template）"""
+    return CompiledTemplate(source, known)
+
+
+def client_variables(client) -> dict:
+    """客戶資料 → 模板變數"""
+    return {
+        'client_name': client.client_name,
+        'project_name': client.project_name,
+        'project_cost': f"NT$ {client.project_cost:,}",
+    }
@@ -4,11 +4,9 @@
 import sys
 sys.path.append('.')
 
-from app.database import SessionLocal, engine
-from app.models import EmailTemplate, Base
-
-# 建立資料表
-Base.metadata.create_all(bind=engine)
+from app.database import SessionLocal
+from app.models import EmailTemplate
+from app.migrations import run_migrations
 
 def init_email_templates():
     db = SessionLocal()
@@ -188,6 +186,8 @@ if __name__ == "__main__":
     print("========================================")
     print()
     
+    # 確保資料表已建立
+    run_migrations()
     init_email_templates()
     
     print()
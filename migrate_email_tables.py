@@ -1,19 +1,18 @@
 """
 資料庫遷移腳本：新增 EmailTemplate 和 EmailLog 表
+（實際遷移由 app/migrations.py 執行，等同 python -m app.migrations）
 """
-from sqlalchemy import create_engine
-from app.database import Base, engine
-from app.models import Client, EmailTemplate, EmailLog
-import os
+from app.database import engine
+from app.migrations import run_migrations
 
 def migrate_database():
     """執行資料庫遷移"""
     print("🔄 開始資料庫遷移...")
     
     try:
-        # 建立所有新表（如果不存在）
-        Base.metadata.create_all(bind=engine)
-        print("✅ 資料庫表已建立/更新")
+        # 執行尚未套用的遷移（建立資料表與索引）
+        applied = run_migrations(engine)
+        print(f"✅ 資料庫表已建立/更新（本次套用：{', '.join(applied) or '無'}）")
         
         # 驗證表是否存在
         from sqlalchemy import inspect
@@ -30,6 +30,9 @@ echo ""
 echo "按 Ctrl+C 停止"
 echo ""
 
+# 資料庫遷移（建立資料表與索引）
+python -m app.migrations || exit 1
+
 # 使用 --reload-dir 避免 multiprocessing 問題
 # 或者不使用 --reload 以獲得更穩定的運行
 python -m uvicorn app.main:app --host 0.0.0.0 --port 8000 --reload --reload-dir app --log-level info
@@ -21,4 +21,5 @@ echo "按 Ctrl+C 停止"
 echo ""
 
 # 不使用 reload，避免所有 multiprocessing 問題
+python -m app.migrations || exit 1
 python -m uvicorn app.main:app --host 0.0.0.0 --port 8000 --log-level info
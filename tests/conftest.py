@@ -0,0 +1,54 @@
+"""
+測試共用設定：暫存 SQLite 資料庫、fake transport、不限速率與配額。
+各模組於 import 時讀取環境變數，因此必須在 import app 之前設定。
+"""
+import os
+import tempfile
+
+_DB_DIR = tempfile.mkdtemp(prefix="crm-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+os.environ["MAIL_TRANSPORT"] = "fake"
+os.environ["GMAIL_SEND_RATE"] = "1000000"
+os.environ["GMAIL_SEND_BURST"] = "1000000"
+os.environ["GMAIL_DAILY_QUOTA"] = "0"
+os.environ["GMAIL_SEND_MAX_RETRIES"] = "0"
+
+import pytest
+from fastapi import Request
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app.migrations import run_migrations
+    from app.main import app as fastapi_app
+
+    run_migrations()
+
+    @fastapi_app.get("/_test/login")
+    def _test_login(request: Request, email: str = "tester@example.com", refresh_token: str = ""):
+        request.session["user"] = {"email": email}
+        request.session["gmail_token"] = {"refresh_token": refresh_token} if refresh_token else None
+        return {}
+
+    return fastapi_app
+
+
+@pytest.fixture
+def client(app):
+    from fastapi.testclient import TestClient
+
+    # 不進入 lifespan（不啟動排程器）；TrustedHostMiddleware 只允許 localhost 等主機
+    test_client = TestClient(app, base_url="https://localhost")
+    test_client.get("/_test/login")
+    return test_client
+
+
+@pytest.fixture
+def db(app):
+    from app.database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
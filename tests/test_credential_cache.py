@@ -0,0 +1,40 @@
+"""Gmail 憑證快取：閒置的憑證不再提前更新，並移出快取"""
+from datetime import timedelta
+import time
+
+from app.credential_cache import CredentialCache, _utcnow, credential_key
+
+
+def _cached(cache: CredentialCache) -> str:
+    """登記一組憑證後停止背景 thread，由測試直接操作閒置時間"""
+    token = {"access_token": "access", "refresh_token": "refresh-idle-test",
+             "expires_at": int(time.time()) + 3600}
+    cache.get(token)
+    cache.stop()
+    cache._thread.join()
+    return credential_key(token)
+
+
+def test_idle_credentials_are_not_refreshed_and_are_evicted():
+    cache = CredentialCache(idle_seconds=60, check_seconds=3600)
+    key = _cached(cache)
+    entry = cache._entries[key]
+
+    # 即將到期、仍在使用中的憑證需要提前更新
+    entry.credentials.expiry = _utcnow() + timedelta(seconds=10)
+    assert cache._needs_refresh(entry)
+
+    entry.last_used = _utcnow() - timedelta(seconds=120)
+    assert not cache._needs_refresh(entry)
+    assert cache.evict_idle() == 1
+    assert cache.token_for(key) is None
+
+
+def test_use_keeps_credentials_cached():
+    cache = CredentialCache(idle_seconds=60, check_seconds=3600)
+    key = _cached(cache)
+    cache._entries[key].last_used = _utcnow() - timedelta(seconds=120)
+
+    assert cache.token_for(key) is not None
+    assert cache.evict_idle() == 0
+    assert cache.token_for(key)["refresh_token"] == "refresh-idle-test"
@@ -0,0 +1,145 @@
+"""以相同冪等鍵重送：程序中斷而遺留的工作應續送，且已發送的客戶不重複發送"""
+from datetime import datetime, timedelta, timezone
+import time
+import uuid
+
+import pytest
+
+from app import email_jobs, models
+from app.mail_transport import fake_outbox
+
+
+@pytest.fixture
+def campaign(db):
+    template = models.EmailTemplate(
+        name="續送測試", template_type="invoice",
+        subject="{{client_name}} 請款通知", content="<p>{{project_name}}：{{project_cost}}</p>",
+    )
+    db.add(template)
+    clients = [
+        models.Client(client_name=f"客戶 {i}", project_name=f"專案 {i}",
+                      email=f"replay{i}@example.com", project_cost=100 + i)
+        for i in range(30)
+    ]
+    db.add_all(clients)
+    db.commit()
+    return {
+        "template_id": template.id,
+        "client_ids": [c.id for c in clients],
+        "idempotency_key": f"replay-{uuid.uuid4().hex}",
+    }
+
+
+def _wait(client, job_id: int) -> dict:
+    for _ in range(200):
+        job = client.get(f"/api/emails/jobs/{job_id}").json()
+        if job["status"] in email_jobs.FINISHED_STATUSES:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"發信工作 {job_id} 未在時限內結束")
+
+
+def _interrupt(db, job_id: int, keep: int, lease_expires_at):
+    """模擬程序在發送途中被強制結束：只留下前 keep 筆記錄，工作停在 running"""
+    logs = (
+        db.query(models.EmailLog).filter(models.EmailLog.job_id == job_id)
+        .order_by(models.EmailLog.id).all()
+    )
+    for log in logs[keep:]:
+        db.delete(log)
+    db.query(models.EmailJob).filter(models.EmailJob.id == job_id).update({
+        "status": "running",
+        "sent_count": keep,
+        "failed_count": 0,
+        "finished_at": None,
+        "worker_id": "dead-host:1:deadbeef",
+        "lease_expires_at": lease_expires_at,
+    })
+    db.commit()
+
+
+def test_replay_resumes_job_with_expired_lease(client, db, campaign):
+    first = client.post("/api/emails/send", json=campaign).json()
+    job_id = first["job_id"]
+    assert _wait(client, job_id)["status"] == "completed"
+
+    _interrupt(db, job_id, keep=10, lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+    sent_before = fake_outbox.total
+
+    replay = client.post("/api/emails/send", json=campaign).json()
+    assert replay["duplicate"] is True
+    assert replay["job_id"] == job_id
+    assert replay["message"] == "工作已重新排入佇列，已發送的客戶不會重複發送"
+
+    job = _wait(client, job_id)
+    assert job["status"] == "completed"
+    assert job["sent_count"] == 30
+    # 只補送中斷時尚未寫入記錄的 20 位客戶
+    assert fake_outbox.total - sent_before == 20
+    db.expire_all()
+    assert db.query(models.EmailLog).filter(models.EmailLog.job_id == job_id).count() == 30
+
+
+def test_replay_does_not_resume_job_with_live_lease(client, db, campaign):
+    first = client.post("/api/emails/send", json=campaign).json()
+    job_id = first["job_id"]
+    _wait(client, job_id)
+
+    _interrupt(db, job_id, keep=10, lease_expires_at=datetime.now(timezone.utc) + timedelta(minutes=5))
+    sent_before = fake_outbox.total
+
+    replay = client.post("/api/emails/send", json=campaign).json()
+    assert replay["duplicate"] is True
+    assert replay["message"] == "此請求已受理，不會重複發送"
+    assert replay["status"] == "running"
+    assert fake_outbox.total == sent_before
+
+
+def test_recover_marks_orphaned_job_failed_then_replay_resumes(client, db, campaign):
+    first = client.post("/api/emails/send", json=campaign).json()
+    job_id = first["job_id"]
+    _wait(client, job_id)
+
+    _interrupt(db, job_id, keep=25, lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+    assert email_jobs.recover_orphaned_jobs(db) >= 1
+    db.expire_all()
+    assert db.get(models.EmailJob, job_id).status == "failed"
+
+    client.post("/api/emails/send", json=campaign)
+    job = _wait(client, job_id)
+    assert job["status"] == "completed"
+    assert job["sent_count"] == 30
+
+
+def test_idempotency_key_is_scoped_to_the_user(client, db, campaign):
+    first = client.post("/api/emails/send", json=campaign).json()
+    _wait(client, first["job_id"])
+
+    client.get("/_test/login", params={"email": "other@example.com"})
+    other = client.post("/api/emails/send", json=campaign).json()
+    assert "duplicate" not in other
+    assert other["job_id"] != first["job_id"]
+    _wait(client, other["job_id"])
+    db.expire_all()
+    assert db.get(models.EmailJob, other["job_id"]).created_by == "other@example.com"
+
+
+def test_replay_resumes_only_with_the_original_sender_credentials(client, db, campaign, monkeypatch):
+    monkeypatch.setattr("app.routers.emails.requires_gmail_auth", lambda: True)
+    monkeypatch.setattr("app.mail_transport.requires_gmail_auth", lambda: True)
+    client.get("/_test/login", params={"refresh_token": "mailbox-a"})
+    first = client.post("/api/emails/send", json=campaign).json()
+    job_id = first["job_id"]
+    _wait(client, job_id)
+    _interrupt(db, job_id, keep=10, lease_expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+    sent_before = fake_outbox.total
+
+    client.get("/_test/login", params={"refresh_token": "mailbox-b"})
+    response = client.post("/api/emails/send", json=campaign)
+    assert response.status_code == 409
+    assert fake_outbox.total == sent_before
+
+    client.get("/_test/login", params={"refresh_token": "mailbox-a"})
+    replay = client.post("/api/emails/send", json=campaign).json()
+    assert replay["message"] == "工作已重新排入佇列，已發送的客戶不會重複發送"
+    assert _wait(client, job_id)["sent_count"] == 30
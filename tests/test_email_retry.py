@@ -0,0 +1,73 @@
+"""重試佇列：一律以原發送者重送，取不到原發送者的憑證時有限次後放棄"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import email_retry, models
+from app.credential_cache import credential_key
+from app.email_service import GmailService
+from app.mail_transport import fake_outbox
+
+
+@pytest.fixture
+def gmail_auth(monkeypatch):
+    """模擬 Gmail transport，且伺服器端 gmail_token.pickle 可用"""
+    monkeypatch.setattr("app.mail_transport.requires_gmail_auth", lambda: True)
+    monkeypatch.setattr(GmailService, "is_authenticated", lambda self: True)
+
+
+def _failed_send(db, key):
+    template = models.EmailTemplate(name="重試測試", template_type="invoice",
+                                    subject="通知 {{client_name}}", content="<p>{{project_name}}</p>")
+    client = models.Client(client_name="客戶", project_name="專案",
+                           email="retry@example.com", project_cost=100)
+    db.add_all([template, client])
+    db.flush()
+    log = models.EmailLog(client_id=client.id, client_email=client.email, template_id=template.id,
+                          subject="通知", status="failed", error_message="503")
+    db.add(log)
+    db.flush()
+    entry = email_retry.retry_entry(None, client.id, template.id, key, "503")
+    entry["next_attempt_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+    item = models.EmailRetry(email_log_id=log.id, **entry)
+    db.add(item)
+    db.commit()
+    return item, log
+
+
+def _drain_due(db, item) -> dict:
+    item.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+    db.commit()
+    return email_retry.drain_retry_queue(db)
+
+
+def test_missing_user_credential_never_falls_back_to_server_account(db, gmail_auth):
+    item, log = _failed_send(db, credential_key({"refresh_token": "logged-out-user"}))
+    sent_before = fake_outbox.total
+
+    for attempt in range(1, email_retry.EMAIL_RETRY_CREDENTIAL_ATTEMPTS):
+        summary = _drain_due(db, item)
+        assert summary["postponed"] == 1
+        db.refresh(item)
+        assert item.status == "pending"
+        assert item.attempts == attempt
+
+    summary = _drain_due(db, item)
+    assert summary["dead"] == 1
+    db.refresh(item)
+    db.refresh(log)
+    assert item.status == "dead"
+    assert item.last_error == email_retry.CREDENTIAL_UNAVAILABLE
+    assert log.status == "failed"
+    assert fake_outbox.total == sent_before
+
+
+def test_server_pickle_items_retry_with_server_account(db, gmail_auth):
+    item, log = _failed_send(db, email_retry.sender_credential_key(None))
+
+    summary = _drain_due(db, item)
+    assert summary["sent"] == 1
+    db.refresh(item)
+    db.refresh(log)
+    assert item.status == "sent"
+    assert log.status == "sent"
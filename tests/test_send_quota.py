@@ -0,0 +1,69 @@
+"""每日發送配額：依發送者分開計算，用完時不等待，剩下的郵件排入重試佇列於換日後發送"""
+from datetime import datetime, timedelta, timezone
+import time
+import uuid
+
+from app import email_jobs, email_retry, models
+from app.rate_limit import _TAIPEI_TZ
+from app.send_quota import SharedDailyQuota
+
+
+class Clock:
+    def __init__(self):
+        self.now = datetime(2030, 1, 1, 10, 0, tzinfo=_TAIPEI_TZ)
+
+    def __call__(self) -> datetime:
+        return self.now
+
+
+def test_quota_is_counted_per_sender():
+    quota = SharedDailyQuota(5, now=Clock())
+    alice, bob = f"alice-{uuid.uuid4().hex}", f"bob-{uuid.uuid4().hex}"
+
+    assert quota.reserve(5, alice) == 5
+    assert quota.reserve(1, alice) == 0
+    assert quota.reserve(3, bob) == 3
+    quota.release(2, alice)
+    assert quota.reserve(3, alice) == 2
+
+
+def test_exhausted_quota_parks_recipients_until_reset(db, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("app.email_sender.daily_quota", SharedDailyQuota(10, now=clock))
+    template = models.EmailTemplate(name="配額測試", template_type="invoice",
+                                    subject="通知 {{client_name}}", content="<p>{{project_name}}</p>")
+    clients = [
+        models.Client(client_name=f"客戶 {i}", project_name=f"專案 {i}",
+                      email=f"quota{i}@example.com", project_cost=100)
+        for i in range(30)
+    ]
+    db.add(template)
+    db.add_all(clients)
+    db.commit()
+    sender = f"quota-sender-{uuid.uuid4().hex}"
+    job, _ = email_jobs.create_job(db, template.id, [c.id for c in clients], "tester@example.com",
+                                   credential_key=sender)
+
+    started = time.monotonic()
+    email_jobs.run_job(job.id, None)
+    assert time.monotonic() - started < 10
+
+    db.expire_all()
+    job = db.get(models.EmailJob, job.id)
+    assert (job.status, job.sent_count, job.failed_count) == ("completed", 10, 20)
+    parked = db.query(models.EmailRetry).filter(models.EmailRetry.job_id == job.id).all()
+    assert len(parked) == 20
+    assert all(item.credential_key == sender for item in parked)
+    assert email_retry.drain_retry_queue(db)["sent"] == 0
+
+    # 隔天：配額重置，重試佇列送出當天配額內的 10 封，其餘再延到下一次重置
+    clock.now += timedelta(days=1)
+    for item in parked:
+        item.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+    db.commit()
+    summary = email_retry.drain_retry_queue(db)
+    assert (summary["sent"], summary["postponed"], summary["dead"]) == (10, 10, 0)
+    db.expire_all()
+    job = db.get(models.EmailJob, job.id)
+    assert (job.sent_count, job.failed_count) == (20, 10)
+    assert all(item.attempts == 0 for item in parked)
@@ -0,0 +1,103 @@
+"""郵件模板前處理：CSS inline、壓縮與預先組好的 MIME 骨架"""
+import email
+from email.header import decode_header, make_header
+
+import pytest
+
+from app.template_prepare import MimeSkeleton, inline_css, minify_html
+
+
+def _style_text(html: str) -> str:
+    start = html.index("<style>") + len("<style>")
+    return html[start:html.index("</style>")]
+
+
+def test_inline_css_applies_specificity_and_keeps_element_style():
+    html = (
+        "<html><head><style>"
+        "p { color: red; margin: 0 }"
+        ".note { color: blue }"
+        "p.note#main { font-weight: bold }"
+        "</style></head><body>"
+        '<p class="note" id="main" style="margin: 4px">hi</p><p>plain</p>'
+        "</body></html>"
+    )
+    out = inline_css(html)
+
+    assert "<style" not in out
+    assert 'style="color:blue;margin:4px;font-weight:bold"' in out
+    assert '<p style="color:red;margin:0">plain</p>' in out
+
+
+def test_inline_css_keeps_non_inlinable_rules_in_source_order():
+    html = (
+        "<style>"
+        "a:hover { color: red }"
+        "@media (max-width: 600px) { a:hover { color: blue } }"
+        "td > a { color: green }"
+        "</style><a href='#'>x</a>"
+    )
+    kept = _style_text(inline_css(html))
+
+    assert kept.index("a:hover{color: red}") < kept.index("@media") < kept.index("td > a{color: green}")
+
+
+def test_inline_css_keeps_media_specific_style_blocks():
+    html = (
+        "<style>a:hover { color: red }</style>"
+        "<style media=\"print\">p { color: black }</style>"
+        "<style>p { color: red }</style><p>x</p>"
+    )
+    out = inline_css(html)
+
+    assert '<p style="color:red">x</p>' in out
+    assert out.startswith('<style>a:hover{color: red}</style><style media="print">p { color: black }</style><p')
+
+
+def test_minify_removes_comments_but_keeps_conditional_comments_and_pre():
+    html = (
+        "<div>\n  <!-- 內部備註 -->\n"
+        "  <!--[if mso]><table><tr><td><![endif]-->\n"
+        "  <p>a   b</p>\n"
+        "  <pre>  line 1\n    line 2</pre>\n"
+        "</div>"
+    )
+    out = minify_html(html)
+
+    assert "內部備註" not in out
+    assert "<!--[if mso]>" in out and "<![endif]-->" in out
+    assert "<p>a b</p>" in out
+    assert "<pre>  line 1\n    line 2</pre>" in out
+
+
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_mime_skeleton_strips_header_injection(linesep):
+    raw = MimeSkeleton().build(
+        "client@example.com\r\nCc: cc@evil.example",
+        "請款通知\r\nBcc: evil@example.com",
+        "<p>hi</p>",
+        from_email="sender@example.com",
+        linesep=linesep,
+    )
+    message = email.message_from_bytes(raw)
+
+    assert message["Bcc"] is None
+    assert message["Cc"] is None
+    assert str(make_header(decode_header(message["Subject"]))) == "請款通知 Bcc: evil@example.com"
+    assert message["To"] == "client@example.com Cc: cc@evil.example"
+
+
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_mime_skeleton_builds_parseable_message(linesep):
+    raw = MimeSkeleton(static_body="<p>固定內文</p>").build(
+        "client@example.com", "Invoice", "ignored", linesep=linesep,
+        extra_headers=[("Reply-To", "billing@example.com")],
+    )
+    if linesep == "\r\n":
+        assert b"\n" not in raw.replace(b"\r\n", b"")
+    message = email.message_from_bytes(raw)
+
+    assert message.get_content_type() == "multipart/alternative"
+    assert message["Reply-To"] == "billing@example.com"
+    [part] = message.get_payload()
+    assert part.get_payload(decode=True).decode("utf-8") == "<p>固定內文</p>"